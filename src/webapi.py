@@ -4,15 +4,23 @@ Application loader.
 
 Handles:
     - flaskenv loading
-    - requirement updates for all plugins/macros and main application (if network is available)
+    - requirement updates for all plugins/macros and main application (if any requirements changed since the last
+      installation or --refresh-dependencies is passed)
     - database upgrade
-    - loading WSGI server in production mode
+    - loading WSGI server in production mode (threaded or prefork, see libs.server)
 """
 
 if __name__ == "__main__":
     from sys import path
     path.append('webapi')
 
+    # Parse arguments
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='StreamHelper')
+    parser.add_argument('--refresh-dependencies', action='store_true',
+                        help='install the dependencies even if no requirements have changed')
+    args = parser.parse_args()
+
     # Load .flaskenv
     from os.path import isfile
     if isfile('.flaskenv'):
@@ -20,30 +28,31 @@ if __name__ == "__main__":
         load_export_file('.flaskenv')
 
     # Pre-load config
-    from libs.config import Config
-    config = Config()
+    from libs.config import get_config
+    config = get_config()
 
     # Install python packages
-    from libs.basics.network import is_up
-    if is_up("8.8.8.8") or is_up("1.1.1.1"):
-        from sys import executable
-        from subprocess import check_call
-        from os import listdir
-        from os.path import isfile, join
-        check_call([executable, '-m', 'pip', 'install', '--upgrade', 'pip', 'wheel'])
-        check_call([executable, '-m', 'pip', 'install', '--upgrade', '-r', 'requirements.txt'])
-        blueprint_path = config.get('webapi', 'plugin_path')
-        for blueprint in listdir(blueprint_path):
-            requirements_path = join(blueprint_path, blueprint, 'requirements.txt')
-            if isfile(requirements_path):
-                check_call([executable, '-m', 'pip', 'install', '--upgrade', '-r', requirements_path])
-        macro_path = config.get('webapi', 'macro_path')
-        for macro in listdir(macro_path):
-            requirements_path = join(macro_path, macro, 'requirements.txt')
-            if isfile(requirements_path):
-                check_call([executable, '-m', 'pip', 'install', '--upgrade', '-r', requirements_path])
+    from libs.dependencies import install_dependencies, get_changes
+    changes = get_changes(config, core_requirements='requirements.txt')
+    if args.refresh_dependencies or changes:
+        for owner, state in changes.items():
+            print(f"Requirements of {owner} {state} since the last installation")
+        from libs.basics.network import check_internet
+        online = check_internet(timeout=float(config.get('webapi', 'network_timeout')),
+                                ttl=float(config.get('webapi', 'network_cache_ttl')))
+        if online:
+            from sys import executable
+            from subprocess import check_call
+            check_call([executable, '-m', 'pip', 'install', '--upgrade', 'pip', 'wheel'])
+        else:
+            print("Internet not reachable, installing dependencies from the wheelhouse")
+        from subprocess import CalledProcessError
+        try:
+            install_dependencies(config, online=online, core_requirements='requirements.txt', force=True)
+        except (RuntimeError, CalledProcessError) as e:
+            print(f"Installing dependencies has failed: {e}")
     else:
-        print("Internet not reachable")
+        print("Dependencies unchanged since the last installation, skipping installation")
 
     # Create application
     from webapi import create_app
@@ -58,9 +67,11 @@ if __name__ == "__main__":
             debug=bool(getenv('FLASK_DEBUG', True))
         )
     else:
-        from waitress import serve
+        from libs.server import serve
         serve(
             webapi,
+            config,
+            webapi.logger,
             host=getenv('FLASK_RUN_HOST', '0.0.0.0'),
             port=int(getenv('FLASK_RUN_PORT', '5000'))
         )
@@ -3,16 +3,16 @@ Main application.
 """
 from typing import Callable
 
-from flask import Flask, Request, redirect, url_for, send_from_directory
+from flask import Flask, Request, redirect, url_for
 from flask.templating import Environment
 from flask_bootstrap import Bootstrap
 
-from libs.config import Config
-from libs.log import setup_webapi as setup, Logger
+from libs.config import get_config
+from libs.log import setup_webapi as setup, setup_request_logging, Logger
 from libs.basics.text import camel_case
 
 # Config loading
-config = Config()
+config = get_config()
 template_folder = config.get('flask', 'template_path')
 static_folder = config.get('flask', 'static_path')
 
@@ -52,6 +52,10 @@ def create_app():
 
     # Setup the logger
     logger = setup(webapi, config)
+    setup_request_logging(webapi, config)
+
+    # Pick up changes of the config file while running
+    config.watch(float(config.get('webapi', 'config_reload_interval') or 0))
 
     # Make the jinja_env accessible
     jinja_env = webapi.jinja_env
@@ -59,36 +63,50 @@ def create_app():
     # Setup the boostrap extension
     bootstrap.init_app(webapi)
 
+    # Compile plugins and macros ahead of importing them
+    from libs.bytecode import enable_pycache_prefix, precompile
+    enable_pycache_prefix(config)
+    if config.get('webapi', 'precompile').lower() == 'true':
+        precompile(config, logger)
+
     # Load blueprints
-    from libs.plugins import load_plugins, get_plugins, get_plugin_pages, get_active_plugins, _activate_plugin, \
-        get_plugins_jinja, exec_post_actions
+    from libs.plugins import load_plugins, get_plugins, get_plugin_pages, get_active_plugins, is_plugin_active, \
+        _activate_plugin, get_plugins_jinja, exec_post_actions, provide_macros, CORE_PLUGINS
     load_plugins(webapi, config, logger)
     # Make sure the main components are always activated
-    _activate_plugin('base', 'errors')
+    _activate_plugin(*CORE_PLUGINS)
 
     # Load macros
-    from libs.macros import load_macros, get_macros, get_macros_jinja
+    from libs.macros import load_macros, get_macros_jinja
     load_macros(config, logger)
 
     # Provide plugins with macros
     for plugin in get_plugins().values():
-        add_macros = {'config': Config, 'logger': Logger}
-        if hasattr(plugin, 'request_macros'):
-            for macro in plugin.request_macros:
-                if macro in get_macros():
-                    add_macros[macro] = get_macros()[macro]
-        plugin.macros = add_macros
+        provide_macros(plugin)
 
     # Run post load actions
     exec_post_actions()
 
+    # Bundle the stylesheets and scripts of the templates and plugins
+    from libs.assets import build_assets, asset_url, asset_urls, send_asset as send_asset_file
+    build_assets(webapi, config, logger)
+
+    # Index the generated thumbnails of earlier runs
+    from libs.thumbnails import setup as setup_thumbnails
+    setup_thumbnails(config, logger)
+
+    # Report the load times
+    from libs.startup import log_summary
+    log_summary(logger)
+
     # Make function callable from jinja templates
     expose_function_for_templates(len=len, enumerate=enumerate, str=str, int=int, list=list, dict=dict,
                                   get_plugin_pages=get_plugin_pages, get_plugins=get_plugins_jinja,
-                                  get_active_plugins=get_active_plugins, get_macros=get_macros_jinja,
+                                  get_active_plugins=get_active_plugins, is_plugin_active=is_plugin_active,
+                                  get_macros=get_macros_jinja,
                                   get_bootstrap_version=get_bootstrap_version, get_jquery_version=get_jquery_version,
                                   get_ace_version=get_ace_version, get_fontawesome_version=get_fontawesome_version,
-                                  camel_case=camel_case)
+                                  camel_case=camel_case, asset_url=asset_url, asset_urls=asset_urls)
 
     # Create a basic redirect to the base plugin
     @webapi.route('/')
@@ -102,25 +120,54 @@ def create_app():
         return redirect(url_for('base.dashboard'))
 
     # Allow access to files in media folder
-    @webapi.route('/media/<filename>')
+    @webapi.route('/media/<path:filename>')
     def get_file(filename):
         """
-        Open a media file from global media folder.
+        Open a media file from global media folder. Answers conditional and range requests, see
+        libs.basics.api.files.send_file_cached.
 
         :param filename: filename to load
         :return: file
         """
-        return send_from_directory(config.get('webapi', 'media_path'), filename)
+        return _send_cached(config.get('webapi', 'media_path'), filename, 'media')
 
-    @webapi.route('/thumbnail/<filename>')
+    @webapi.route('/thumbnail/<path:filename>')
     def get_thumbnail(filename):
         """
-        Open a thumbnail file from global thumbnail folder.
+        Open a thumbnail file from global thumbnail folder. If there is no such file or the parameters size or format
+        are passed, a thumbnail of the media file with this name is generated on demand, see libs.thumbnails. Answers
+        conditional and range requests, see libs.basics.api.files.send_file_cached.
 
         :param filename: filename to load
         :return: file
         """
-        return send_from_directory(config.get('webapi', 'thumbnail_path'), filename)
+        from os.path import isfile
+        from flask.helpers import safe_join
+        from werkzeug.exceptions import BadRequest, NotFound
+        from libs.basics.api.parsing import param
+        from libs.thumbnails import get_thumbnail as generate_thumbnail
+
+        thumbnail_path = config.get('webapi', 'thumbnail_path')
+        size, image_format = param('size', None), param('format', None)
+        if size is None and image_format is None and isfile(safe_join(thumbnail_path, filename)):
+            return _send_cached(thumbnail_path, filename, 'thumbnail')
+        try:
+            name = generate_thumbnail(config, filename, size, image_format)
+        except ValueError as e:
+            raise BadRequest(str(e))
+        except (FileNotFoundError, RuntimeError) as e:
+            raise NotFound(str(e))
+        return _send_cached(thumbnail_path, name, 'thumbnail')
+
+    @webapi.route('/assets/<path:filename>')
+    def send_asset(filename):
+        """
+        Open a built asset bundle, see libs.assets.
+
+        :param filename: file name of the bundle
+        :return: file
+        """
+        return send_asset_file(config.get('webapi', 'asset_path'), filename)
 
     @webapi.route('/favicon.ico')
     def favicon():
@@ -134,6 +181,22 @@ def create_app():
     return webapi
 
 
+def _send_cached(directory: str, filename: str, kind: str):
+    """
+    Send a media file or thumbnail with the Cache-Control policy and sendfile mode from configuration.
+
+    :param directory: folder containing the files
+    :param filename: path of the file relative to the folder
+    :param kind: media or thumbnail, selects the policy <kind>_cache_control and the sendfile location
+    :return: the response
+    """
+    from libs.basics.api.files import send_file_cached, parse_cache_policies, get_cache_control
+    cache_control = get_cache_control(parse_cache_policies(config.get('webapi', f'{kind}_cache_control')), filename)
+    sendfile_prefix = f'{config.get("webapi", "sendfile_prefix").rstrip("/")}/{kind}'
+    return send_file_cached(directory, filename, cache_control, config.get('webapi', 'sendfile').lower(),
+                            sendfile_prefix)
+
+
 def expose_function_for_templates(**kwargs):
     """
     Make a passed function callable from jinja framework.
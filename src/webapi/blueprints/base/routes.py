@@ -4,9 +4,8 @@ Routes for the base plugin.
 from os import remove
 from os.path import join, basename, dirname
 from zipfile import ZipFile
-from time import sleep
 
-from flask import render_template, request, flash, url_for
+from flask import render_template, request, flash, jsonify
 from werkzeug.utils import secure_filename
 
 from libs.basics.api.response import response, redirect_or_response
@@ -31,9 +30,15 @@ def _extract_blueprint_zip(filepath, delete=False):
 
     If the zip contains multiple files at root level, the name of the zip determines the name of the folder.
 
+    An already installed version of the blueprint is updated incrementally, only changed files are written and the new
+    tree replaces the old one at once, see libs.basics.archive.extract_incremental.
+
     :param filepath: path to the zip file
     :param delete: whether to delete the zip after extraction
-    :return:
+    :raises ValueError: if the folder name is invalid or belongs to a core plugin (see libs.plugins.check_plugin_folder)
+        or the zip contains paths leaving the blueprint folder
+    :return: the name of the directory containing the files and a dictionary with the lists of changed, removed and
+        unchanged files
     """
     # Basic error checks
     if not filepath.endswith('.zip'):
@@ -42,62 +47,85 @@ def _extract_blueprint_zip(filepath, delete=False):
     if not isfile(filepath) or isdir(filepath):
         raise FileNotFoundError('Given file seems to be no file.')
 
+    from libs.basics.archive import extract_incremental
+    from libs.plugins import check_plugin_folder
+
     # Extraction
-    with ZipFile(filepath, 'r') as zip_file:
-        extract_filepath = dirname(filepath)
-        org_extract_filepath = extract_filepath
-        filename_without_ext = '.'.join(basename(filepath).split('.')[:-1]).lower()
-        files = [f.filename.lower() for f in zip_file.filelist]
-        # Ensuring files will not be packed out without a directory name, using the zips name in case of doubt
-        if '/' not in files[0]:
-            extract_filepath = join(extract_filepath, filename_without_ext)
-        else:
-            prefix = files[0].split('/')[0]
-            for f in files:
+    try:
+        with ZipFile(filepath, 'r') as zip_file:
+            filename_without_ext = '.'.join(basename(filepath).split('.')[:-1]).lower()
+            files = [f.filename for f in zip_file.filelist]
+            # Ensuring files will not be packed out without a directory name, using the zips name in case of doubt
+            folder_name, strip = filename_without_ext, 0
+            if files and '/' in files[0]:
+                prefix = files[0].split('/')[0]
                 # TODO Check if separator within zip differs for Windows implementation of zipfile
-                if not f.startswith(f'{prefix}/'):
-                    extract_filepath = join(extract_filepath, filename_without_ext)
-                    break
-        # Remove old directory if present, replacing with new one TODO Dangerous?
-        if extract_filepath == org_extract_filepath:
-            if isdir(join(extract_filepath, prefix)):
-                from shutil import rmtree
-                rmtree(join(extract_filepath, prefix), ignore_errors=True)
-        else:
-            if isdir(join(extract_filepath, filename_without_ext)):
-                from shutil import rmtree
-                rmtree(join(extract_filepath, filename_without_ext), ignore_errors=True)
-        zip_file.extractall(extract_filepath)
+                if all(f.startswith(f'{prefix}/') for f in files):
+                    folder_name, strip = prefix, len(prefix) + 1
+
+            check_plugin_folder(folder_name)
+            changes = extract_incremental(zip_file, join(dirname(filepath), folder_name), rename=lambda f: f[strip:])
+    except ValueError:
+        # The rejected upload must not stay in the plugin path
+        if delete:
+            remove(filepath)
+        raise
 
     # Delete zip file after completion if requested
     if delete:
         remove(filepath)
 
     # Return the name of the directory containing the files
-    if extract_filepath == org_extract_filepath:
-        return prefix
-    else:
-        return filename_without_ext
+    return folder_name, changes
+
+
+def _store_blueprint_archive(filepath):
+    """
+    Stores a blueprint zip as packaged plugin (see libs.packaged) instead of extracting it. The zip is renamed to the
+    name of the plugin package it contains, an extracted folder of the same plugin is removed since it would take
+    precedence.
+
+    :param filepath: path to the zip file
+    :raises ValueError: if the zip does not contain exactly one package folder or its name is invalid (see
+        libs.plugins.check_plugin_folder)
+    :return: the name of the package folder
+    """
+    from os import replace
+    from os.path import isdir
+    from libs.packaged import find_package, forget_index
+    from libs.plugins import check_plugin_folder
+    folder_name = find_package(filepath)
+    if folder_name is None:
+        raise ValueError('The zip needs to contain exactly one folder with an __init__.py')
+    try:
+        check_plugin_folder(folder_name)
+    except ValueError:
+        # The rejected upload must not stay in the plugin path, where it would be loaded as packaged plugin
+        remove(filepath)
+        raise
+    target = join(dirname(filepath), f'{folder_name}.zip')
+    forget_index(target)
+    replace(filepath, target)
+    if isdir(join(dirname(filepath), folder_name)):
+        from shutil import rmtree
+        rmtree(join(dirname(filepath), folder_name))
+    return folder_name
 
 
 def _install_dependencies(blueprint_name) -> bool:
     """
-    Installs the dependencies from a single blueprint's requirements.txt
+    Installs the dependencies of all plugins and macros after a blueprint was added, resolving its requirements.txt
+    (which may be located within the archive of a packaged plugin) together with all others, see
+    libs.dependencies.install_dependencies.
 
     :param blueprint_name: name of the blueprint
-    :return: Whether an installation happened
+    :raises RuntimeError: if the requirements conflict with the ones of other plugins or macros
+    :raises subprocess.CalledProcessError: if pip fails
+    :return: Whether the blueprint has dependencies
     """
-    from . import config
-    from os.path import isfile
-    from subprocess import check_call
-    from sys import executable
-    blueprint_path = config.get('webapi', 'plugin_path')
-    requirements_path = join(blueprint_path, blueprint_name, 'requirements.txt')
-    if isfile(requirements_path):
-        check_call([executable, '-m', 'pip', 'install', '--upgrade', '-r', requirements_path])
-        return True
-    else:
-        return False
+    from . import config, logger
+    from libs.dependencies import install_dependencies
+    return f'plugin:{blueprint_name}' in install_dependencies(config, report=logger.info)
 
 
 @bp.route('/', methods=['GET', 'POST'])
@@ -114,17 +142,21 @@ def dashboard():
 @bp.route('/install', methods=['POST'])
 def install():
     """
-    Install a given zip containing a blueprint. If in production mode, changes will only appear after a server reload
-    for now.
-
-    TODO Add a reload mechanism for production mode.
+    Install a given zip containing a blueprint. Only the upload is saved within the request, extracting, compiling,
+    installing the dependencies and loading the plugin (or reloading, if it was installed before) run as background job,
+    see libs.jobs. The progress can be followed with the routes install_status and install_events.
 
     Arguments:
             - plugin (must be a file)
 
-    :return: redirect or 201 response
+    :return: redirect (with the job id as parameter job) or 202 response containing the job id, 409 while serving by
+        multiple worker processes (see libs.plugins.refuse_runtime_change)
     """
-    from . import logger, name
+    from . import logger
+    from libs.plugins import refuse_runtime_change
+    refused = refuse_runtime_change()
+    if refused is not None:
+        return refused
     if 'plugin' not in request.files:
         return redirect_or_response(400, 'Missing file "plugin"')
     file = request.files['plugin']
@@ -134,19 +166,262 @@ def install():
     if file and _allowed_file(file.filename):
         logger.debug('-> Filename accepted')
         from . import config
+        from libs.jobs import Job, submit
         filename = secure_filename(file.filename)
         filepath = join(config.get('webapi', 'plugin_path'), filename)
         logger.debug(f'-> Saving location: {filepath}')
         file.save(filepath)
         logger.debug('-> File saved')
-        fp = _extract_blueprint_zip(filepath=filepath, delete=True)
+
+        job = Job(f'installation of {filename}', lambda j: _install_job(j, filepath))
+        job.progress('saved', f'Saved upload {filename}')
+        submit(job)
+        redirect_url = param('redirect_url')
+        if redirect_url:
+            redirect_url += ('&' if '?' in redirect_url else '?') + f'job={job.id}'
+        return redirect_or_response(202, job.id, redirect_url=redirect_url)
+    return redirect_or_response(400, 'Missing post parameters')
+
+
+def _install_job(job, filepath: str) -> str:
+    """
+    Install an uploaded plugin zip, see install.
+
+    :param job: the job reporting the progress
+    :param filepath: path to the saved zip file
+    :raises Exception: if any step fails
+    :return: final message
+    """
+    from . import logger, config
+    from libs.bytecode import compile_tree
+    from libs.plugins import load_plugin, _plugin_name
+
+    packaged = config.get('webapi', 'plugin_install_mode').lower() == 'packaged'
+    if packaged:
+        fp = _store_blueprint_archive(filepath)
+        logger.debug('-> Archive stored')
+        job.progress('extracted', f'Stored packaged plugin {fp}')
+    else:
+        fp, changes = _extract_blueprint_zip(filepath=filepath, delete=True)
         logger.debug('-> Files extracted')
-        _install_dependencies(fp)
+        job.progress('extracted', f'Extracted plugin {fp}: {len(changes["changed"])} files written, '
+                                  f'{len(changes["removed"])} removed, {len(changes["unchanged"])} unchanged')
+    if _install_dependencies(fp):
         logger.debug('-> Dependencies installed')
+        job.progress('dependencies', 'Installed dependencies')
+    else:
+        job.progress('dependencies', 'No dependencies to install')
+    if not packaged:
+        try:
+            job.progress('compiled',
+                         f'Compiled {len(compile_tree(join(config.get("webapi", "plugin_path"), fp)))} modules')
+        except Exception as e:
+            logger.warning(f'-> Compiling plugin has failed: {e}')
+    try:
+        load_plugin(_plugin_name(fp))
+    except Exception as e:
+        logger.warning(f'-> Loading plugin has failed: {e}')
+        raise RuntimeError(f'Installed, but loading the plugin has failed: {e}')
+    logger.debug('-> Plugin loaded')
+    job.progress('loaded', f'Loaded plugin {_plugin_name(fp)}')
+    return f'Installed plugin {_plugin_name(fp)}'
 
-        sleep(2)
-        return redirect_or_response(201, "Installed", redirect_url=param('redirect_url', url_for(name+'.dashboard')))
-    return redirect_or_response(400, 'Missing post parameters')
+
+@bp.route('/install/<job_id>')
+def install_status(job_id):
+    """
+    Returns the state and all progress events of an installation job as json.
+
+    :param job_id: id of the job
+    :return: json response or 404
+    """
+    from libs.jobs import get_job
+    job = get_job(job_id)
+    if job is None:
+        return response(404, 'Unknown job')
+    return jsonify(job.to_dict())
+
+
+@bp.route('/install/<job_id>/events')
+def install_events(job_id):
+    """
+    Streams the progress events of an installation job as Server-Sent Events (event name progress, json data). The
+    stream ends after the last event of a finished job. Reconnecting clients only receive events they have missed.
+
+    :param job_id: id of the job
+    :return: event stream or 404
+    """
+    from libs.jobs import get_job
+    from libs.basics.api.stream import event_stream
+    job = get_job(job_id)
+    if job is None:
+        return response(404, 'Unknown job')
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    start = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+
+    def events():
+        index = start
+        while True:
+            new_events = job.wait_for_events(index, timeout=15)
+            if not new_events:
+                if job.is_finished():
+                    return
+                yield None, None, None
+            for event in new_events:
+                yield 'progress', event, str(event['id'])
+            index += len(new_events)
+
+    return event_stream(events(), retry=2000)
+
+
+@bp.route('/logs/events')
+def log_events():
+    """
+    Streams the log as Server-Sent Events (event name log, json data, see libs.log.RingBufferHandler): first the latest
+    records kept in memory, then new records as they are logged. Takes the optional parameters level (minimum level
+    name, defaults to DEBUG), logger (only this logger and its children) and backlog (number of latest records sent
+    first, defaults to 100). Reconnecting clients only receive records they have missed.
+
+    :return: event stream or 404 if the log is not kept in memory
+    """
+    from logging import getLevelName
+    from libs.log import get_ring_buffer
+    from libs.basics.api.stream import event_stream
+    ring_buffer = get_ring_buffer()
+    if ring_buffer is None:
+        return response(404, 'Log buffer is disabled')
+    level = getLevelName(param('level', 'DEBUG').upper())
+    if not isinstance(level, int):
+        return response(400, 'Invalid log level')
+    logger_name = param('logger')
+    backlog = param('backlog', '100')
+    backlog = int(backlog) if backlog.isdigit() else 100
+    last_event_id = request.headers.get('Last-Event-ID', '')
+
+    def events():
+        # Only send records below the next id at the time of reading, later ones are sent by the next iteration
+        index = ring_buffer.wait_for_records(0, timeout=0)
+        if last_event_id.isdigit():
+            records = ring_buffer.get_records(int(last_event_id) + 1, level, logger_name)
+        else:
+            records = ring_buffer.get_records(0, level, logger_name, limit=backlog)
+        while True:
+            for record in records:
+                if record['id'] < index:
+                    yield 'log', record, str(record['id'])
+            next_index = ring_buffer.wait_for_records(index, timeout=15)
+            if next_index == index:
+                records = list()
+                yield None, None, None
+                continue
+            records = ring_buffer.get_records(index, level, logger_name)
+            index = next_index
+
+    return event_stream(events(), retry=2000)
+
+
+@bp.route('/startup')
+def startup():
+    """
+    Returns the load times of all plugins and macros as json, see libs.startup.get_report.
+
+    :return: json response
+    """
+    from libs.startup import get_report
+    return jsonify(get_report())
+
+
+@bp.route('/dependencies')
+def dependencies():
+    """
+    Returns the requirement files (by owner, e.g. plugin:<folder>) changed since the last installation of the
+    dependencies as json, see libs.dependencies.get_changes.
+
+    :return: json response
+    """
+    from . import config
+    from libs.dependencies import get_changes
+    return jsonify(get_changes(config))
+
+
+@bp.route('/macros/cache')
+def macro_cache():
+    """
+    Returns the hit, miss, wait and eviction counters of all cached macro methods as json, see
+    libs.cache.get_cache_stats.
+
+    :return: json response
+    """
+    from libs.cache import get_cache_stats
+    return jsonify(get_cache_stats())
+
+
+@bp.route('/macros/cache/clear', methods=['POST'])
+def clear_macro_cache():
+    """
+    Drops cached macro results. Takes the optional parameters macro and method to limit it to a macro or a method of
+    it, see libs.cache.invalidate.
+
+    :return: empty 200 response
+    """
+    from libs.cache import invalidate
+    invalidate(param('macro') or None, param('method') or None)
+    return redirect_or_response(200)
+
+
+@bp.route('/media')
+def media():
+    """
+    Lists the indexed media files as json, see libs.media.query_media. The listing is streamed, so large pages are not
+    held in memory. Takes the optional parameters directory, recursive (true or false, defaults to true), type (mime
+    type or main type, e.g. video), q (part of the file name), sort (path, name, size, mtime or duration), order (asc
+    or desc), page (starting at 1) and per_page (defaults to 100, at most 1000).
+
+    While the initial scan of the media folder runs, the listing is incomplete and scanning is true.
+
+    :return: streamed json response containing page, per_page, total, scanning and items, or 400 if a parameter is
+        invalid
+    """
+    from json import dumps
+    from flask import Response, stream_with_context
+    from . import config
+    from libs.media import query_media, count_media, ensure_fresh, SORT_COLUMNS
+    page, per_page = param('page', '1'), param('per_page', '100')
+    if not page.isdigit() or not per_page.isdigit() or int(page) < 1:
+        return response(400, 'Invalid page or per_page')
+    page, per_page = int(page), max(1, min(int(per_page), 1000))
+    sort = param('sort', 'path')
+    if sort not in SORT_COLUMNS:
+        return response(400, f'Invalid sort, use one of {", ".join(SORT_COLUMNS)}')
+    filters = {'directory': param('directory', None), 'recursive': param('recursive', 'true').lower() == 'true',
+               'mimetype': param('type', None), 'search': param('q', None)}
+    scanning = ensure_fresh(config)
+    total = count_media(config, refresh=False, **filters)
+    items = query_media(config, sort=sort, descending=param('order', 'asc').lower() == 'desc', limit=per_page,
+                        offset=(page - 1) * per_page, refresh=False, **filters)
+
+    def generate():
+        yield f'{{"page": {page}, "per_page": {per_page}, "total": {total}, "scanning": {dumps(scanning)}, "items": ['
+        for index, item in enumerate(items):
+            yield (', ' if index else '') + dumps(item)
+        yield ']}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+@bp.route('/media/rescan', methods=['POST'])
+def rescan_media():
+    """
+    Starts a rescan of the media index in the background, see libs.media.rescan. Takes the optional parameter full
+    (true to list all directories, also noticing files modified in place).
+
+    :return: 202 response if a rescan was started, 200 if one is running already
+    """
+    from . import config
+    from libs.media import start_rescan
+    if start_rescan(config, full=param('full').lower() == 'true'):
+        return redirect_or_response(202, 'Rescan started')
+    return redirect_or_response(200, 'Rescan is running already')
 
 
 @bp.route('/ping')
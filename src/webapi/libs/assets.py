@@ -0,0 +1,311 @@
+"""
+Static asset bundles.
+
+On startup, the stylesheets and scripts of the core templates (see get_core_bundles) and the bundles declared by
+plugins are concatenated, minified and written to the asset folder (config asset_path) under a name containing a hash
+of their content, e.g. core.3f2a9c1b0d4e.css, next to precompressed .gz and (if the brotli package is installed) .br
+variants. The route /assets/<file> serves them with Cache-Control immutable, see send_asset.
+
+Templates reference bundles by name through the jinja helpers asset_url and asset_urls:
+
+    {% for url in asset_urls('core.css') %}<link rel="stylesheet" href="{{ url }}">{% endfor %}
+
+A plugin declares bundles by the attribute asset_bundles, a dictionary from bundle name (ending with .css or .js) to
+paths within its static folder, e.g. asset_bundles = {'overlay.js': ['js/socket.js', 'js/overlay.js']}. They are
+referenced as <plugin name>/<bundle name>. Bundles of packaged plugins are not built, their files are referenced
+individually.
+"""
+from os.path import join
+from threading import Lock
+from typing import Dict, List, Optional
+
+from libs.config import Config
+from libs.log import Logger
+
+#: Cache-Control of files named by content hash
+IMMUTABLE = 'public, max-age=31536000, immutable'
+#: Names of built bundles and their compressed variants, only such files are removed from the asset folder
+BUNDLE_FILE_PATTERN = r'.+\.[0-9a-f]{12}\.(css|js)(\.gz|\.br)?'
+
+_bundles: Dict[str, dict] = dict()  # {bundle name: {'file': hashed file name or None, 'endpoint': str, 'sources': []}}
+_bundles_lock = Lock()
+
+
+def get_core_bundles(config: Config) -> Dict[str, List[str]]:
+    """
+    Get the bundles of the core templates.
+
+    :param config: configuration object
+    :return: paths within the static folder by bundle name
+    """
+    bootstrap = f'bootstrap-{config.get("webapi", "bootstrap_version")}-dist'
+    fontawesome = f'fontawesome-free-{config.get("webapi", "fontawesome_version")}-web'
+    return {
+        'core.css': [
+            f'{bootstrap}/css/bootstrap.min.css',
+            f'{bootstrap}/css/bootstrap-grid.min.css',
+            f'{fontawesome}/css/fontawesome.min.css',
+            f'{fontawesome}/css/solid.min.css',
+            'css/base.css'
+        ],
+        'core.js': [
+            f'jquery/jquery-{config.get("webapi", "jquery_version")}.min.js',
+            f'{bootstrap}/js/bootstrap.js',
+            'js/utilities.js'
+        ]
+    }
+
+
+def build_assets(webapi, config: Config, logger: Logger):
+    """
+    Build the core bundles and the bundles of all loaded plugins, then remove outdated bundles (files matching
+    BUNDLE_FILE_PATTERN) from the asset folder. Bundles failing to build (e.g. because a file is missing) are logged and
+    referenced by their single files.
+
+    :param webapi: main application object
+    :param config: configuration object
+    :param logger: logger to use
+    """
+    from os import listdir, remove
+    from re import fullmatch
+    from time import perf_counter
+    from libs.plugins import get_plugins
+    from libs.startup import record_phase
+
+    start = perf_counter()
+    enabled = config.get('webapi', 'asset_bundling').lower() == 'true'
+    for name, sources in get_core_bundles(config).items():
+        _build_bundle(name, sources, webapi.static_folder, webapi.static_url_path, 'static', config, logger, enabled)
+    for plugin in list(get_plugins().values()):
+        build_plugin_bundles(plugin, config, logger)
+    record_phase('asset', perf_counter() - start)
+
+    asset_path = config.get('webapi', 'asset_path')
+    with _bundles_lock:
+        used = {bundle['file'] for bundle in _bundles.values() if bundle['file'] is not None}
+    for file in listdir(asset_path):
+        # Files not named like a bundle are left alone, the asset folder may be shared
+        if not fullmatch(BUNDLE_FILE_PATTERN, file):
+            continue
+        if (file[:-3] if file.endswith(('.gz', '.br')) else file) not in used:
+            try:
+                remove(join(asset_path, file))
+            except OSError:
+                pass
+
+
+def build_plugin_bundles(plugin, config: Config, logger: Logger):
+    """
+    Build the bundles declared by a plugin, see module description.
+
+    :param plugin: the plugin module
+    :param config: configuration object
+    :param logger: logger to use
+    """
+    from os.path import dirname, isfile
+    bundles: Dict[str, List[str]] = getattr(plugin, 'asset_bundles', dict())
+    if not bundles:
+        return
+    static_folder = join(dirname(plugin.__file__), 'static')
+    # Packaged plugins are imported from an archive, their static files are not on disk
+    enabled = config.get('webapi', 'asset_bundling').lower() == 'true' and isfile(plugin.__file__)
+    for name, sources in bundles.items():
+        _build_bundle(f'{plugin.name}/{name}', sources, static_folder, f'/{plugin.name}/static',
+                      f'{plugin.name}.static', config, logger, enabled)
+
+
+def _build_bundle(name: str, sources: List[str], static_folder: str, static_url: str, endpoint: str, config: Config,
+                  logger: Logger, enabled: bool = True):
+    """
+    Build and register a bundle.
+
+    :param name: bundle name, ending with .css or .js
+    :param sources: paths of the files within the static folder
+    :param static_folder: folder containing the files
+    :param static_url: url the static folder is served at, relative urls in stylesheets are rewritten to it
+    :param endpoint: endpoint serving the single files, used if the bundle is not built
+    :param config: configuration object
+    :param logger: logger to use
+    :param enabled: whether to build the bundle or to reference the single files
+    """
+    from libs.startup import record, timed
+    bundle = {'file': None, 'endpoint': endpoint, 'sources': list(sources)}
+    if enabled:
+        try:
+            bundle['file'], build_time = timed(_write_bundle, name, sources, static_folder, static_url,
+                                               config.get('webapi', 'asset_path'))
+            record('asset', name, wall_time=build_time)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Building asset bundle {name} has failed, using the single files: {e}')
+    with _bundles_lock:
+        _bundles[name] = bundle
+
+
+def _write_bundle(name: str, sources: List[str], static_folder: str, static_url: str, asset_path: str) -> str:
+    """
+    Concatenate and minify the files of a bundle and write it with its compressed variants, unless it exists already.
+
+    :param name: bundle name, ending with .css or .js
+    :param sources: paths of the files within the static folder
+    :param static_folder: folder containing the files
+    :param static_url: url the static folder is served at
+    :param asset_path: folder to write the bundle to
+    :raises OSError: if a file cannot be read or the bundle cannot be written
+    :raises ValueError: if the bundle name has an unsupported extension
+    :return: file name of the bundle
+    """
+    from hashlib import sha256
+    from os.path import isfile
+    from libs.basics.file import create_folder, write_atomic
+
+    stem, _, extension = name.replace('/', '.').rpartition('.')
+    if extension not in ('css', 'js'):
+        raise ValueError(f'Unsupported bundle type {extension}')
+    parts = list()
+    for source in sources:
+        with open(join(static_folder, source), 'r', encoding='utf-8') as f:
+            content = f.read()
+        if extension == 'css':
+            parts.append(minify_css(rewrite_css_urls(content, source, static_url), source.endswith('.min.css')))
+        else:
+            parts.append(minify_js(content, source.endswith('.min.js')))
+    data = (';\n' if extension == 'js' else '\n').join(parts).encode('utf-8')
+
+    file = f'{stem}.{sha256(data).hexdigest()[:12]}.{extension}'
+    fp = join(asset_path, file)
+    create_folder(asset_path)
+    if not isfile(fp):
+        write_atomic(fp, data)
+    if not isfile(f'{fp}.gz'):
+        from gzip import compress
+        write_atomic(f'{fp}.gz', compress(data, 9, mtime=0))
+    if not isfile(f'{fp}.br'):
+        try:
+            import brotli
+            write_atomic(f'{fp}.br', brotli.compress(data))
+        except ImportError:
+            pass
+    return file
+
+
+def rewrite_css_urls(content: str, source: str, static_url: str) -> str:
+    """
+    Rewrite relative urls (e.g. url(../webfonts/fa-solid-900.woff2)) of a stylesheet to absolute ones, so they stay
+    valid within a bundle.
+
+    :param content: the stylesheet
+    :param source: path of the stylesheet within the static folder
+    :param static_url: url the static folder is served at
+    :return: the rewritten stylesheet
+    """
+    from re import sub
+    from posixpath import normpath, join as join_url, dirname
+
+    def rewrite(match) -> str:
+        quote, url = match.group(1), match.group(2).strip()
+        if url.startswith(('/', '#', 'data:')) or '://' in url:
+            return match.group(0)
+        path, separator, suffix = url.partition('?') if '?' in url else url.partition('#')
+        path = normpath(join_url(dirname(source), path))
+        return f'url({quote}{static_url.rstrip("/")}/{path}{separator}{suffix}{quote})'
+
+    return sub(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)', rewrite, content)
+
+
+def minify_css(content: str, minified: bool = False) -> str:
+    """
+    Remove comments (except of /*! license comments) and unneeded whitespace from a stylesheet. Quoted strings and
+    url(...) values are kept as they are.
+
+    :param content: the stylesheet
+    :param minified: whether the stylesheet is minified already, only source map references are removed then
+    :return: the minified stylesheet
+    """
+    from re import sub, split, DOTALL
+    content = sub(r'/\*# sourceMappingURL=[^*]*\*/', '', content)
+    if minified:
+        return content.strip()
+    string = r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\''
+    # Splitting by a capturing pattern alternates between text (even indices) and tokens (odd indices)
+    parts = split(rf'(/\*.*?\*/|{string}|url\(\s*(?:{string}|[^)]*)\s*\))', content, flags=DOTALL)
+    result = list()
+    for index, part in enumerate(parts):
+        if index % 2 == 0:
+            part = sub(r'\s+', ' ', part)
+            result.append(sub(r'\s*([{};,])\s*', r'\1', part))
+        elif not part.startswith('/*') or part.startswith('/*!'):
+            result.append(part)
+    return ''.join(result).strip()
+
+
+def minify_js(content: str, minified: bool = False) -> str:
+    """
+    Remove indentation and empty lines from a script. Scripts containing template literals are only stripped of source
+    map references, as their whitespace may be significant.
+
+    :param content: the script
+    :param minified: whether the script is minified already, only source map references are removed then
+    :return: the minified script
+    """
+    lines = [line for line in content.split('\n') if not line.strip().startswith('//# sourceMappingURL=')]
+    if minified or '`' in content:
+        return '\n'.join(lines).strip()
+    return '\n'.join(line.strip() for line in lines if line.strip())
+
+
+def asset_url(name: str) -> Optional[str]:
+    """
+    Get the url of a built bundle, jinja helper.
+
+    :param name: bundle name, e.g. core.css or <plugin>/<bundle>
+    :return: the url or None if the bundle is not built
+    """
+    from flask import url_for
+    with _bundles_lock:
+        bundle = _bundles.get(name)
+    if bundle is None or bundle['file'] is None:
+        return None
+    return url_for('send_asset', filename=bundle['file'])
+
+
+def asset_urls(name: str) -> List[str]:
+    """
+    Get the urls to include a bundle, jinja helper. That is the url of the built bundle or, if it is not built, the urls
+    of its single files.
+
+    :param name: bundle name, e.g. core.css or <plugin>/<bundle>
+    :return: list of urls, empty if the bundle is unknown
+    """
+    from flask import url_for
+    url = asset_url(name)
+    if url is not None:
+        return [url]
+    with _bundles_lock:
+        bundle = _bundles.get(name)
+    if bundle is None:
+        return list()
+    return [url_for(bundle['endpoint'], filename=source) for source in bundle['sources']]
+
+
+def send_asset(asset_path: str, filename: str):
+    """
+    Send a built bundle, preferring the brotli or gzip variant if accepted by the client.
+
+    :param asset_path: the asset folder
+    :param filename: file name of the bundle
+    :return: the response
+    """
+    from os.path import isfile
+    from mimetypes import guess_type
+    from flask import request
+    from libs.basics.api.files import send_file_cached
+    mimetype = guess_type(filename)[0]
+    for encoding, extension in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[encoding] and isfile(join(asset_path, f'{filename}{extension}')):
+            response = send_file_cached(asset_path, f'{filename}{extension}', IMMUTABLE, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_file_cached(asset_path, filename, IMMUTABLE, mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,249 @@
+"""
+Library for sending files with validators, conditional and range requests.
+"""
+from collections import OrderedDict
+from os import stat_result
+from threading import Lock
+from typing import Iterator, List, Optional, Tuple
+
+from flask import Response, request
+
+#: Seconds the stat result of a file is reused
+STAT_TTL = 1.0
+#: Maximum number of cached stat results
+STAT_CACHE_SIZE = 4096
+#: Requests with more ranges are answered with the whole file
+MAX_RANGES = 16
+#: Size of the chunks files are sent in
+CHUNK_SIZE = 65536
+
+_stat_cache: OrderedDict = OrderedDict()  # {path: (expiry time, stat result or None)}
+_stat_lock = Lock()
+
+CachePolicies = List[Tuple[str, str]]  # [(file name pattern, Cache-Control value)]
+
+
+def cached_stat(path: str, ttl: float = STAT_TTL) -> Optional[stat_result]:
+    """
+    Stat a file, reusing the result for ttl seconds.
+
+    :param path: path to the file
+    :param ttl: seconds to reuse the result
+    :return: the stat result or None if the path does not exist or is no file
+    """
+    from os import stat
+    from stat import S_ISREG
+    from time import monotonic
+    with _stat_lock:
+        expiry, result = _stat_cache.get(path, (0.0, None))
+    if monotonic() < expiry:
+        return result
+    try:
+        result = stat(path)
+        if not S_ISREG(result.st_mode):
+            result = None
+    except OSError:
+        result = None
+    with _stat_lock:
+        _stat_cache[path] = (monotonic() + ttl, result)
+        _stat_cache.move_to_end(path)
+        while len(_stat_cache) > STAT_CACHE_SIZE:
+            _stat_cache.popitem(last=False)
+    return result
+
+
+def parse_cache_policies(value: str) -> CachePolicies:
+    """
+    Parse Cache-Control policies of the form pattern=value;pattern=value, e.g.
+    '*.mp4=public, max-age=86400; *=no-cache'. Patterns are matched by fnmatch against the relative path of the file,
+    the first matching rule applies.
+
+    :param value: the policies, a rule consisting of a value without = (e.g. no-cache) applies to all files
+    :return: list of (pattern, Cache-Control value) in order of precedence
+    """
+    policies = list()
+    for rule in value.split(';'):
+        pattern, separator, cache_control = rule.partition('=')
+        if not separator:
+            pattern, cache_control = '*', rule
+        if cache_control.strip():
+            policies.append((pattern.strip(), cache_control.strip()))
+    return policies
+
+
+def get_cache_control(policies: CachePolicies, filename: str) -> Optional[str]:
+    """
+    Get the Cache-Control value for a file, see parse_cache_policies.
+
+    :param policies: the policies
+    :param filename: relative path of the file
+    :return: the value of the first matching rule or None
+    """
+    from fnmatch import fnmatch
+    for pattern, cache_control in policies:
+        if fnmatch(filename, pattern):
+            return cache_control
+    return None
+
+
+def send_file_cached(directory: str, filename: str, cache_control: str = None, sendfile: str = '',
+                     sendfile_prefix: str = '', mimetype: str = None) -> Response:
+    """
+    Send a file from a directory, answering conditional and range requests.
+
+    The response carries a strong ETag (from inode, size and modification time) and Last-Modified, taken from a cached
+    stat result (see cached_stat). Requests with matching If-None-Match or If-Modified-Since get 304. Range requests
+    get 206 with the requested range, multiple ranges as multipart/byteranges, or 416 if no range is satisfiable.
+
+    If sendfile is set, the file is not sent by the application but by a fronting web server: x-sendfile sets the
+    X-Sendfile header to the absolute path (e.g. Apache, lighttpd), x-accel-redirect sets X-Accel-Redirect to
+    sendfile_prefix/filename (nginx, which needs an internal location for the prefix). The web server handles ranges
+    then.
+
+    :param directory: directory containing the file
+    :param filename: path relative to the directory
+    :param cache_control: optional Cache-Control value
+    :param sendfile: empty, x-sendfile or x-accel-redirect
+    :param sendfile_prefix: internal location of the directory for x-accel-redirect
+    :param mimetype: mimetype of the file, guessed from the file name if not given
+    :raises werkzeug.exceptions.NotFound: if the file does not exist or the path leaves the directory
+    :return: the response
+    """
+    from datetime import datetime
+    from mimetypes import guess_type
+    from os.path import abspath
+    from flask.helpers import safe_join
+    from werkzeug.exceptions import NotFound
+    from werkzeug.http import is_resource_modified
+
+    path = safe_join(directory, filename)
+    st = cached_stat(path)
+    if st is None:
+        raise NotFound()
+
+    etag = f'{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}'
+    last_modified = datetime.utcfromtimestamp(int(st.st_mtime))
+    mimetype = mimetype or guess_type(filename)[0] or 'application/octet-stream'
+
+    def with_validators(response: Response) -> Response:
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        if cache_control:
+            response.headers['Cache-Control'] = cache_control
+        return response
+
+    if not is_resource_modified(request.environ, etag, last_modified=last_modified):
+        return with_validators(Response(status=304))
+
+    if sendfile == 'x-sendfile':
+        response = Response(mimetype=mimetype, headers={'X-Sendfile': abspath(path)})
+        return with_validators(response)
+    if sendfile == 'x-accel-redirect':
+        location = f'{sendfile_prefix.rstrip("/")}/{filename.lstrip("/")}'
+        response = Response(mimetype=mimetype, headers={'X-Accel-Redirect': location})
+        return with_validators(response)
+
+    size = st.st_size
+    ranges = _requested_ranges(size, etag, last_modified)
+    if ranges is None:
+        body = _read_ranges(path, [(0, size)])
+        if request.method != 'HEAD':
+            # Lets the WSGI server send the file efficiently, e.g. by os.sendfile
+            from werkzeug.wsgi import wrap_file
+            body = wrap_file(request.environ, open(path, 'rb'), CHUNK_SIZE)
+        response = Response(body, mimetype=mimetype, direct_passthrough=True)
+        response.content_length = size
+        response.accept_ranges = 'bytes'
+        return with_validators(response)
+    if not ranges:
+        response = Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+        return with_validators(response)
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response = Response(_read_ranges(path, ranges), status=206, mimetype=mimetype, direct_passthrough=True)
+        response.content_length = stop - start
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        response.accept_ranges = 'bytes'
+        return with_validators(response)
+
+    from uuid import uuid4
+    boundary = uuid4().hex
+    parts = [
+        (f'\r\n--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n'
+         .encode('latin-1'), start, stop) for start, stop in ranges
+    ]
+    end = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+    response = Response(_read_parts(path, parts, end), status=206, direct_passthrough=True,
+                        mimetype=f'multipart/byteranges; boundary={boundary}')
+    response.content_length = sum(len(header) + stop - start for header, start, stop in parts) + len(end)
+    response.accept_ranges = 'bytes'
+    return with_validators(response)
+
+
+def _requested_ranges(size: int, etag: str, last_modified) -> Optional[List[Tuple[int, int]]]:
+    """
+    Get the satisfiable byte ranges of the current request. The Range header is ignored if an If-Range header does not
+    match or if it contains more than MAX_RANGES ranges.
+
+    :param size: size of the file
+    :param etag: ETag of the file
+    :param last_modified: modification time of the file
+    :return: list of (start, stop) with exclusive stop, empty if no range is satisfiable, None to send the whole file
+    """
+    from werkzeug.http import parse_range_header, parse_if_range_header
+    requested = parse_range_header(request.headers.get('Range'))
+    if requested is None or requested.units != 'bytes' or len(requested.ranges) > MAX_RANGES:
+        return None
+    if 'If-Range' in request.headers:
+        if_range = parse_if_range_header(request.headers.get('If-Range'))
+        if if_range.etag is not None and if_range.etag != etag:
+            return None
+        if if_range.date is not None and last_modified > if_range.date:
+            return None
+        if if_range.etag is None and if_range.date is None:
+            return None
+
+    ranges = list()
+    for start, stop in requested.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def _read_ranges(path: str, ranges: List[Tuple[int, int]]) -> Iterator[bytes]:
+    """
+    Read byte ranges of a file in chunks.
+
+    :param path: path to the file
+    :param ranges: list of (start, stop) with exclusive stop
+    :return: generator of chunks
+    """
+    with open(path, 'rb') as f:
+        for start, stop in ranges:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+
+def _read_parts(path: str, parts: List[Tuple[bytes, int, int]], end: bytes) -> Iterator[bytes]:
+    """
+    Read byte ranges of a file as multipart/byteranges body.
+
+    :param path: path to the file
+    :param parts: list of (part header, start, stop)
+    :param end: closing boundary
+    :return: generator of chunks
+    """
+    for header, start, stop in parts:
+        yield header
+        yield from _read_ranges(path, [(start, stop)])
+    yield end
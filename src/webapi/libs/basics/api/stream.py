@@ -0,0 +1,54 @@
+"""
+Library for streaming responses.
+"""
+from typing import Iterable, Optional, Tuple
+
+from flask import Response, stream_with_context
+
+Event = Tuple[Optional[str], object, Optional[str]]  # (event name or None, data, event id or None)
+
+
+def format_event(data, event: str = None, event_id: str = None) -> str:
+    """
+    Format a Server-Sent Event. Data which is not a string is sent as json.
+
+    :param data: data of the event
+    :param event: optional event name, clients receive unnamed events as message
+    :param event_id: optional event id, browsers send the last one as Last-Event-ID header when reconnecting
+    :return: the event as text
+    """
+    if not isinstance(data, str):
+        from json import dumps
+        data = dumps(data)
+    lines = list()
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if event is not None:
+        lines.append(f'event: {event}')
+    lines += [f'data: {line}' for line in data.split('\n')]
+    return '\n'.join(lines) + '\n\n'
+
+
+def event_stream(events: Iterable[Event], retry: int = None) -> Response:
+    """
+    Create a Server-Sent Events response. The events are generated lazily within the request context while the response
+    is sent. Yield (None, None, None) to send a comment line, which keeps the connection of idle streams alive.
+
+    :param events: iterable of (event name, data, event id), see format_event
+    :param retry: optional reconnection delay in milliseconds for the client
+    :return: the streaming flask response
+    """
+    def generate():
+        if retry is not None:
+            yield f'retry: {retry}\n\n'
+        for event, data, event_id in events:
+            if event is None and data is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield format_event(data, event, event_id)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Disable response buffering of nginx
+        'X-Accel-Buffering': 'no'
+    })
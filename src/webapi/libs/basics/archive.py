@@ -0,0 +1,255 @@
+"""
+Library for extracting and reading archives.
+"""
+from typing import Dict, Callable, Optional
+from zipfile import ZipFile
+
+#: Name of the file storing the hashes of all extracted files, located in the root of the extracted tree
+MANIFEST_NAME = '.manifest.json'
+
+#: File extensions of zip archives containing python packages
+ARCHIVE_EXTENSIONS = ('.zip', '.pyz')
+
+Manifest = Dict[str, dict]  # {relative path: {'size': int, 'crc': int, 'sha256': str}}
+
+
+def split_archive_name(filename: str) -> Optional[str]:
+    """
+    Get the name of an archive without its extension, see ARCHIVE_EXTENSIONS.
+
+    :param filename: file name of the archive
+    :return: the name without extension or None if the file is no archive
+    """
+    for extension in ARCHIVE_EXTENSIONS:
+        if filename.lower().endswith(extension):
+            return filename[:-len(extension)]
+    return None
+
+
+def safe_join(root: str, name: str) -> str:
+    """
+    Join a relative path from an untrusted source (e.g. a zip entry) to a root folder, refusing paths which would end up
+    outside of it (zip-slip).
+
+    :param root: folder the path has to stay in
+    :param name: relative path, using / as separator
+    :raises ValueError: if the path is absolute or leaves the root folder
+    :return: the joined path
+    """
+    from os.path import join, normpath, isabs, commonpath, abspath
+    parts = name.replace('\\', '/').split('/')
+    if isabs(name) or name.startswith('/') or '..' in parts or (parts and ':' in parts[0]):
+        raise ValueError(f'Refusing unsafe path {name}')
+    path = normpath(join(root, *parts))
+    if commonpath([abspath(root), abspath(path)]) != abspath(root):
+        raise ValueError(f'Refusing unsafe path {name}')
+    return path
+
+
+def read_manifest(folder: str) -> Manifest:
+    """
+    Read the manifest of an extracted tree. Trees without a manifest get one computed from their content.
+
+    :param folder: root of the extracted tree
+    :return: the manifest, empty if the folder does not exist
+    """
+    from os.path import join, isfile, isdir
+    from json import load
+    fp = join(folder, MANIFEST_NAME)
+    if isfile(fp):
+        try:
+            with open(fp, 'r') as f:
+                return load(f)
+        except (OSError, ValueError):
+            pass
+    return compute_manifest(folder) if isdir(folder) else dict()
+
+
+def compute_manifest(folder: str) -> Manifest:
+    """
+    Hash all files of a tree, skipping __pycache__ folders and the manifest itself.
+
+    :param folder: root of the tree
+    :return: the manifest
+    """
+    from os import walk
+    from os.path import join, relpath
+    manifest = dict()
+    for root, dirs, files in walk(folder):
+        dirs[:] = [d for d in dirs if d != '__pycache__']
+        for file in files:
+            fp = join(root, file)
+            name = relpath(fp, folder).replace('\\', '/')
+            if name == MANIFEST_NAME:
+                continue
+            with open(fp, 'rb') as f:
+                manifest[name] = _hash_stream(f)
+    return manifest
+
+
+def _hash_stream(stream, out=None) -> dict:
+    """
+    Hash a stream in chunks, optionally copying it.
+
+    :param stream: binary stream to read
+    :param out: optional binary stream to copy the data to
+    :return: dictionary containing size, crc and sha256
+    """
+    from hashlib import sha256
+    from zlib import crc32
+    digest = sha256()
+    crc = 0
+    size = 0
+    for chunk in iter(lambda: stream.read(65536), b''):
+        digest.update(chunk)
+        crc = crc32(chunk, crc)
+        size += len(chunk)
+        if out is not None:
+            out.write(chunk)
+    return {'size': size, 'crc': crc, 'sha256': digest.hexdigest()}
+
+
+def extract_incremental(zip_file: ZipFile, target: str, rename: Callable[[str], Optional[str]] = None) -> dict:
+    """
+    Extract a zip file over an existing tree, only writing files which have changed.
+
+    The new tree is built in a staging folder next to the target: files whose size and CRC match the manifest of the
+    current tree are hard linked (copied if linking is not possible) without decompressing them, all other entries are
+    streamed from the archive. Files missing in the archive are not carried over. Afterwards the staging folder replaces
+    the target by two renames, so the target is never missing or partially written for more than that moment.
+
+    :param zip_file: opened zip file
+    :param target: folder to extract to
+    :param rename: optional function mapping entry names to paths relative to target, entries it returns None for are
+        skipped. Defaults to the entry name.
+    :raises ValueError: if an entry would be extracted outside of the target (zip-slip)
+    :return: dictionary containing the lists of changed, removed and unchanged relative paths
+    """
+    from os import link, makedirs, rename as rename_path
+    from os.path import join, dirname, exists, basename
+    from shutil import copy2, rmtree
+    from tempfile import mkdtemp
+    from json import dump
+
+    old_manifest = read_manifest(target)
+    makedirs(dirname(target) or '.', exist_ok=True)
+    staging = mkdtemp(prefix=f'.{basename(target)}.staging-', dir=dirname(target) or '.')
+    manifest: Manifest = dict()
+    changed, unchanged = list(), list()
+    try:
+        for info in zip_file.infolist():
+            if info.is_dir():
+                continue
+            name = rename(info.filename) if rename is not None else info.filename
+            if not name or name == MANIFEST_NAME:
+                continue
+            destination = safe_join(staging, name)
+            source = safe_join(target, name)
+            name = name.replace('\\', '/')
+            makedirs(dirname(destination), exist_ok=True)
+
+            old = old_manifest.get(name)
+            if old is not None and old['size'] == info.file_size and old['crc'] == info.CRC and exists(source):
+                try:
+                    link(source, destination)
+                except OSError:
+                    copy2(source, destination)
+                manifest[name] = old
+                unchanged.append(name)
+                continue
+
+            with zip_file.open(info) as stream, open(destination, 'wb') as out:
+                manifest[name] = _hash_stream(stream, out)
+            changed.append(name)
+
+        with open(join(staging, MANIFEST_NAME), 'w') as f:
+            dump(manifest, f, indent=1, sort_keys=True)
+
+        # Swap the trees
+        if exists(target):
+            old_tree = f'{staging}.old'
+            rename_path(target, old_tree)
+            rename_path(staging, target)
+            rmtree(old_tree, ignore_errors=True)
+        else:
+            rename_path(staging, target)
+    except BaseException:
+        rmtree(staging, ignore_errors=True)
+        raise
+
+    return {
+        'changed': changed,
+        'removed': sorted(name for name in old_manifest if name not in manifest),
+        'unchanged': unchanged
+    }
+
+
+class ArchiveIndex:
+    """
+    Read access to the files of a zip archive by an in-memory index of its central directory, without extracting it.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, path: str):
+        """
+        Open an archive and index its entries.
+
+        :param path: path to the zip archive
+        :raises zipfile.BadZipFile: if the file is no zip archive
+        """
+        from os import stat
+        from threading import Lock
+        self.path = path
+        self._lock = Lock()
+        self._zip_file = ZipFile(path, 'r')
+        self.mtime = stat(path).st_mtime
+        self.entries = {info.filename: info for info in self._zip_file.infolist() if not info.is_dir()}
+
+    def exists(self, name: str) -> bool:
+        """
+        Check if a file exists within the archive.
+
+        :param name: path within the archive, using / as separator
+        :return: whether the file exists
+        """
+        return name in self.entries
+
+    def list(self, prefix: str = '') -> list:
+        """
+        List all files below a folder within the archive.
+
+        :param prefix: folder within the archive, using / as separator and ending with /
+        :return: sorted paths relative to the folder
+        """
+        return sorted(name[len(prefix):] for name in self.entries if name.startswith(prefix))
+
+    def read(self, name: str) -> bytes:
+        """
+        Read a file from the archive.
+
+        :param name: path within the archive, using / as separator
+        :raises KeyError: if the file does not exist
+        :return: file content
+        """
+        info = self.entries[name]
+        with self._lock:
+            return self._zip_file.read(info)
+
+    def is_outdated(self) -> bool:
+        """
+        Check if the archive was replaced or modified on disk since it was indexed.
+
+        :return: whether the index is outdated
+        """
+        from os import stat
+        try:
+            return stat(self.path).st_mtime != self.mtime
+        except OSError:
+            return True
+
+    def close(self):
+        """
+        Close the archive.
+        """
+        with self._lock:
+            self._zip_file.close()
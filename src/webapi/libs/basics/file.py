@@ -47,3 +47,47 @@ def create_underlying_folder(filepath: str):
     from os.path import dirname, isdir
     if not isdir(dirname(filepath)):
         create_folder(dirname(filepath))
+
+
+def write_atomic(filepath: str, data, encoding: str = 'utf-8'):
+    """
+    Write a file atomically. The data is written to a temporary file next to the target, synced to disk and renamed
+    over the target afterwards, so readers (and a crashed process) either see the old or the new content, never a
+    truncated file. Permissions of an existing target are preserved.
+
+    :param filepath: path of the file to write
+    :param data: text or bytes to write
+    :param encoding: encoding used if data is a string, defaults to utf-8
+    :raises OSError: if writing or renaming fails
+    """
+    from os import fsync, replace, remove, open as os_open, close, O_RDONLY
+    from os.path import dirname, basename, isfile, abspath
+    from shutil import copymode
+    from tempfile import mkstemp
+
+    folder = dirname(abspath(filepath))
+    fd, tmp_fp = mkstemp(dir=folder, prefix=f'.{basename(filepath)}.', suffix='.tmp')
+    try:
+        with open(fd, 'wb') as f:
+            f.write(data.encode(encoding) if isinstance(data, str) else data)
+            f.flush()
+            fsync(f.fileno())
+        if isfile(filepath):
+            copymode(filepath, tmp_fp)
+        replace(tmp_fp, filepath)
+    except BaseException:
+        if isfile(tmp_fp):
+            remove(tmp_fp)
+        raise
+
+    # Persist the rename itself, not supported on every platform
+    try:
+        dir_fd = os_open(folder, O_RDONLY)
+    except OSError:
+        return
+    try:
+        fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        close(dir_fd)
@@ -0,0 +1,131 @@
+"""
+Library for dependency graphs.
+"""
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+Dependencies = Dict[str, Set[str]]  # {node: nodes it depends on}
+
+
+def build_dependency_graph(nodes: Dict[str, Tuple[Iterable[str], Iterable[str]]]) \
+        -> Tuple[Dependencies, Dict[str, List[str]]]:
+    """
+    Build a dependency graph from declared dependencies. Every node declares the names it depends on and the names it
+    provides in addition to its own name. A dependency on a name is a dependency on every node with or providing that
+    name.
+
+    :param nodes: (depends on, provides) by node name
+    :return: dependencies by node name and the unresolvable dependency names by node name
+    """
+    providers: Dict[str, Set[str]] = dict()
+    for node, (_, provides) in nodes.items():
+        providers.setdefault(node, set()).add(node)
+        for name in provides:
+            providers.setdefault(name, set()).add(node)
+
+    dependencies: Dependencies = dict()
+    unknown: Dict[str, List[str]] = dict()
+    for node, (depends_on, _) in nodes.items():
+        dependencies[node] = set()
+        for name in depends_on:
+            if name in providers:
+                dependencies[node] |= providers[name] - {node}
+            else:
+                unknown.setdefault(node, list()).append(name)
+    return dependencies, unknown
+
+
+def find_cycle(dependencies: Dependencies) -> Optional[List[str]]:
+    """
+    Find a dependency cycle.
+
+    :param dependencies: dependencies by node name
+    :return: the nodes of a cycle, the first node repeated at the end, or None if there is no cycle
+    """
+    visited: Set[str] = set()
+    for start in sorted(dependencies):
+        if start in visited:
+            continue
+        path: List[str] = list()
+        on_path: Set[str] = set()
+        stack = [(start, iter(sorted(dependencies.get(start, set()))))]
+        path.append(start)
+        on_path.add(start)
+        while stack:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                path.pop()
+                on_path.discard(node)
+                visited.add(node)
+            elif child in on_path:
+                return path[path.index(child):] + [child]
+            elif child not in visited:
+                stack.append((child, iter(sorted(dependencies.get(child, set())))))
+                path.append(child)
+                on_path.add(child)
+    return None
+
+
+def run_in_dependency_order(tasks: Dict[str, Callable[[], None]], dependencies: Dependencies,
+                            max_workers: int = 4) -> Dict[str, dict]:
+    """
+    Run tasks in a thread pool, every task once all tasks it depends on have finished. Independent tasks run
+    concurrently. Dependencies on nodes without a task are ignored.
+
+    Tasks depending on a failed task are skipped, as are tasks within (or depending on) a dependency cycle.
+
+    :param tasks: functions by node name
+    :param dependencies: dependencies by node name
+    :param max_workers: maximum number of concurrently running tasks
+    :return: result by node name, containing the status (ok, failed or skipped), the time in seconds and an error
+        message if not ok
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    from time import perf_counter
+
+    def run(node: str) -> float:
+        start = perf_counter()
+        tasks[node]()
+        return perf_counter() - start
+
+    waiting_for = {node: set(dependencies.get(node, set())) & set(tasks) for node in tasks}
+    dependents: Dependencies = {node: set() for node in tasks}
+    for node, required in waiting_for.items():
+        for dependency in required:
+            dependents[dependency].add(node)
+
+    results: Dict[str, dict] = dict()
+
+    def skip(node: str, reason: str):
+        if node in results:
+            return
+        results[node] = {'status': 'skipped', 'time': 0.0, 'error': reason}
+        for dependent in sorted(dependents[node]):
+            skip(dependent, f'dependency {node} was not run')
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='dependency-runner') as pool:
+        running = {pool.submit(run, node): node for node in sorted(tasks) if not waiting_for[node]}
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda f: running[f]):
+                node = running.pop(future)
+                try:
+                    results[node] = {'status': 'ok', 'time': future.result()}
+                except Exception as e:
+                    results[node] = {'status': 'failed', 'time': 0.0, 'error': str(e)}
+                    for dependent in sorted(dependents[node]):
+                        skip(dependent, f'dependency {node} has failed')
+                    continue
+                for dependent in sorted(dependents[node]):
+                    waiting_for[dependent].discard(node)
+                    if not waiting_for[dependent] and dependent not in results:
+                        running[pool.submit(run, dependent)] = dependent
+
+    # Everything left over is part of or depends on a cycle
+    left_over = {node: waiting_for[node] for node in tasks if node not in results}
+    cycle = find_cycle(left_over)
+    reason = f'dependency cycle {" -> ".join(cycle)}' if cycle else 'dependency cycle'
+    for node in left_over:
+        results[node] = {'status': 'skipped', 'time': 0.0, 'error': reason}
+    return results
@@ -1,31 +1,98 @@
 """
 Library for network operations.
 """
+from threading import Lock
+from typing import Dict, Iterable, Tuple
 
+#: Seconds to wait for a connection
+DEFAULT_TIMEOUT = 1.0
+#: Seconds results are cached
+DEFAULT_TTL = 30.0
+#: Port probed if the host does not name one, DNS servers (e.g. 1.1.1.1) accept TCP connections on port 53
+DEFAULT_PORT = 53
 
-def is_up(host) -> bool:
+_cache: Dict[Tuple[str, int], Tuple[float, bool]] = dict()  # {(host, port): (expiry time, result)}
+_cache_lock = Lock()
+
+
+def _split_host(host: str) -> Tuple[str, int]:
+    """
+    Split a host of the form hostname or hostname:port.
+
+    :param host: host, IPv6 addresses with a port need to be enclosed in brackets
+    :return: hostname and port, DEFAULT_PORT if none is given
+    """
+    if host.startswith('['):
+        hostname, _, port = host[1:].partition(']')
+        return hostname, int(port[1:]) if port.startswith(':') else DEFAULT_PORT
+    if host.count(':') == 1:
+        hostname, port = host.split(':')
+        return hostname, int(port)
+    return host, DEFAULT_PORT
+
+
+def is_up(host, timeout: float = DEFAULT_TIMEOUT, ttl: float = DEFAULT_TTL) -> bool:
     """
-    Check if a host is up and running.
+    Check if a host is up and running by opening a TCP connection. Results are cached for ttl seconds.
 
-    :param host: hostname
+    :param host: hostname or hostname:port, see DEFAULT_PORT
+    :param timeout: seconds to wait for the connection
+    :param ttl: seconds to cache the result, 0 to disable the cache
     :return: whether the host is reachable
     """
-    from os import system
-    return True if system("ping -c 1 " + host + ' > /dev/null 2>&1') == 0 else False
+    from socket import create_connection
+    from time import monotonic
 
+    key = _split_host(host)
+    with _cache_lock:
+        expiry, result = _cache.get(key, (0.0, False))
+    if monotonic() < expiry:
+        return result
 
-def check_internet(hosts=None) -> bool:
+    try:
+        with create_connection(key, timeout=timeout):
+            result = True
+    except OSError:
+        result = False
+    if ttl > 0:
+        with _cache_lock:
+            _cache[key] = (monotonic() + ttl, result)
+    return result
+
+
+def check_internet(hosts: Iterable[str] = None, timeout: float = DEFAULT_TIMEOUT, ttl: float = DEFAULT_TTL) -> bool:
     """
-    Check all given hosts if they are up. Assumes internet connection if any one succeeds.
+    Check all given hosts concurrently if they are up, see is_up. Assumes internet connection if any one succeeds and
+    returns as soon as the first one does, so it takes at most timeout seconds.
 
     Do not include local addresses!
 
-    :param hosts: hostnames to ping to. Defaults to 1.1.1.1 and 8.8.8.8
+    :param hosts: hostnames (optionally with port) to connect to. Defaults to 1.1.1.1 and 8.8.8.8
+    :param timeout: seconds to wait for each connection
+    :param ttl: seconds to cache the results, 0 to disable the cache
     :return: whether any host is reachable
     """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
     if hosts is None:
         hosts = ["1.1.1.1", "8.8.8.8"]
-    for host in hosts:
-        if is_up(host):
-            return True
-    return False
+    hosts = list(hosts)
+    if not hosts:
+        return False
+
+    pool = ThreadPoolExecutor(max_workers=len(hosts), thread_name_prefix='network-probe')
+    try:
+        for future in as_completed([pool.submit(is_up, host, timeout, ttl) for host in hosts]):
+            if future.result():
+                return True
+        return False
+    finally:
+        # Do not wait for the remaining probes, they finish within their timeout
+        pool.shutdown(wait=False)
+
+
+def clear_cache():
+    """
+    Forget all cached results of is_up and check_internet.
+    """
+    with _cache_lock:
+        _cache.clear()
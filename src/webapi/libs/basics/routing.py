@@ -0,0 +1,185 @@
+"""
+Library for changing the url routing of a running flask application.
+"""
+from threading import Lock
+from typing import Callable, Dict, Optional
+
+from flask import Flask, Blueprint
+from werkzeug.routing import Map, Rule
+
+_routing_lock = Lock()
+
+
+def clone_url_map(url_map: Map, exclude: Callable[[Rule], bool] = None) -> Map:
+    """
+    Create a new url map with the same settings and unbound copies of all rules.
+
+    :param url_map: map to copy
+    :param exclude: optional predicate, rules it returns true for are not copied
+    :return: new map
+    """
+    new_map = url_map.__class__(
+        default_subdomain=url_map.default_subdomain,
+        charset=url_map.charset,
+        strict_slashes=url_map.strict_slashes,
+        merge_slashes=url_map.merge_slashes,
+        redirect_defaults=url_map.redirect_defaults,
+        sort_parameters=url_map.sort_parameters,
+        sort_key=url_map.sort_key,
+        encoding_errors=url_map.encoding_errors,
+        host_matching=url_map.host_matching
+    )
+    new_map.converters = url_map.converters.copy()
+    for rule in url_map.iter_rules():
+        if exclude is None or not exclude(rule):
+            new_map.add(rule.empty())
+    return new_map
+
+
+#: Per blueprint hook registries of flask, {blueprint name or None: [functions]}
+_HOOKS = ('before_request_funcs', 'after_request_funcs', 'teardown_request_funcs', 'url_value_preprocessors',
+          'url_default_functions', 'template_context_processors')
+
+_app_hooks: Dict[str, dict] = dict()  # {blueprint name: application wide hooks added by the blueprint}
+
+
+def register_blueprint_live(webapi: Flask, blueprint: Blueprint, **options):
+    """
+    Register a blueprint on an application that may already be serving requests, see swap_blueprint_live.
+
+    :param webapi: the applications flask object
+    :param blueprint: blueprint to register
+    :param options: options passed to Flask.register_blueprint
+    """
+    swap_blueprint_live(webapi, None, blueprint, **options)
+
+
+def unregister_blueprint_live(webapi: Flask, name: str):
+    """
+    Remove a blueprint from an application that may already be serving requests, see swap_blueprint_live.
+
+    :param webapi: the applications flask object
+    :param name: name of the blueprint to remove
+    """
+    swap_blueprint_live(webapi, name, None)
+
+
+def swap_blueprint_live(webapi: Flask, remove: Optional[str], add: Optional[Blueprint], **options):
+    """
+    Remove and/or register a blueprint on an application that may already be serving requests.
+
+    All changes are made to a copy of the url map which then replaces the current one. Requests bound to the old map
+    are not affected and finish with the old view functions, requests bound to the copy wait until all changes are
+    done, so no request ever sees a partially (un)registered blueprint. Removing and adding a blueprint of the same
+    name in one call replaces it without any request running into a 404.
+
+    Removing a blueprint drops its routes, view functions, request hooks, error handlers and the application wide
+    hooks it registered (e.g. by app_errorhandler or before_app_request).
+
+    :param webapi: the applications flask object
+    :param remove: name of the blueprint to remove or None
+    :param add: blueprint to register or None
+    :param options: options passed to Flask.register_blueprint
+    """
+    def excluded(rule: Rule) -> bool:
+        return remove is not None and rule.endpoint.startswith(f'{remove}.')
+
+    with _routing_lock:
+        url_map = clone_url_map(webapi.url_map, exclude=excluded)
+        # noinspection PyProtectedMember
+        with url_map._remap_lock, webapi._before_request_lock:
+            webapi.url_map = url_map
+            if remove is not None:
+                _remove_blueprint_state(webapi, remove)
+            if add is None:
+                return
+
+            # Flask refuses setup methods after the first request in debug mode, the locks above make this safe
+            got_first_request = webapi._got_first_request
+            webapi._got_first_request = False
+            before = _snapshot_app_hooks(webapi)
+            try:
+                webapi.register_blueprint(add, **options)
+            finally:
+                webapi._got_first_request = got_first_request
+                _app_hooks[add.name] = _diff_app_hooks(before, _snapshot_app_hooks(webapi))
+
+        # Templates of a replaced blueprint may be cached under the same name
+        webapi.jinja_env.cache.clear()
+
+
+def _remove_blueprint_state(webapi: Flask, name: str):
+    """
+    Remove everything flask stores about a blueprint except of its url rules. Containers are replaced instead of
+    modified, so concurrent requests iterating them are not affected.
+
+    :param webapi: the applications flask object
+    :param name: name of the blueprint
+    """
+    webapi.blueprints.pop(name, None)
+    # noinspection PyProtectedMember
+    webapi._blueprint_order = [blueprint for blueprint in webapi._blueprint_order if blueprint.name != name]
+    webapi.view_functions = {
+        endpoint: view_function for endpoint, view_function in webapi.view_functions.items()
+        if not endpoint.startswith(f'{name}.')
+    }
+    webapi.error_handler_spec.pop(name, None)
+    for attr in _HOOKS:
+        getattr(webapi, attr).pop(name, None)
+
+    added = _app_hooks.pop(name, dict())
+    for attr in _HOOKS:
+        hooks = getattr(webapi, attr)
+        if None in hooks and added.get(attr):
+            hooks[None] = [function for function in hooks[None] if function not in added[attr]]
+    if None in webapi.error_handler_spec and added.get('error_handler_spec'):
+        webapi.error_handler_spec[None] = {
+            code: {
+                exception: handler for exception, handler in handlers.items()
+                if (code, exception, handler) not in added['error_handler_spec']
+            }
+            for code, handlers in webapi.error_handler_spec[None].items()
+        }
+
+
+def _snapshot_app_hooks(webapi: Flask) -> dict:
+    """
+    Collect all application wide hooks.
+
+    :param webapi: the applications flask object
+    :return: dictionary with lists of hooks by attribute name
+    """
+    snapshot = {attr: list(getattr(webapi, attr).get(None, list())) for attr in _HOOKS}
+    snapshot['error_handler_spec'] = [
+        (code, exception, handler)
+        for code, handlers in webapi.error_handler_spec.get(None, dict()).items()
+        for exception, handler in handlers.items()
+    ]
+    return snapshot
+
+
+def _diff_app_hooks(before: dict, after: dict) -> dict:
+    """
+    Get the application wide hooks added between two snapshots.
+
+    :param before: snapshot before the change
+    :param after: snapshot after the change
+    :return: dictionary with lists of added hooks by attribute name
+    """
+    return {attr: [hook for hook in hooks if hook not in before[attr]] for attr, hooks in after.items()}
+
+
+def rebind_url_adapter(webapi: Flask) -> bool:
+    """
+    Bind the url adapter of the current request (or application) context to the current url map of the application.
+    Needed to build urls for routes registered after the context was created.
+
+    :param webapi: the applications flask object
+    :return: whether the adapter was bound to an outdated map
+    """
+    from flask import _request_ctx_stack, _app_ctx_stack
+    ctx = _request_ctx_stack.top or _app_ctx_stack.top
+    if ctx is None or ctx.url_adapter is None or ctx.url_adapter.map is webapi.url_map:
+        return False
+    ctx.url_adapter = webapi.create_url_adapter(getattr(ctx, 'request', None))
+    return True
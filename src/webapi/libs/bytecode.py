@@ -0,0 +1,119 @@
+"""
+Library to precompile the bytecode of plugins and macros.
+
+Bytecode is written below a pycache prefix (see sys.pycache_prefix) instead of __pycache__ folders next to the sources,
+so it can be cached even if the plugin and macro folders are read-only. Hash based pyc files are used, they are
+validated against the source content instead of the modification time, which survives copying and extracting archives.
+"""
+from typing import List
+
+from libs.config import Config
+from libs.log import Logger
+
+#: Flags within the pyc header, see PEP 552
+_HASH_BASED = 0b01
+_CHECK_SOURCE = 0b10
+
+
+def enable_pycache_prefix(config: Config) -> str:
+    """
+    Set sys.pycache_prefix to config.get('webapi', 'pycache_prefix') unless a prefix is set already (e.g. by
+    PYTHONPYCACHEPREFIX). Affects all modules compiled afterwards.
+
+    :param config: configuration object
+    :return: the active prefix, an empty string if none is used
+    """
+    import sys
+    prefix = config.get('webapi', 'pycache_prefix')
+    if not sys.pycache_prefix and prefix:
+        from libs.basics.file import create_folder
+        create_folder(prefix)
+        sys.pycache_prefix = prefix
+    return sys.pycache_prefix or ''
+
+
+def is_up_to_date(source_path: str) -> bool:
+    """
+    Check if the cached bytecode of a source file exists and is a hash based pyc matching the current source.
+
+    :param source_path: path to the python source file
+    :return: whether no compilation is needed
+    """
+    from importlib.util import cache_from_source, source_hash, MAGIC_NUMBER
+    try:
+        with open(cache_from_source(source_path), 'rb') as f:
+            header = f.read(16)
+        with open(source_path, 'rb') as f:
+            source = f.read()
+    except OSError:
+        return False
+    if len(header) != 16 or header[:4] != MAGIC_NUMBER:
+        return False
+    flags = int.from_bytes(header[4:8], 'little')
+    if not flags & _HASH_BASED or not flags & _CHECK_SOURCE:
+        return False
+    return header[8:16] == source_hash(source)
+
+
+def compile_tree(path: str) -> List[str]:
+    """
+    Compile all python files below a folder whose cached bytecode is missing or outdated. Uses sys.pycache_prefix if
+    set, see enable_pycache_prefix.
+
+    :param path: folder (or single file) to compile
+    :raises py_compile.PyCompileError: if a file contains syntax errors
+    :return: paths of all recompiled source files
+    """
+    from os import walk
+    from os.path import isfile, join
+    from py_compile import compile as compile_file, PycInvalidationMode
+
+    if isfile(path):
+        sources = [path] if path.endswith('.py') else list()
+    else:
+        sources = list()
+        for root, dirs, files in walk(path):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__' and not d.startswith('.'))
+            sources += [join(root, f) for f in sorted(files) if f.endswith('.py')]
+
+    recompiled = list()
+    for source in sources:
+        if is_up_to_date(source):
+            continue
+        compile_file(source, doraise=True, invalidation_mode=PycInvalidationMode.CHECKED_HASH)
+        recompiled.append(source)
+    return recompiled
+
+
+def precompile(config: Config, logger: Logger) -> List[str]:
+    """
+    Compile all plugins and macros ahead of importing them, see compile_tree. Plugins and macros which fail to compile
+    are skipped, importing them reports the error later on.
+
+    :param config: configuration object
+    :param logger: logger to use
+    :return: paths of all recompiled source files, relative to the plugin or macro folder
+    """
+    from os import listdir
+    from os.path import join, isdir, relpath
+    from time import perf_counter
+    from py_compile import PyCompileError
+
+    start = perf_counter()
+    recompiled = list()
+    for option in ('plugin_path', 'macro_path'):
+        base_path = config.get('webapi', option)
+        if not isdir(base_path):
+            continue
+        for name in sorted(listdir(base_path)):
+            if name == '__pycache__':
+                continue
+            try:
+                recompiled += [relpath(fp, base_path) for fp in compile_tree(join(base_path, name))]
+            except (PyCompileError, OSError) as e:
+                logger.warning(f'Precompiling {name} has failed: {e}')
+
+    logger.info(f'Recompiled {len(recompiled)} modules in {perf_counter() - start:.3f}s')
+    for fp in recompiled:
+        logger.debug(f' -> {fp}')
+    return recompiled
@@ -0,0 +1,319 @@
+"""
+Result caching for macro methods.
+
+Macro authors declare cacheable methods (or module functions of macros using the module) with the cached decorator:
+
+    from libs.cache import cached
+
+    class Scenes:
+        @cached(ttl=5, max_entries=32)
+        def list_scenes(self, collection):
+            ...
+
+When the macro is created, every declared method is replaced by a memoizing wrapper on the macro object, see
+install_caches. Results are kept in memory (least recently used entries are evicted) and optionally on disk below
+CACHE_DIR, where they survive restarts. Concurrent calls with the same arguments wait for a single computation.
+Exceptions are not cached.
+"""
+from collections import OrderedDict
+from os.path import join
+from threading import Lock, Event
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from libs.config import CACHE_DIR
+
+#: Folder of the on-disk tier
+DISK_CACHE_DIR = join(CACHE_DIR, 'macro_cache')
+
+_caches: Dict[str, Dict[str, 'MemoCache']] = dict()  # {macro name: {method name: cache}}
+_caches_lock = Lock()
+
+
+def cached(ttl: Optional[float] = None, max_entries: int = 128, key: Callable[..., Hashable] = None,
+           persistent: bool = False):
+    """
+    Declare a macro method as cacheable. The method itself is not changed, the cache is added when the macro is created.
+
+    :param ttl: seconds a result stays valid, forever if None
+    :param max_entries: maximum number of results kept in memory
+    :param key: function computing the cache key from the arguments of the method (without self), defaults to the
+        arguments themselves, which need to be hashable then
+    :param persistent: whether to store results on disk as well, results need to be picklable
+    :return: decorator
+    """
+    def decorator(func: Callable) -> Callable:
+        func._cache_options = {'ttl': ttl, 'max_entries': max_entries, 'key': key, 'persistent': persistent}
+        return func
+    return decorator
+
+
+class _Flight:
+    """A computation other callers with the same key wait for."""
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
+
+
+class MemoCache:
+    """
+    Thread safe LRU cache with expiry, single flight computation and statistics for a single function.
+    """
+
+    def __init__(self, func: Callable, name: str, ttl: Optional[float] = None, max_entries: int = 128,
+                 key: Callable[..., Hashable] = None, persistent: bool = False):
+        """
+        Create the cache.
+
+        :param func: function to cache
+        :param name: name of the cache, used for the on-disk folder, e.g. macro/method
+        :param ttl: seconds a result stays valid, forever if None
+        :param max_entries: maximum number of results kept in memory
+        :param key: function computing the cache key from the arguments
+        :param persistent: whether to store results on disk as well
+        """
+        self.func = func
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.key = key
+        self.persistent = persistent
+        # Calls waiting for the computation of another call are counted as waits, neither as hit nor miss
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'evictions': 0, 'expirations': 0, 'disk_hits': 0,
+                      'errors': 0}
+        self._entries: OrderedDict = OrderedDict()  # {key: (expiry or None, value)}
+        self._flights: Dict[Hashable, _Flight] = dict()
+        self._lock = Lock()
+
+    def _make_key(self, args: tuple, kwargs: dict) -> Hashable:
+        """
+        Compute the cache key of a call.
+
+        :param args: positional arguments
+        :param kwargs: keyword arguments
+        :return: the key
+        """
+        if self.key is not None:
+            return self.key(*args, **kwargs)
+        return args + tuple(sorted(kwargs.items())) if kwargs else args
+
+    def __call__(self, *args, **kwargs):
+        """
+        Return the cached result for the arguments, computing it if needed.
+
+        :raises Exception: whatever the function raises
+        :return: the result
+        """
+        from time import monotonic
+        key = self._make_key(args, kwargs)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] is None or entry[0] > monotonic():
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[1]
+                del self._entries[key]
+                self.stats['expirations'] += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.stats['misses'] += 1
+            else:
+                self.stats['waits'] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            found, value = self._read_disk(key) if self.persistent else (False, None)
+            if found:
+                with self._lock:
+                    self.stats['disk_hits'] += 1
+            else:
+                value = self.func(*args, **kwargs)
+                if self.persistent:
+                    self._write_disk(key, value)
+            flight.value = value
+            self._store(key, value)
+            return value
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                self.stats['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def _store(self, key: Hashable, value: Any):
+        """
+        Store a result in memory, evicting the least recently used entries if full.
+
+        :param key: cache key
+        :param value: result
+        """
+        from time import monotonic
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl if self.ttl is not None else None, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def _disk_path(self, key: Hashable) -> str:
+        """
+        Get the file storing a result on disk.
+
+        :param key: cache key
+        :return: path of the file
+        """
+        from hashlib import sha256
+        return join(DISK_CACHE_DIR, *self.name.split('/'), f'{sha256(repr(key).encode("utf-8")).hexdigest()}.pickle')
+
+    def _read_disk(self, key: Hashable) -> tuple:
+        """
+        Read a result from disk, removing it if expired.
+
+        :param key: cache key
+        :return: whether a valid result was found and the result
+        """
+        from pickle import load
+        from time import time
+        from os import remove
+        fp = self._disk_path(key)
+        try:
+            with open(fp, 'rb') as f:
+                stored_key, expiry, value = load(f)
+        except Exception:
+            return False, None
+        if stored_key != key:
+            return False, None
+        if expiry is not None and expiry <= time():
+            try:
+                remove(fp)
+            except OSError:
+                pass
+            return False, None
+        return True, value
+
+    def _write_disk(self, key: Hashable, value: Any):
+        """
+        Write a result to disk. Results that cannot be pickled are only kept in memory.
+
+        :param key: cache key
+        :param value: result
+        """
+        from pickle import dumps, PicklingError
+        from time import time
+        from os.path import dirname
+        from libs.basics.file import create_folder, write_atomic
+        try:
+            data = dumps((key, time() + self.ttl if self.ttl is not None else None, value))
+        except (PicklingError, TypeError, AttributeError):
+            return
+        fp = self._disk_path(key)
+        create_folder(dirname(fp))
+        write_atomic(fp, data)
+
+    def invalidate(self, *args, **kwargs):
+        """
+        Drop the cached result for the given arguments.
+        """
+        from os import remove
+        key = self._make_key(args, kwargs)
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.persistent:
+            try:
+                remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Drop all cached results.
+        """
+        from shutil import rmtree
+        with self._lock:
+            self._entries.clear()
+        if self.persistent:
+            rmtree(join(DISK_CACHE_DIR, *self.name.split('/')), ignore_errors=True)
+
+    def get_stats(self) -> dict:
+        """
+        Get the statistics of the cache.
+
+        :return: dictionary containing the counters, the number of entries and the settings
+        """
+        with self._lock:
+            return {**self.stats, 'entries': len(self._entries), 'max_entries': self.max_entries, 'ttl': self.ttl,
+                    'persistent': self.persistent}
+
+
+def install_caches(macro, name: str) -> int:
+    """
+    Replace all methods (or module functions) of a macro declared by cached with memoizing wrappers. The wrappers
+    provide the functions invalidate(*args, **kwargs), cache_clear() and cache_stats().
+
+    :param macro: the macro object or module
+    :param name: macro name
+    :return: number of cached methods
+    """
+    from functools import wraps
+    from inspect import ismodule
+    caches = dict()
+    owner = macro if ismodule(macro) else type(macro)
+    for attr in dir(owner):
+        func = getattr(owner, attr, None)
+        options = getattr(func, '_cache_options', None)
+        if options is None or not callable(func):
+            continue
+        bound = getattr(macro, attr)
+        cache = MemoCache(bound, f'{name}/{attr}', **options)
+
+        @wraps(func)
+        def wrapper(*args, _cache=cache, **kwargs):
+            return _cache(*args, **kwargs)
+        wrapper.invalidate = cache.invalidate
+        wrapper.cache_clear = cache.clear
+        wrapper.cache_stats = cache.get_stats
+        setattr(macro, attr, wrapper)
+        caches[attr] = cache
+    if caches:
+        with _caches_lock:
+            _caches[name] = caches
+    return len(caches)
+
+
+def invalidate(macro_name: str = None, method: str = None):
+    """
+    Drop cached results.
+
+    :param macro_name: macro to drop the results of, all macros if None
+    :param method: method to drop the results of, all methods of the macro if None
+    """
+    with _caches_lock:
+        caches = [
+            cache for name, methods in _caches.items() if macro_name is None or name == macro_name
+            for method_name, cache in methods.items() if method is None or method_name == method
+        ]
+    for cache in caches:
+        cache.clear()
+
+
+def get_cache_stats() -> Dict[str, Dict[str, dict]]:
+    """
+    Get the statistics of all caches.
+
+    :return: statistics by method name by macro name, see MemoCache.get_stats
+    """
+    with _caches_lock:
+        caches = {name: dict(methods) for name, methods in _caches.items()}
+    return {name: {method: cache.get_stats() for method, cache in methods.items()} for name, methods in caches.items()}
@@ -4,17 +4,30 @@ Library to load and handle config values.
 from os.path import isfile, join, dirname
 from os import getenv, urandom
 from configparser import ConfigParser
+from contextlib import contextmanager
+from threading import RLock, Lock, Timer, Thread, Event
 from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
 
 HOME_DIR = str(Path.home())
 CACHE_DIR = getenv('SH_CACHE_DIR') or join(HOME_DIR, '.cache', 'streamhelper')
 CONFIG_DIR = getenv('SH_CONFIG_DIR') or join(HOME_DIR, '.config', 'streamhelper')
 DATA_DIR = getenv('SH_DATA_DIR') or join(HOME_DIR, '.local', 'share', 'streamhelper')
+PLUGIN_CONFIG_DIR = getenv('SH_PLUGIN_CONFIG_DIR') or join(CONFIG_DIR, 'plugins')
+
+#: Sections stored in the main config file, every other section gets a file of its own in PLUGIN_CONFIG_DIR
+CORE_SECTIONS = ('flask', 'webapi')
+
+Subscriber = Callable[[str, str, Optional[str], Optional[str]], None]  # (app, key, old value, new value)
+Change = Tuple[str, str, Optional[str], Optional[str]]  # [App, Key, Old Value, New Value]
 
 
 class Config:
     """Configuration handler for the base framework and all plugins."""
 
+    #: Seconds to wait for further changes before a deferred write is flushed to disk
+    flush_delay: float = 1.0
+
     def __init__(self):
         """
         Initialize the configuration object. If no configuration exists, the config is generated from scratch.
@@ -23,16 +36,39 @@ class Config:
             - SH_CONFIG_DIR : Fallback directory for configuration files. Defaults to
                 $HOME/.config/streamhelper
             - SH_CONFIG_FP : Filepath to store the configuration. Defaults to $SH_CONFIG_DIR/config.ini
+            - SH_PLUGIN_CONFIG_DIR : Directory storing one file per plugin section. Defaults to
+                $SH_CONFIG_DIR/plugins
+
+        The sections of the framework itself are stored in the main config file. Every other section (usually one per
+        plugin) is stored in a file of its own, which is only read once the section is accessed. Sections of older
+        installations found in the main file are moved on first access.
+
+        Changes are written back to disk atomically and only if a value actually changed, touching only the files of
+        the changed sections. Use Config::batch to group multiple changes into a single write.
+
+        Most code should not create its own object but use the shared one returned by get_config(). Changes made to the
+        files by others are picked up by Config::reload (or periodically by Config::watch) and announced to everyone
+        registered with Config::subscribe.
 
         To change individual config options, see Config::update_config.
         """
-        self._config_fp = getenv('SH_CONFIG_FP') or join(CONFIG_DIR, 'config.ini')
-        self._config = ConfigParser()
+        self._lock = RLock()
+        self._main = _ConfigFile(getenv('SH_CONFIG_FP') or join(CONFIG_DIR, 'config.ini'))
+        self._shards: Dict[str, _ConfigFile] = dict()
+        self._batch_depth = 0
+        self._flush_timer: Timer = None
+        self._subscribers: Dict[Tuple[str, Optional[str]], List[Subscriber]] = dict()
+        self._watcher: Thread = None
+        self._stop_watching = Event()
         from .basics.file import create_underlying_folder
-        create_underlying_folder(self._config_fp)
-        if isfile(self._config_fp):
-            self._config.read(self._config_fp)
-        self.update_config()
+        create_underlying_folder(self._main.fp)
+        self._main.read()
+        with self.batch():
+            self.update_config()
+
+        # Write pending deferred changes on shutdown
+        from atexit import register
+        register(self.flush)
 
     def get(self, app: str, key: str) -> str:
         """
@@ -43,39 +79,282 @@ class Config:
         :return: the value associated with the key (or an empty string if non existent)
         """
         try:
-            return self._config[app][key]
+            return self._file(app).parser[app][key]
         except KeyError:
             return ""
 
-    def set(self, app: str, key: str, value: str):
+    def set(self, app: str, key: str, value: str, deferred: bool = False):
         """
         Set a configuration value for a plugin.
 
+        The config file is only written if the value changed. Within Config::batch, the write happens once the
+        outermost batch is left.
+
         :param app: the plugins internal name
         :param key: the key within the application
         :param value: the value to set
+        :param deferred: whether to write the file in the background after Config.flush_delay seconds without further
+            changes instead of immediately. Meant for request driven changes.
         """
-        if app not in self._config.sections():
+        key = self._key(key)
+        with self._lock:
+            config_file = self._file(app)
             self.create_section(app)
-        self._config[app][key] = value
-        with open(self._config_fp, 'w') as f:
-            self._config.write(f)
+            old_value = config_file.parser.get(app, key, raw=True, fallback=None)
+            if old_value == value:
+                return
+            config_file.parser[app][key] = value
+            self._mark_dirty(config_file, app, key, deferred)
+        self._notify([(app, key, old_value, value)])
 
-    def set_if_none(self, app: str, key: str, value: str):
+    def set_if_none(self, app: str, key: str, value: str, deferred: bool = False):
         """
         Set a configuration value for a plugin but only if the value does not exist.
 
         :param app: the plugins internal name
         :param key: the key within the application
         :param value: the value to set
+        :param deferred: whether to delay the write, see Config::set
         """
-        if app not in self._config.sections():
+        key = self._key(key)
+        with self._lock:
+            config_file = self._file(app)
             self.create_section(app)
-        if key in self._config[app].keys():
+            if key in config_file.parser[app].keys():
+                return
+            config_file.parser[app][key] = value
+            self._mark_dirty(config_file, app, key, deferred)
+        self._notify([(app, key, None, value)])
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager grouping multiple changes into a single write. Batches may be nested, the config files are
+        written once when leaving the outermost batch and only if anything changed.
+
+        Example:
+            with config.batch():
+                config.set('myplugin', 'a', '1')
+                config.set('myplugin', 'b', '2')
+        """
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.flush()
+
+    def flush(self):
+        """
+        Write all pending changes to the config files. Files without changes are not touched.
+
+        Files are replaced atomically, so a crash never leaves a truncated config behind.
+        """
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            for config_file in self._files():
+                if config_file.modified:
+                    config_file.write()
+
+    def _mark_dirty(self, config_file: '_ConfigFile', app: str, key: str, deferred: bool):
+        """
+        Mark a value as changed and write the config, unless a batch is open or the write is deferred.
+
+        :param config_file: file containing the value
+        :param app: the plugins internal name
+        :param key: the key within the application
+        :param deferred: whether to schedule a debounced background write instead of writing immediately
+        """
+        config_file.pending.add((app, key))
+        config_file.modified = True
+        if self._batch_depth > 0:
+            return
+        if not deferred:
+            self.flush()
             return
-        self._config[app][key] = value
-        with open(self._config_fp, 'w') as f:
-            self._config.write(f)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        """
+        (Re)start the timer writing pending changes after Config.flush_delay seconds.
+        """
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+            self._flush_timer = Timer(self.flush_delay, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _key(self, key: str) -> str:
+        """
+        Normalize a key the way the config parser does.
+
+        :param key: the key within the application
+        :return: normalized key
+        """
+        return self._main.parser.optionxform(key)
+
+    def _files(self) -> List['_ConfigFile']:
+        """
+        Returns all files loaded so far, the main file first.
+
+        :return: list of config files
+        """
+        with self._lock:
+            return [self._main] + list(self._shards.values())
+
+    def _file(self, app: str) -> '_ConfigFile':
+        """
+        Returns the file storing a section, reading it on first access.
+
+        :param app: the plugins internal name
+        :return: config file for the section
+        """
+        config_file = self._shards.get(app)
+        if config_file is not None:
+            return config_file
+        if app in CORE_SECTIONS or not _is_valid_shard_name(app):
+            return self._main
+
+        with self._lock:
+            if app in self._shards:
+                return self._shards[app]
+            config_file = _ConfigFile(join(PLUGIN_CONFIG_DIR, f'{app}.ini'))
+            config_file.read()
+
+            # Move the section out of the main file (created by older versions)
+            if self._main.parser.has_section(app):
+                if not config_file.parser.has_section(app):
+                    config_file.parser.add_section(app)
+                    for key, value in self._main.parser.items(app, raw=True):
+                        config_file.parser[app][key] = value
+                        config_file.pending.add((app, key))
+                    config_file.modified = True
+                self._main.parser.remove_section(app)
+                self._main.modified = True
+                if self._batch_depth == 0:
+                    self._schedule_flush()
+
+            self._shards[app] = config_file
+            return config_file
+
+    def subscribe(self, app: str, key: Optional[str], callback: Subscriber):
+        """
+        Register a callback for changes of a configuration value, no matter whether they are made through this object
+        or by editing the file.
+
+        The callback is called with the app, the key, the old and the new value. Missing values are passed as None.
+
+        :param app: the plugins internal name
+        :param key: the key within the application, None to get notified about every key of the app
+        :param callback: function to call on changes
+        """
+        if key is not None:
+            key = self._key(key)
+        with self._lock:
+            self._subscribers.setdefault((app, key), list()).append(callback)
+
+    def unsubscribe(self, app: str, key: Optional[str], callback: Subscriber):
+        """
+        Remove a callback registered with Config::subscribe. Does nothing if it is not registered.
+
+        :param app: the plugins internal name
+        :param key: the key within the application or None
+        :param callback: function to remove
+        """
+        if key is not None:
+            key = self._key(key)
+        with self._lock:
+            callbacks = self._subscribers.get((app, key), list())
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def reload(self) -> List[Change]:
+        """
+        Re-read all config files loaded so far and notify subscribers about every value that changed.
+
+        Values changed by this object but not yet written (see Config::set with deferred) are kept.
+
+        :return: list of changes as (app, key, old value, new value)
+        """
+        changes = list()
+        with self._lock:
+            for config_file in self._files():
+                changes += config_file.reload()
+        self._notify(changes)
+        return changes
+
+    def reload_if_changed(self) -> List[Change]:
+        """
+        Reload the config files that were modified since they were last read or written.
+
+        :return: list of changes, empty if no file was modified
+        """
+        changes = list()
+        with self._lock:
+            for config_file in self._files():
+                if config_file.changed_on_disk():
+                    changes += config_file.reload()
+        self._notify(changes)
+        return changes
+
+    def watch(self, interval: float):
+        """
+        Start a background thread checking the config files for modifications every interval seconds. Does nothing if
+        already watching or if interval is not positive.
+
+        :param interval: seconds between two checks
+        """
+        with self._lock:
+            if interval <= 0 or self._watcher is not None:
+                return
+            self._stop_watching.clear()
+            self._watcher = Thread(target=self._watch, args=(interval,), name='config-watcher', daemon=True)
+            self._watcher.start()
+
+    def stop_watching(self):
+        """
+        Stop the background thread started by Config::watch.
+        """
+        with self._lock:
+            watcher, self._watcher = self._watcher, None
+        if watcher is not None:
+            self._stop_watching.set()
+            watcher.join()
+
+    def _watch(self, interval: float):
+        """
+        Loop of the watcher thread.
+
+        :param interval: seconds between two checks
+        """
+        from logging import getLogger
+        while not self._stop_watching.wait(interval):
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                getLogger('webapi').warning(f'Reloading config failed: {e}')
+
+    def _notify(self, changes: List[Change]):
+        """
+        Call all subscribers registered for the given changes. Failing subscribers are logged and skipped.
+
+        :param changes: list of changes as (app, key, old value, new value)
+        """
+        from logging import getLogger
+        for app, key, old_value, new_value in changes:
+            with self._lock:
+                callbacks = self._subscribers.get((app, key), list()) + self._subscribers.get((app, None), list())
+            for callback in callbacks:
+                try:
+                    callback(app, key, old_value, new_value)
+                except Exception as e:
+                    getLogger('webapi').warning(f'Config subscriber for {app}.{key} has failed: {e}')
 
     def get_or_set(self, app: str, key: str, default_value: str) -> str:
         """
@@ -98,9 +377,10 @@ class Config:
         :param key: the key within the application
         :return: Whether the key exists
         """
-        if app not in self._config.sections():
+        parser = self._file(app).parser
+        if app not in parser.sections():
             return False
-        if key not in self._config[app].keys():
+        if key not in parser[app].keys():
             return False
         return True
 
@@ -110,8 +390,10 @@ class Config:
 
         :param app: the plugins internal name
         """
-        if app not in self._config.sections():
-            self._config.add_section(app)
+        with self._lock:
+            parser = self._file(app).parser
+            if app not in parser.sections():
+                parser.add_section(app)
 
     def flask_config(self) -> dict:
         """
@@ -119,7 +401,7 @@ class Config:
 
         :return: dictionary containing all settings related to flask
         """
-        d = dict(self._config['flask'])
+        d = dict(self._main.parser['flask'])
         for key in list(d.keys()):
             d[key.upper()] = d[key]
         return d
@@ -131,6 +413,7 @@ class Config:
         Environment variables:
         - SH_CONFIG_DIR : Fallback directory for configuration files. Defaults to
                 $HOME/.config/streamhelper
+        - SH_PLUGIN_CONFIG_DIR : Directory storing one file per plugin section. Defaults to $SH_CONFIG_DIR/plugins
         - SH_CACHE_DIR : Fallback directory for non permanent files (e.g. logs). Defaults to
                 $HOME/.cache/streamhelper
         - SH_DATA_DIR : Fallback directory for additional files (templates, plugins, etc.). Defaults to
@@ -148,6 +431,21 @@ class Config:
         - SH_LOG_TYPES : Log types. Currently STREAM (output to console) and FILE (output to logfile) are supported.
             Set multiple types by comma or space separation. Defaults to 'STREAM, FILE'
         - SH_LOG_LEVEL : Log level. Supported are CRITICAL, ERROR, WARNING, INFO, DEBUG, NOTSET. Defaults to DEBUG.
+        - SH_LOG_MAX_BYTES : Size in bytes at which the log file is rotated, 0 to disable size based rotation. Defaults
+            to 10485760 (10 MiB).
+        - SH_LOG_BACKUP_COUNT : Number of rotated log files to keep. Defaults to 10.
+        - SH_LOG_ROTATION_WHEN : Rotate the log file by time instead of size, e.g. midnight, H or W0 (see
+            logging.handlers.TimedRotatingFileHandler). Defaults to empty (rotation by size).
+        - SH_LOG_COMPRESS : Whether to gzip rotated log files. Defaults to false.
+        - SH_LOG_FORMAT : Format of the log lines, text or json (one object per line including the request context).
+            Defaults to text.
+        - SH_ACCESS_LOG : Whether to log method, path, status, size and latency of every request. Defaults to true.
+        - SH_REQUEST_ID_HEADER : Header taking and returning the id of a request, which is added to its log records.
+            Defaults to X-Request-ID.
+        - SH_LOG_BUFFER_SIZE : Number of latest log records kept in memory for the live log of the dashboard, 0 to
+            disable. Defaults to 1000.
+        - SH_LOG_QUEUE_SIZE : Number of log records buffered for the logging thread, further records are dropped.
+            Defaults to 10000.
         - SH_PLUGIN_PATH : Directory containing all plugins as folders. Defaults to $SH_DATA_DIR/blueprints.
         - SH_MACRO_PATH : Directory containing all macros as folders. Defaults to $SH_DATA_DIR/macros.
         - SH_MEDIA_PATH : Directory containing all media files. Defaults to $SH_DATA_DIR/media.
@@ -156,12 +454,58 @@ class Config:
         - SH_JQUERY_VERSION : Version of jquery to use. Defaults to 3.5.
         - SH_ACE_VERSION : Version of ace to use. Defaults to 1.4.12.
         - SH_FONTAWESOME_VERSION : Version of fontawesome to use. Defaults to 5.15.1.
+        - SH_LOADER_THREADS : Number of threads importing plugins and macros concurrently. Defaults to 4.
+        - SH_LAZY_PLUGINS : Whether to defer importing plugins shipping a manifest until they are used. Defaults to
+            false.
+        - SH_LAZY_MACROS : Whether to create macros provided as class on first use instead of on startup. Only classes
+            declaring their name as class attribute are deferred. Defaults to false.
+        - SH_CONFIG_RELOAD_INTERVAL : Seconds between checks of the config file for external modifications, 0 to
+            disable. Defaults to 2.
+        - SH_PYCACHE_PREFIX : Directory to store the bytecode of plugins and macros in, empty to use __pycache__
+            folders. Ignored if PYTHONPYCACHEPREFIX is set. Defaults to $SH_CACHE_DIR/pycache.
+        - SH_PRECOMPILE : Whether to compile outdated plugins and macros on startup before importing them. Defaults to
+            true.
+        - SH_PLUGIN_INSTALL_MODE : How uploaded plugins are installed, either extract (into a folder) or packaged (run
+            from the zip archive). Defaults to extract.
+        - SH_NETWORK_TIMEOUT : Seconds to wait for connectivity checks, e.g. before installing dependencies. Defaults to
+            1.
+        - SH_NETWORK_CACHE_TTL : Seconds the results of connectivity checks are cached. Defaults to 30.
+        - SH_MEDIA_CACHE_CONTROL : Cache-Control policies for media files as pattern=value rules separated by ;, matched
+            against the file name, e.g. '*.mp4=public, max-age=86400; *=no-cache'. Defaults to no-cache (browsers
+            revalidate by ETag and get 304 if unchanged).
+        - SH_THUMBNAIL_CACHE_CONTROL : Cache-Control policies for thumbnails, see SH_MEDIA_CACHE_CONTROL. Defaults to
+            '*=public, max-age=3600'.
+        - SH_SENDFILE : Let a fronting web server send media files and thumbnails, either x-sendfile or
+            x-accel-redirect. Defaults to empty (sent by the application).
+        - SH_SENDFILE_PREFIX : Internal location of the media and thumbnail folders for x-accel-redirect, the files are
+            redirected to <prefix>/media/<file> and <prefix>/thumbnail/<file>. Defaults to /internal.
+        - SH_THUMBNAIL_DEFAULT_SIZE : Size of generated thumbnails if none is requested, see libs.thumbnails. Defaults
+            to 256.
+        - SH_THUMBNAIL_MAX_SIZE : Maximum width and height of generated thumbnails. Defaults to 1920.
+        - SH_THUMBNAIL_WORKERS : Number of threads generating thumbnails. Defaults to 2.
+        - SH_THUMBNAIL_CACHE_SIZE : Maximum total size in bytes of the generated thumbnails, least recently used ones
+            are removed. Defaults to 268435456 (256 MiB).
+        - SH_THUMBNAIL_QUALITY : Quality of generated jpeg and webp thumbnails, 1 to 100. Defaults to 85.
+        - SH_MEDIA_INDEX_PATH : SQLite database indexing the media files, see libs.media. Defaults to
+            $SH_CACHE_DIR/media_index.db.
+        - SH_MEDIA_RESCAN_INTERVAL : Seconds after which queries of the media index start a rescan in the background, 0
+            disables automatic rescans. Defaults to 60.
+        - SH_ASSET_BUNDLING : Whether to bundle the stylesheets and scripts of the templates on startup, see
+            libs.assets. Defaults to true.
+        - SH_ASSET_PATH : Directory storing the built asset bundles. Defaults to $SH_CACHE_DIR/assets.
+        - SH_SERVER_MODE : How the WSGI server runs in production, threaded (one process) or prefork (multiple worker
+            processes sharing the listening socket, see libs.server). Defaults to threaded.
+        - SH_SERVER_WORKERS : Number of worker processes in prefork mode. Defaults to 2.
+        - SH_SERVER_THREADS : Number of threads handling requests per process. Defaults to 8.
+        - SH_SERVER_CONNECTION_LIMIT : Maximum number of open connections per process. Defaults to 100.
+        - SH_SERVER_BACKLOG : Length of the queue of connections waiting to be accepted. Defaults to 1024.
+        - SH_SERVER_CHANNEL_TIMEOUT : Seconds after which inactive connections are closed. Defaults to 120.
         """
 
         from os.path import isdir, dirname
-        if not isdir(dirname(self._config_fp)):
+        if not isdir(dirname(self._main.fp)):
             from .basics.file import create_folder
-            create_folder(dirname(self._config_fp))
+            create_folder(dirname(self._main.fp))
 
         self.set_if_none('flask', 'SECRET_KEY', getenv('SECRET_KEY') or urandom(24).hex())
         self.set_if_none('flask', 'TEMPLATES_AUTO_RELOAD', getenv('TEMPLATES_AUTO_RELOAD') or "true")
@@ -174,6 +518,15 @@ class Config:
         self.set_if_none('webapi', 'log_fp', getenv('SH_LOG_FP') or join(CACHE_DIR, 'streamhelper.log'))
         self.set_if_none('webapi', 'log_types', getenv('SH_LOG_TYPES') or 'STREAM, FILE')
         self.set_if_none('webapi', 'log_level', getenv('SH_LOG_LEVEL') or 'DEBUG')
+        self.set_if_none('webapi', 'log_max_bytes', getenv('SH_LOG_MAX_BYTES') or '10485760')
+        self.set_if_none('webapi', 'log_backup_count', getenv('SH_LOG_BACKUP_COUNT') or '10')
+        self.set_if_none('webapi', 'log_rotation_when', getenv('SH_LOG_ROTATION_WHEN') or '')
+        self.set_if_none('webapi', 'log_compress', getenv('SH_LOG_COMPRESS') or 'false')
+        self.set_if_none('webapi', 'log_format', getenv('SH_LOG_FORMAT') or 'text')
+        self.set_if_none('webapi', 'access_log', getenv('SH_ACCESS_LOG') or 'true')
+        self.set_if_none('webapi', 'request_id_header', getenv('SH_REQUEST_ID_HEADER') or 'X-Request-ID')
+        self.set_if_none('webapi', 'log_buffer_size', getenv('SH_LOG_BUFFER_SIZE') or '1000')
+        self.set_if_none('webapi', 'log_queue_size', getenv('SH_LOG_QUEUE_SIZE') or '10000')
         self.set_if_none('webapi', 'plugin_path', getenv('SH_PLUGIN_PATH') or join(DATA_DIR, 'blueprints'))
         self.set_if_none('webapi', 'macro_path', getenv('SH_MACRO_PATH') or join(DATA_DIR, 'macros'))
         self.set_if_none('webapi', 'media_path', getenv('SH_MEDIA_PATH') or join(DATA_DIR, 'media'))
@@ -182,6 +535,36 @@ class Config:
         self.set_if_none('webapi', 'jquery_version', getenv('SH_JQUERY_VERSION') or '3.5.1')
         self.set_if_none('webapi', 'ace_version', getenv('SH_ACE_VERSION') or '1.4.12')
         self.set_if_none('webapi', 'fontawesome_version', getenv('SH_FONTAWESOME_VERSION') or '5.15.1')
+        self.set_if_none('webapi', 'loader_threads', getenv('SH_LOADER_THREADS') or '4')
+        self.set_if_none('webapi', 'lazy_plugins', getenv('SH_LAZY_PLUGINS') or 'false')
+        self.set_if_none('webapi', 'lazy_macros', getenv('SH_LAZY_MACROS') or 'false')
+        self.set_if_none('webapi', 'config_reload_interval', getenv('SH_CONFIG_RELOAD_INTERVAL') or '2')
+        self.set_if_none('webapi', 'pycache_prefix', getenv('SH_PYCACHE_PREFIX', join(CACHE_DIR, 'pycache')))
+        self.set_if_none('webapi', 'precompile', getenv('SH_PRECOMPILE') or 'true')
+        self.set_if_none('webapi', 'plugin_install_mode', getenv('SH_PLUGIN_INSTALL_MODE') or 'extract')
+        self.set_if_none('webapi', 'network_timeout', getenv('SH_NETWORK_TIMEOUT') or '1')
+        self.set_if_none('webapi', 'network_cache_ttl', getenv('SH_NETWORK_CACHE_TTL') or '30')
+        self.set_if_none('webapi', 'media_cache_control', getenv('SH_MEDIA_CACHE_CONTROL') or 'no-cache')
+        self.set_if_none('webapi', 'thumbnail_cache_control',
+                         getenv('SH_THUMBNAIL_CACHE_CONTROL') or '*=public, max-age=3600')
+        self.set_if_none('webapi', 'sendfile', getenv('SH_SENDFILE') or '')
+        self.set_if_none('webapi', 'sendfile_prefix', getenv('SH_SENDFILE_PREFIX') or '/internal')
+        self.set_if_none('webapi', 'thumbnail_default_size', getenv('SH_THUMBNAIL_DEFAULT_SIZE') or '256')
+        self.set_if_none('webapi', 'thumbnail_max_size', getenv('SH_THUMBNAIL_MAX_SIZE') or '1920')
+        self.set_if_none('webapi', 'thumbnail_workers', getenv('SH_THUMBNAIL_WORKERS') or '2')
+        self.set_if_none('webapi', 'thumbnail_cache_size', getenv('SH_THUMBNAIL_CACHE_SIZE') or '268435456')
+        self.set_if_none('webapi', 'thumbnail_quality', getenv('SH_THUMBNAIL_QUALITY') or '85')
+        self.set_if_none('webapi', 'media_index_path',
+                         getenv('SH_MEDIA_INDEX_PATH') or join(CACHE_DIR, 'media_index.db'))
+        self.set_if_none('webapi', 'media_rescan_interval', getenv('SH_MEDIA_RESCAN_INTERVAL') or '60')
+        self.set_if_none('webapi', 'asset_bundling', getenv('SH_ASSET_BUNDLING') or 'true')
+        self.set_if_none('webapi', 'asset_path', getenv('SH_ASSET_PATH') or join(CACHE_DIR, 'assets'))
+        self.set_if_none('webapi', 'server_mode', getenv('SH_SERVER_MODE') or 'threaded')
+        self.set_if_none('webapi', 'server_workers', getenv('SH_SERVER_WORKERS') or '2')
+        self.set_if_none('webapi', 'server_threads', getenv('SH_SERVER_THREADS') or '8')
+        self.set_if_none('webapi', 'server_connection_limit', getenv('SH_SERVER_CONNECTION_LIMIT') or '100')
+        self.set_if_none('webapi', 'server_backlog', getenv('SH_SERVER_BACKLOG') or '1024')
+        self.set_if_none('webapi', 'server_channel_timeout', getenv('SH_SERVER_CHANNEL_TIMEOUT') or '120')
         self.set('webapi', 'data_dir', DATA_DIR)
         self.set('webapi', 'config_dir', CONFIG_DIR)
         self.set('webapi', 'cache_dir', CACHE_DIR)
@@ -189,6 +572,7 @@ class Config:
         from .basics.file import create_folder
         create_folder(CACHE_DIR)
         create_folder(CONFIG_DIR)
+        create_folder(PLUGIN_CONFIG_DIR)
         create_folder(DATA_DIR)
         create_folder(self.get('flask', 'template_path'))
         create_folder(self.get('flask', 'static_path'))
@@ -198,6 +582,135 @@ class Config:
         create_folder(self.get('webapi', 'macro_path'))
         create_folder(self.get('webapi', 'media_path'))
         create_folder(self.get('webapi', 'thumbnail_path'))
+        create_folder(self.get('webapi', 'asset_path'))
+
+
+_config: Config = None
+_config_lock = Lock()
+
+
+def get_config() -> Config:
+    """
+    Returns the process-wide config object, creating it on first use.
+
+    :return: shared config object
+    """
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = Config()
+        return _config
+
+
+def _diff(old: ConfigParser, new: ConfigParser) -> List[Change]:
+    """
+    Compare two parsed configs.
+
+    :param old: previous config
+    :param new: current config
+    :return: list of changes as (app, key, old value, new value)
+    """
+    changes = list()
+    for app in list(dict.fromkeys(old.sections() + new.sections())):
+        old_keys = list(old[app].keys()) if old.has_section(app) else list()
+        new_keys = list(new[app].keys()) if new.has_section(app) else list()
+        for key in dict.fromkeys(old_keys + new_keys):
+            old_value = old.get(app, key, raw=True, fallback=None)
+            new_value = new.get(app, key, raw=True, fallback=None)
+            if old_value != new_value:
+                changes.append((app, key, old_value, new_value))
+    return changes
+
+
+def _is_valid_shard_name(app: str) -> bool:
+    """
+    Checks if a section name can safely be used as filename.
+
+    :param app: the plugins internal name
+    :return: whether the section can be stored in a file of its own
+    """
+    from re import fullmatch
+    return fullmatch(r'[A-Za-z0-9_][A-Za-z0-9_.-]*', app) is not None
+
+
+def _file_signature(fp: str) -> Optional[Tuple[int, int]]:
+    """
+    Get a cheap signature of a file to detect modifications.
+
+    :param fp: path of the file
+    :return: modification time and size of the file or None if it does not exist
+    """
+    from os import stat
+    try:
+        stat_result = stat(fp)
+    except OSError:
+        return None
+    return stat_result.st_mtime_ns, stat_result.st_size
+
+
+class _ConfigFile:
+    """A single ini file storing one or more sections of the config. Not thread safe on its own."""
+
+    def __init__(self, fp: str):
+        """
+        Initialize an empty file representation, see _ConfigFile::read.
+
+        :param fp: path of the file
+        """
+        self.fp = fp
+        self.parser = ConfigParser()
+        self.pending = set()  # {(app, key)} changed but not yet written
+        self.modified = False
+        self.signature = None
+
+    def read(self):
+        """
+        Read the file, replacing the current content. A missing file results in an empty config.
+        """
+        self.parser = ConfigParser()
+        if isfile(self.fp):
+            self.parser.read(self.fp)
+        self.signature = _file_signature(self.fp)
+
+    def write(self):
+        """
+        Write the file atomically.
+
+        :raises OSError: if writing fails
+        """
+        from io import StringIO
+        from .basics.file import create_underlying_folder, write_atomic
+        buffer = StringIO()
+        self.parser.write(buffer)
+        create_underlying_folder(self.fp)
+        write_atomic(self.fp, buffer.getvalue())
+        self.pending = set()
+        self.modified = False
+        self.signature = _file_signature(self.fp)
+
+    def changed_on_disk(self) -> bool:
+        """
+        Check if the file was modified since it was last read or written.
+
+        :return: whether the file was modified
+        """
+        return _file_signature(self.fp) != self.signature
+
+    def reload(self) -> List[Change]:
+        """
+        Re-read the file, keeping pending changes.
+
+        :return: list of changes as (app, key, old value, new value)
+        """
+        old_parser = self.parser
+        self.read()
+        for app, key in self.pending:
+            value = old_parser.get(app, key, raw=True, fallback=None)
+            if value is not None:
+                if not self.parser.has_section(app):
+                    self.parser.add_section(app)
+                self.parser[app][key] = value
+        return _diff(old_parser, self.parser)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,289 @@
+"""
+Python package dependencies of the application, its plugins and macros.
+
+All requirement files are resolved together in a single pip run, which builds (or reuses) wheels in a wheelhouse below
+CACHE_DIR. The packages are then installed from the wheelhouse without accessing the index, so the number of resolver
+runs and index lookups does not grow with the number of plugins, and a filled wheelhouse allows installing offline.
+"""
+from os.path import join, dirname, abspath
+from typing import Callable, Dict, List
+
+from libs.config import Config, CACHE_DIR
+
+try:
+    from packaging.requirements import Requirement, InvalidRequirement
+    from packaging.utils import canonicalize_name
+    from packaging.version import Version, InvalidVersion
+except ImportError:
+    # pip ships its own copy
+    from pip._vendor.packaging.requirements import Requirement, InvalidRequirement
+    from pip._vendor.packaging.utils import canonicalize_name
+    from pip._vendor.packaging.version import Version, InvalidVersion
+
+#: Requirements of the application itself
+CORE_REQUIREMENTS = join(dirname(dirname(dirname(abspath(__file__)))), 'requirements.txt')
+#: Folder for requirement files extracted from packaged plugins and other generated files
+DEPENDENCY_DIR = join(CACHE_DIR, 'dependencies')
+#: Folder containing the wheels of all dependencies
+WHEELHOUSE_DIR = join(CACHE_DIR, 'wheelhouse')
+#: State of the last successful installation, see compute_fingerprint
+FINGERPRINT_FILE = join(DEPENDENCY_DIR, 'fingerprint.json')
+
+RequirementFiles = Dict[str, str]  # {owner: path to requirements.txt}
+
+
+def collect_requirement_files(config: Config, core_requirements: str = CORE_REQUIREMENTS) -> RequirementFiles:
+    """
+    Collect the requirement files of the application and all plugins and macros. Requirement files of packaged plugins
+    are extracted to DEPENDENCY_DIR.
+
+    :param config: configuration object
+    :param core_requirements: requirement file of the application
+    :return: paths of the requirement files by owner, which is core, plugin:<folder> or macro:<folder>
+    """
+    from os import listdir
+    from os.path import isfile, isdir
+    from libs.basics.archive import split_archive_name
+    files: RequirementFiles = dict()
+    if isfile(core_requirements):
+        files['core'] = core_requirements
+
+    plugin_path = config.get('webapi', 'plugin_path')
+    for entry in sorted(listdir(plugin_path)) if isdir(plugin_path) else list():
+        if entry.startswith('.') or entry == '__pycache__':
+            continue
+        requirements_path = join(plugin_path, entry, 'requirements.txt')
+        if isfile(requirements_path):
+            files[f'plugin:{entry}'] = requirements_path
+        elif isfile(join(plugin_path, entry)):
+            folder = split_archive_name(entry)
+            if folder is not None and not isdir(join(plugin_path, folder)):
+                requirements_path = _extract_archive_requirements(join(plugin_path, entry), folder)
+                if requirements_path is not None:
+                    files[f'plugin:{folder}'] = requirements_path
+
+    macro_path = config.get('webapi', 'macro_path')
+    for entry in sorted(listdir(macro_path)) if isdir(macro_path) else list():
+        requirements_path = join(macro_path, entry, 'requirements.txt')
+        if isfile(requirements_path):
+            files[f'macro:{entry}'] = requirements_path
+    return files
+
+
+def _extract_archive_requirements(archive_path: str, folder: str):
+    """
+    Copy the requirement file of a packaged plugin to DEPENDENCY_DIR.
+
+    :param archive_path: path to the archive
+    :param folder: folder of the plugin package within the archive
+    :return: path to the copy or None if the plugin has no requirements
+    """
+    from zipfile import ZipFile, BadZipFile
+    from libs.basics.file import create_folder, write_atomic
+    try:
+        with ZipFile(archive_path, 'r') as zip_file:
+            data = zip_file.read(f'{folder}/requirements.txt')
+    except (KeyError, BadZipFile, OSError):
+        return None
+    create_folder(join(DEPENDENCY_DIR, 'plugins'))
+    requirements_path = join(DEPENDENCY_DIR, 'plugins', f'{folder}.txt')
+    write_atomic(requirements_path, data)
+    return requirements_path
+
+
+def parse_requirements(requirements_path: str) -> List[Requirement]:
+    """
+    Parse the requirements of a requirement file. Options (e.g. -r or --index-url), urls and invalid lines are skipped,
+    pip still processes them when installing.
+
+    :param requirements_path: path to the requirement file
+    :return: list of requirements
+    """
+    requirements = list()
+    with open(requirements_path, 'r', encoding='utf-8') as f:
+        for line in f.readlines():
+            line = line.split(' #', 1)[0].strip()
+            if not line or line.startswith('#') or line.startswith('-'):
+                continue
+            try:
+                requirements.append(Requirement(line))
+            except InvalidRequirement:
+                continue
+    return requirements
+
+
+def find_conflicts(files: RequirementFiles) -> List[str]:
+    """
+    Find packages required by multiple owners in incompatible versions, e.g. flask~=1.1.2 and flask>=2.0. Requirements
+    are considered compatible if any version mentioned by them (or a version right above one) satisfies all of them,
+    pip detects the remaining cases when resolving.
+
+    :param files: requirement files by owner
+    :return: list of human readable conflict descriptions
+    """
+    required: Dict[str, list] = dict()  # {project: [(owner, requirement)]}
+    for owner, requirements_path in files.items():
+        for requirement in parse_requirements(requirements_path):
+            if requirement.marker is not None and not requirement.marker.evaluate():
+                continue
+            required.setdefault(canonicalize_name(requirement.name), list()).append((owner, requirement))
+
+    conflicts = list()
+    for project, entries in sorted(required.items()):
+        if len({owner for owner, _ in entries}) < 2:
+            continue
+        candidates = set()
+        for _, requirement in entries:
+            for specifier in requirement.specifier:
+                try:
+                    version = Version(specifier.version.rstrip('.*'))
+                except InvalidVersion:
+                    continue
+                candidates.add(version)
+                candidates.add(Version('.'.join(str(part) for part in version.release + (1,))))
+        if not candidates:
+            continue
+        if not any(all(requirement.specifier.contains(version, prereleases=True) for _, requirement in entries)
+                   for version in candidates):
+            conflicts.append(f'{project}: ' + ', '.join(
+                f'{owner} requires {requirement.specifier or "any version"}' for owner, requirement in entries
+            ))
+    return conflicts
+
+
+def compute_fingerprint(files: RequirementFiles) -> dict:
+    """
+    Compute the fingerprint of an installation, consisting of the hashes of all requirement files, the interpreter path
+    and version and a hash of all installed distributions and their versions.
+
+    :param files: requirement files by owner
+    :return: json serializable fingerprint
+    """
+    from sys import executable, version
+    from hashlib import sha256
+    from importlib.metadata import distributions
+
+    requirement_hashes = dict()
+    for owner, requirements_path in files.items():
+        with open(requirements_path, 'rb') as f:
+            requirement_hashes[owner] = sha256(f.read()).hexdigest()
+    installed = sorted({f'{dist.metadata["Name"]}=={dist.version}' for dist in distributions()})
+    return {
+        'executable': executable,
+        'version': version,
+        'requirements': requirement_hashes,
+        'distributions': sha256('\n'.join(installed).encode('utf-8')).hexdigest()
+    }
+
+
+def load_fingerprint() -> dict:
+    """
+    Load the fingerprint of the last successful installation.
+
+    :return: the fingerprint, empty if there is none
+    """
+    from json import load
+    try:
+        with open(FINGERPRINT_FILE, 'r') as f:
+            return load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_fingerprint(fingerprint: dict):
+    """
+    Store the fingerprint of a successful installation.
+
+    :param fingerprint: the fingerprint, see compute_fingerprint
+    """
+    from json import dumps
+    from libs.basics.file import create_folder, write_atomic
+    create_folder(DEPENDENCY_DIR)
+    write_atomic(FINGERPRINT_FILE, dumps(fingerprint, indent=1, sort_keys=True))
+
+
+def get_changes(config: Config, core_requirements: str = CORE_REQUIREMENTS) -> Dict[str, str]:
+    """
+    Get the requirement files changed since the last successful installation.
+
+    :param config: configuration object
+    :param core_requirements: requirement file of the application
+    :return: dictionary with the state (added, changed or removed) by owner, see collect_requirement_files. Changes of
+        the interpreter or the installed distributions are listed as owner python or distributions.
+    """
+    old = load_fingerprint()
+    new = compute_fingerprint(collect_requirement_files(config, core_requirements))
+    changes = dict()
+    if (old.get('executable'), old.get('version')) != (new['executable'], new['version']):
+        changes['python'] = 'changed'
+    if old.get('distributions') != new['distributions']:
+        changes['distributions'] = 'changed'
+    old_requirements = old.get('requirements', dict())
+    for owner, digest in new['requirements'].items():
+        if owner not in old_requirements:
+            changes[owner] = 'added'
+        elif old_requirements[owner] != digest:
+            changes[owner] = 'changed'
+    for owner in old_requirements:
+        if owner not in new['requirements']:
+            changes[owner] = 'removed'
+    return changes
+
+
+def install_dependencies(config: Config, online: bool = True, report: Callable[[str], None] = print,
+                         core_requirements: str = CORE_REQUIREMENTS, force: bool = False) -> RequirementFiles:
+    """
+    Install the dependencies of the application and all plugins and macros in a single resolver run. Nothing is done if
+    neither the requirement files, the interpreter nor the installed distributions have changed since the last
+    successful installation, see get_changes.
+
+    If online, wheels for all requirements are built or downloaded into the wheelhouse (WHEELHOUSE_DIR) first, wheels
+    already in there are reused. Afterwards everything is installed from the wheelhouse without accessing the index.
+    Offline (or if building the wheels fails), the installation only succeeds if the wheelhouse already contains all
+    needed wheels.
+
+    :param config: configuration object
+    :param online: whether the package index is reachable
+    :param report: function called with progress messages
+    :param core_requirements: requirement file of the application
+    :param force: whether to install even if nothing has changed
+    :raises RuntimeError: if requirements of different owners conflict
+    :raises subprocess.CalledProcessError: if pip fails
+    :return: the installed requirement files by owner
+    """
+    from sys import executable
+    from subprocess import check_call, CalledProcessError
+    from libs.basics.file import create_folder
+
+    files = collect_requirement_files(config, core_requirements)
+    if not files:
+        report('No dependencies to install')
+        return files
+    if not force:
+        changes = get_changes(config, core_requirements)
+        if not changes:
+            report('Dependencies unchanged since the last installation')
+            return files
+        report('Changed since the last installation: ' +
+               ', '.join(f'{owner} ({state})' for owner, state in changes.items()))
+
+    conflicts = find_conflicts(files)
+    if conflicts:
+        for conflict in conflicts:
+            report(f'Conflicting requirements for {conflict}')
+        raise RuntimeError('Conflicting requirements: ' + '; '.join(conflicts))
+
+    create_folder(WHEELHOUSE_DIR)
+    requirement_args = [arg for requirements_path in files.values() for arg in ('-r', requirements_path)]
+    report(f'Resolving dependencies of {", ".join(files.keys())}')
+    if online:
+        try:
+            check_call([executable, '-m', 'pip', 'wheel', '--wheel-dir', WHEELHOUSE_DIR, '--find-links',
+                        WHEELHOUSE_DIR, *requirement_args])
+        except CalledProcessError as e:
+            report(f'Building wheels has failed, installing from the wheelhouse only: {e}')
+    check_call([executable, '-m', 'pip', 'install', '--upgrade', '--no-index', '--find-links', WHEELHOUSE_DIR,
+                *requirement_args])
+    save_fingerprint(compute_fingerprint(files))
+    report('Dependencies installed')
+    return files
@@ -0,0 +1,153 @@
+"""
+Library for running long tasks (e.g. plugin installations) as background jobs outside of request threads.
+
+Jobs are executed one after another by a single worker thread. Every job keeps a list of progress events, which can be
+polled or streamed while the job is running.
+"""
+from threading import Condition, Lock
+from typing import Callable, Dict, List, Optional
+from collections import OrderedDict
+
+#: Number of finished jobs kept for status requests
+MAX_FINISHED_JOBS = 50
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    """
+    A background job. The job function gets the job as only argument and reports its progress by calling
+    job.progress().
+    """
+
+    def __init__(self, name: str, func: Callable[['Job'], Optional[str]]):
+        """
+        Create a new job, queue it with submit.
+
+        :param name: display name of the job
+        :param func: job function, gets the job as argument to report progress. Exceptions mark the job as failed, the
+            return value is used as message of the final event.
+        """
+        from uuid import uuid4
+        self.id: str = uuid4().hex
+        self.name: str = name
+        self.state: str = QUEUED
+        self.events: List[dict] = list()
+        self._func = func
+        self._condition = Condition()
+
+    def progress(self, step: str, message: str = '', state: str = None):
+        """
+        Add a progress event and wake up everyone waiting for it.
+
+        :param step: short machine readable name of the step, e.g. extracted
+        :param message: human readable description
+        :param state: new state of the job, keeps the current one if not set
+        """
+        from time import time
+        with self._condition:
+            self.state = state or self.state
+            self.events.append({'id': len(self.events), 'step': step, 'message': message, 'state': self.state,
+                                'time': time()})
+            self._condition.notify_all()
+
+    def is_finished(self) -> bool:
+        """
+        Check if the job has finished, regardless whether it succeeded.
+
+        :return: whether the state is done or failed
+        """
+        return self.state in (DONE, FAILED)
+
+    def wait_for_events(self, start: int, timeout: float = None) -> List[dict]:
+        """
+        Get all events from a given index on, waiting for new events if there are none yet and the job is still
+        running.
+
+        :param start: index of the first event to return
+        :param timeout: maximum number of seconds to wait, waits forever if None
+        :return: list of events, empty if the timeout has passed or the job has finished without new events
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: len(self.events) > start or self.is_finished(), timeout)
+            return self.events[start:]
+
+    def to_dict(self) -> dict:
+        """
+        Get the job as json serializable dictionary.
+
+        :return: dictionary containing id, name, state and events
+        """
+        with self._condition:
+            return {'id': self.id, 'name': self.name, 'state': self.state, 'events': list(self.events)}
+
+    def _run(self):
+        """
+        Execute the job function, recording the outcome as final event.
+        """
+        self.progress('started', f'Started {self.name}', RUNNING)
+        try:
+            message = self._func(self)
+        except Exception as e:
+            self.progress('failed', str(e), FAILED)
+        else:
+            self.progress('done', message or f'Finished {self.name}', DONE)
+        finally:
+            _forget_finished_jobs()
+
+
+_jobs: Dict[str, Job] = OrderedDict()
+_jobs_lock = Lock()
+_executor = None
+
+
+def submit(job: Job) -> Job:
+    """
+    Queue a job created before, e.g. Job('installation', func). Progress events added before are kept.
+
+    :param job: the job to queue
+    :return: the queued job
+    """
+    global _executor
+    with _jobs_lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='jobs')
+        _jobs[job.id] = job
+        job.progress('queued', f'Queued {job.name}')
+        _executor.submit(job._run)
+    return job
+
+
+def get_job(job_id: str) -> Optional[Job]:
+    """
+    Get a job by its id.
+
+    :param job_id: id of the job
+    :return: the job or None if it does not exist (anymore)
+    """
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def get_jobs() -> List[Job]:
+    """
+    Get all known jobs, oldest first.
+
+    :return: list of jobs
+    """
+    with _jobs_lock:
+        return list(_jobs.values())
+
+
+def _forget_finished_jobs():
+    """
+    Drop the oldest finished jobs exceeding MAX_FINISHED_JOBS.
+    """
+    with _jobs_lock:
+        finished = [job_id for job_id, job in _jobs.items() if job.is_finished()]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del _jobs[job_id]
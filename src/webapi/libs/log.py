@@ -2,44 +2,480 @@
 Library for creating and deleting loggers as well as auxiliary functions.
 """
 
-from logging import Logger
+from logging import Logger, LogRecord, Filter, Formatter, Handler, FileHandler
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+from typing import Callable, Dict, List, Optional
+
 from libs.config import Config
 from libs.basics.file import create_folder
 
+_queue_handler: Optional['DroppingQueueHandler'] = None
+_listener: Optional[QueueListener] = None
+_listener_running = False
+_ring_buffer: Optional['RingBufferHandler'] = None
+_level_subscribers: Dict[str, Callable] = dict()  # {logger name: config subscriber following log_level}
+_forward_queue = None  # multiprocessing queue of records prefork workers send to the supervisor, see start_forwarding
+_forward_listener: Optional[QueueListener] = None  # thread of the supervisor writing the records of the workers
+_is_worker = False  # whether this process is a prefork worker forwarding its records
+_setup_lock = Lock()
+
 
 def setup(logger: Logger, config: Config):
     """
     Configure a passed logger using standardized parameters from configuration.
 
+    Records are not written by the calling thread. The logger only gets a handler putting them into a bounded queue,
+    a single listener thread owns the actual handlers (see get_queue_handler), so logging never blocks on file I/O. If
+    the queue is full, records are dropped and counted instead of waiting.
+
     :param logger: logger to manipulate
     :param config: configuration object
     :raises OSError: if folder or file creation fails
     :return:
     """
 
+    queue_handler = get_queue_handler(config)
+    if queue_handler not in logger.handlers:
+        logger.addHandler(queue_handler)
+
+    # Set log level and follow changes, replacing the subscriber of an earlier setup of the same logger
+    set_level(logger, config)
+    with _setup_lock:
+        previous = _level_subscribers.pop(logger.name, None)
+        if previous is not None:
+            config.unsubscribe('webapi', 'log_level', previous)
+        _level_subscribers[logger.name] = lambda *_: set_level(logger, config)
+        config.subscribe('webapi', 'log_level', _level_subscribers[logger.name])
+
+
+def get_queue_handler(config: Config) -> 'DroppingQueueHandler':
+    """
+    Get the handler shared by all loggers, creating it and starting the listener thread with the handlers configured by
+    log_types on first use.
+
+    :param config: configuration object
+    :raises OSError: if folder or file creation fails
+    :return: the queue handler
+    """
+    global _queue_handler, _listener
+    with _setup_lock:
+        if _queue_handler is not None:
+            return _queue_handler
+
+        from queue import Queue
+        handlers = _create_handlers(config)
+        queue = Queue(maxsize=max(1, int(config.get('webapi', 'log_queue_size'))))
+        _queue_handler = DroppingQueueHandler(queue)
+        _queue_handler.addFilter(RequestContextFilter())
+        _listener = QueueListener(queue, *handlers, respect_handler_level=True)
+        start_listener()
+
+        from atexit import register
+        register(shutdown)
+        return _queue_handler
+
+
+def _create_handlers(config: Config) -> list:
+    """
+    Create the handlers writing the records, see log_types.
+
+    :param config: configuration object
+    :raises OSError: if folder or file creation fails
+    :return: list of handlers
+    """
     # Set formatting
-    from logging import Formatter
-    formatter = Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
+    if config.get('webapi', 'log_format').lower() == 'json':
+        formatter = JsonFormatter()
+    else:
+        from logging import Formatter
+        formatter = Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
 
     # Get log types and initialize the associated log handlers
     log_types = config.get('webapi', 'log_types').upper().replace(',', ' ').replace('  ', ' ').split(' ')
+    handlers = list()
 
     if 'STREAM' in log_types:
         from logging import StreamHandler
         stream_handler = StreamHandler()
         stream_handler.setFormatter(formatter)
-        logger.addHandler(stream_handler)
+        handlers.append(stream_handler)
 
     if 'FILE' in log_types:
-        from logging.handlers import RotatingFileHandler
         from os.path import dirname
         log_fp = config.get('webapi', 'log_fp')
         create_folder(dirname(log_fp))
-        file_handler = RotatingFileHandler(filename=log_fp, encoding='utf-8', mode='w', maxBytes=10240, backupCount=10)
+        backup_count = int(config.get('webapi', 'log_backup_count'))
+        when = config.get('webapi', 'log_rotation_when').strip()
+        if when:
+            from logging.handlers import TimedRotatingFileHandler
+            file_handler = TimedRotatingFileHandler(filename=log_fp, encoding='utf-8', when=when,
+                                                    backupCount=backup_count)
+        else:
+            from logging.handlers import RotatingFileHandler
+            file_handler = RotatingFileHandler(filename=log_fp, encoding='utf-8', mode='a',
+                                               maxBytes=int(config.get('webapi', 'log_max_bytes')),
+                                               backupCount=backup_count)
+        if config.get('webapi', 'log_compress').lower() == 'true':
+            file_handler.namer = lambda name: f'{name}.gz'
+            file_handler.rotator = _compress_rotated
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    buffer_size = int(config.get('webapi', 'log_buffer_size') or 0)
+    if buffer_size > 0:
+        global _ring_buffer
+        _ring_buffer = RingBufferHandler(buffer_size)
+        handlers.append(_ring_buffer)
+
+    return handlers
+
+
+def _compress_rotated(source: str, dest: str):
+    """
+    Rotator for file handlers, gzips the rotated file to dest and removes it. Runs in the listener thread while the
+    handler holds its lock, so the next rotation only starts once the file is compressed and shifts it as the other
+    backups. Logging threads are not blocked meanwhile, their records wait in the queue.
+
+    :param source: the log file which was just closed
+    :param dest: name of the rotated file, ending with .gz
+    """
+    import gzip
+    from os import remove, replace
+    from shutil import copyfileobj
+    with open(source, 'rb') as f_in, gzip.open(f'{dest}.tmp', 'wb') as f_out:
+        copyfileobj(f_in, f_out)
+    replace(f'{dest}.tmp', dest)
+    remove(source)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queue handler that never blocks: if the queue is full, the record is dropped and counted. Once there is room again,
+    a warning with the number of dropped records is logged.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        self._unreported = 0
+
+    def enqueue(self, record: LogRecord):
+        """
+        Put a record into the queue without waiting.
+
+        :param record: the prepared record
+        """
+        from queue import Full
+        try:
+            if self._unreported:
+                from logging import makeLogRecord, WARNING
+                self.queue.put_nowait(makeLogRecord({
+                    'name': record.name, 'levelno': WARNING, 'levelname': 'WARNING',
+                    'msg': f'{self._unreported} log records have been dropped, the logging queue was full'
+                }))
+                self._unreported = 0
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            self._unreported += 1
+
+
+class RingBufferHandler(Handler):
+    """
+    Keeps the latest records in memory, e.g. to show them live in the browser. Records are stored as dictionaries
+    containing id (increasing by one per record), time, level, levelno, logger, message and request_id.
+    """
+
+    def __init__(self, capacity: int):
+        """
+        Create the handler.
+
+        :param capacity: maximum number of records kept
+        """
+        from collections import deque
+        from threading import Condition
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+        self.next_id = 0
+        self._condition = Condition()
+
+    def emit(self, record: LogRecord):
+        """
+        Store a record and wake up all waiting readers.
+
+        :param record: the record
+        """
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'levelno': record.levelno,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None)
+        }
+        with self._condition:
+            entry['id'] = self.next_id
+            self.next_id += 1
+            self.records.append(entry)
+            self._condition.notify_all()
+
+    def get_records(self, start: int = 0, level: int = 0, logger: str = '', limit: int = None) -> List[dict]:
+        """
+        Get the stored records starting at an id, optionally filtered.
+
+        :param start: id of the first record to return
+        :param level: minimum level number
+        :param logger: only return records of this logger and its children, all if empty
+        :param limit: only return the latest number of matching records
+        :return: list of records, oldest first
+        """
+        with self._condition:
+            records = [entry for entry in self.records if entry['id'] >= start]
+        records = [
+            entry for entry in records if entry['levelno'] >= level and
+            (not logger or entry['logger'] == logger or entry['logger'].startswith(f'{logger}.'))
+        ]
+        if limit is not None:
+            return records[-limit:] if limit > 0 else list()
+        return records
+
+    def wait_for_records(self, start: int, timeout: float = None) -> int:
+        """
+        Wait until a record with an id of at least start exists.
+
+        :param start: id to wait for
+        :param timeout: maximum seconds to wait
+        :return: the next id to be assigned
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.next_id > start, timeout)
+            return self.next_id
+
+
+def get_ring_buffer() -> Optional[RingBufferHandler]:
+    """
+    Get the handler keeping the latest records in memory, see log_buffer_size.
+
+    :return: the handler or None if disabled or logging is not set up
+    """
+    return _ring_buffer
+
+
+#: Attributes of the request context, see RequestContextFilter and setup_request_logging
+CONTEXT_ATTRIBUTES = ('request_id', 'blueprint', 'endpoint', 'elapsed_ms', 'method', 'path', 'status', 'size')
+
+
+class RequestContextFilter(Filter):
+    """
+    Adds the request context to records logged while handling a request: request_id, blueprint, endpoint and
+    elapsed_ms (milliseconds since the request started). Needs to run in the thread handling the request, so it is
+    attached to the queue handler. Records logged outside of requests get None.
+    """
 
-    # Set log level
+    def filter(self, record: LogRecord) -> bool:
+        """
+        Add the request context to a record.
+
+        :param record: the record
+        :return: always True
+        """
+        from time import perf_counter
+        from flask import has_request_context, request, g
+        if has_request_context() and 'request_start' in g:
+            record.request_id = g.request_id
+            record.blueprint = request.blueprint
+            record.endpoint = request.endpoint
+            record.elapsed_ms = round((perf_counter() - g.request_start) * 1000, 3)
+        else:
+            record.request_id = record.blueprint = record.endpoint = record.elapsed_ms = None
+        return True
+
+
+class JsonFormatter(Formatter):
+    """
+    Formats records as a single line json object containing time, level, logger and message, the request context if
+    any (see CONTEXT_ATTRIBUTES) and the formatted exception.
+    """
+
+    def format(self, record: LogRecord) -> str:
+        """
+        Format a record.
+
+        :param record: the record
+        :return: json string
+        """
+        from json import dumps
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for attribute in CONTEXT_ATTRIBUTES:
+            value = getattr(record, attribute, None)
+            if value is not None:
+                data[attribute] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return dumps(data, default=str)
+
+
+def setup_request_logging(webapi, config: Config):
+    """
+    Give every request an id and write an access log line at the end of each request.
+
+    The id is taken from the request header configured by request_id_header if it is present and valid, a random one
+    is generated otherwise. It is returned in the same header and added to all records logged while handling the
+    request, see RequestContextFilter. If access_log is true, the logger <app logger>.access writes the method, path,
+    status, response size and latency of every request on info level.
+
+    :param webapi: main application object
+    :param config: configuration object
+    """
+    from re import compile as compile_regex
+    from time import perf_counter
+    from uuid import uuid4
+    from flask import request, g
+    valid_id = compile_regex(r'[A-Za-z0-9._:-]{1,128}')
+    header = config.get('webapi', 'request_id_header')
+    access_logger = webapi.logger.getChild('access')
+
+    @webapi.before_request
+    def start_request():
+        g.request_start = perf_counter()
+        request_id = request.headers.get(header, '')
+        g.request_id = request_id if valid_id.fullmatch(request_id) else uuid4().hex
+
+    @webapi.after_request
+    def finish_request(response):
+        if 'request_start' not in g:
+            return response
+        response.headers[header] = g.request_id
+        if config.get('webapi', 'access_log').lower() == 'true':
+            # Streamed responses (e.g. Server-Sent Events) must not be buffered to measure them
+            size = response.calculate_content_length() if response.is_sequence else response.content_length
+            access_logger.info(
+                f'{request.method} {request.full_path if request.query_string else request.path} {response.status_code}'
+                f' {size if size is not None else "-"} {(perf_counter() - g.request_start) * 1000:.1f}ms',
+                extra={'method': request.method, 'path': request.path, 'status': response.status_code, 'size': size}
+            )
+        return response
+
+
+def get_stats() -> dict:
+    """
+    Get statistics of the logging queue.
+
+    :return: dictionary containing the number of queued and dropped records
+    """
+    if _queue_handler is None:
+        return {'queued': 0, 'dropped': 0}
+    return {'queued': _queue_handler.queue.qsize(), 'dropped': _queue_handler.dropped}
+
+
+def start_listener():
+    """
+    Start the listener thread writing the queued records, e.g. after stop_listener. Does nothing if it is running or
+    logging is not set up.
+    """
+    global _listener_running
+    if _listener is not None and not _listener_running:
+        _listener.start()
+        _listener_running = True
+
+
+def stop_listener():
+    """
+    Stop the listener thread after writing all queued records, keeping the handlers. Records logged afterwards are
+    queued until start_listener is called. Used around os.fork, so no lock of the logging thread is held while forking.
+    """
+    global _listener_running
+    if _listener is not None and _listener_running:
+        _listener.stop()
+        _listener_running = False
+
+
+def start_forwarding():
+    """
+    Let the current process (the supervisor of prefork workers, see libs.server) write the log files for all processes.
+    Call before forking: in the forked workers, restart_after_fork replaces the file handlers by a handler sending the
+    records to the supervisor, so only one process writes and rotates the files. The supervisor writes them by a
+    second listener thread. Records are dropped and counted if the queue is full, as for the logging queue.
+    """
+    global _forward_queue, _forward_listener
+    with _setup_lock:
+        if _listener is None or _forward_queue is not None:
+            return
+        file_handlers = [handler for handler in _listener.handlers if isinstance(handler, FileHandler)]
+        if not file_handlers:
+            return
+        from multiprocessing import get_context
+        _forward_queue = get_context('fork').Queue(maxsize=_queue_handler.queue.maxsize)
+        _forward_listener = QueueListener(_forward_queue, *file_handlers, respect_handler_level=True)
+        _forward_listener.start()
+
+
+def restart_after_fork():
+    """
+    Restart the background threads of logging in a forked child process, which only inherits the forking thread. Call
+    after stop_listener was called before forking. If the parent forwards records (see start_forwarding), the records
+    for the file handlers are sent to it from now on.
+    """
+    global _forward_listener, _is_worker
+    if _forward_listener is not None and _listener is not None:
+        # The listener belongs to the supervisor, stopping it here would stop the one of the supervisor
+        _forward_listener = None
+        _is_worker = True
+        _listener.handlers = tuple(handler for handler in _listener.handlers if not isinstance(handler, FileHandler)) \
+            + (DroppingQueueHandler(_forward_queue),)
+    start_listener()
+
+
+def shutdown():
+    """
+    Stop the listener thread after writing all queued records, close all handlers and remove the queue handler from all
+    loggers. Records logged afterwards are not handled until setup is called again.
+    """
+    global _queue_handler, _listener, _ring_buffer, _forward_listener
+    with _setup_lock:
+        if _listener is None:
+            return
+        stop_listener()
+        if _forward_listener is not None:
+            _forward_listener.stop()
+            _forward_listener = None
+        if _is_worker:
+            # Send the remaining records to the supervisor before the process exits
+            _forward_queue.close()
+            _forward_queue.join_thread()
+        for handler in _listener.handlers:
+            handler.close()
+        for logger in _loggers():
+            if _queue_handler in logger.handlers:
+                logger.removeHandler(_queue_handler)
+        _queue_handler = _listener = _ring_buffer = None
+
+
+def _loggers() -> list:
+    """
+    Get all existing loggers including the root logger.
+
+    :return: list of loggers
+    """
+    from logging import getLogger, Logger as LoggerClass
+    return [getLogger()] + [logger for logger in LoggerClass.manager.loggerDict.values() if isinstance(logger, Logger)]
+
+
+def set_level(logger: Logger, config: Config):
+    """
+    Set the level of a passed logger from configuration.
+
+    :param logger: logger to manipulate
+    :param config: configuration object
+    """
     log_level = config.get('webapi', 'log_level').upper()
     log_mapping = {'CRITICAL': 50, 'ERROR': 40, 'WARNING': 30, 'INFO': 20, 'DEBUG': 10, 'NOTSET': 0, 'INVALID': 10}
     if log_level not in log_mapping:
@@ -67,7 +503,8 @@ def setup_webapi(webapi, config: Config):
 
     # Remove old handlers
     for handler in handlers:
-        webapi.logger.removeHandler(handler)
+        if handler is not _queue_handler:
+            webapi.logger.removeHandler(handler)
 
     # Return logger (not necessary, but helpful for further use)
     return webapi.logger
@@ -75,12 +512,14 @@ def setup_webapi(webapi, config: Config):
 
 def disassemble(webapi):
     """
-    Close all logging handlers on main application.
+    Close all logging handlers on main application and stop the listener thread, see shutdown.
 
     :param webapi: main application object
     :return:
     """
 
+    shutdown()
+
     # Remove all handlers
     handlers = webapi.logger.handlers.copy()
     for handler in handlers:
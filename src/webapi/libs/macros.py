@@ -1,16 +1,149 @@
 """
 Macro loader and management.
 """
-from typing import Tuple, List, Dict, Type
+from typing import Callable, Tuple, List, Dict, Type
 from types import ModuleType
+from threading import Lock, local
 
 from libs.config import Config
 from libs.log import Logger
 
 Macros = Dict[str, ModuleType]  # {macro_name: module}
+PostLoads = Dict[str, Tuple[Callable[[], None], List[str], List[str]]]  # {macro_name: (function, depends_on, provides)}
 
 macros: Macros = dict()
 c: Config = None
+_resolving = local()  # names of the macros a thread is creating, to detect dependency cycles
+
+
+class MacroProxy:
+    """
+    Placeholder for a macro provided as class, see load_macros. The macro is created and post_load() is executed on the
+    first access to any attribute, exactly once even if accessed from multiple threads. Macros named in the class
+    attribute depends_on are created before. If creating the macro fails, every access raises a RuntimeError.
+
+    The class attributes name, description, depends_on and provides are readable without creating the macro.
+    """
+
+    def __init__(self, factory: Callable[[], object], name: str, config: Config, logger: Logger):
+        """
+        Create the placeholder.
+
+        :param factory: class of the macro, called without arguments
+        :param name: macro name
+        :param config: the global config object
+        :param logger: the global logging object
+        """
+        object.__setattr__(self, '_macro_factory', factory)
+        object.__setattr__(self, '_macro_config', config)
+        object.__setattr__(self, '_macro_logger', logger)
+        object.__setattr__(self, '_macro_lock', Lock())
+        object.__setattr__(self, '_macro_object', None)
+        object.__setattr__(self, '_macro_error', None)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'description', getattr(factory, 'description', ''))
+        object.__setattr__(self, 'depends_on', list(getattr(factory, 'depends_on', list())))
+        object.__setattr__(self, 'provides', list(getattr(factory, 'provides', list())))
+
+    def is_loaded(self) -> bool:
+        """
+        Check if the macro has been created successfully.
+
+        :return: whether the macro exists
+        """
+        return self._macro_object is not None
+
+    def resolve(self) -> object:
+        """
+        Create the macro if not done yet, see class description.
+
+        :raises RuntimeError: if creating the macro fails or failed before
+        :return: the macro object
+        """
+        if self._macro_object is not None:
+            return self._macro_object
+        resolving = getattr(_resolving, 'names', None)
+        if resolving is None:
+            resolving = _resolving.names = set()
+        if self.name in resolving:
+            raise RuntimeError(f'Macro {self.name} depends on itself: {" -> ".join(sorted(resolving))}')
+
+        resolving.add(self.name)
+        try:
+            for dependency in self.depends_on:
+                for provider in _find_providers(dependency):
+                    if isinstance(provider, MacroProxy) and provider is not self:
+                        provider.resolve()
+            with self._macro_lock:
+                if self._macro_object is None and self._macro_error is None:
+                    self._create()
+        finally:
+            resolving.discard(self.name)
+        if self._macro_error is not None:
+            raise RuntimeError(f'Macro {self.name} has failed to load: {self._macro_error}')
+        return self._macro_object
+
+    def _create(self):
+        """
+        Create the macro and run post_load(), storing the macro or the error. Callers need to hold the lock.
+        """
+        from libs.startup import timed, record
+        from libs.cache import install_caches
+        logger = self._macro_logger
+        logger.debug(f'Creating macro {self.name}')
+        try:
+            macro_object, setup_time = timed(self._macro_factory)
+            macro_object.logger = logger
+            macro_object.config = self._macro_config
+            if not hasattr(macro_object, 'name'):
+                macro_object.name = self.name
+            install_caches(macro_object, self.name)
+            post_load_time = 0.0
+            if hasattr(macro_object, 'post_load'):
+                _, post_load_time = timed(macro_object.post_load)
+            record('macro', self.name, setup_time=setup_time, post_load_time=post_load_time)
+            object.__setattr__(self, '_macro_object', macro_object)
+        except Exception as e:
+            logger.warning(f' -> Creating macro {self.name} has failed: {e}')
+            object.__setattr__(self, '_macro_error', str(e) or e.__class__.__name__)
+
+    def __getattr__(self, item):
+        return getattr(self.resolve(), item)
+
+    def __setattr__(self, key, value):
+        setattr(self.resolve(), key, value)
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        state = 'loaded' if self._macro_object is not None else 'failed' if self._macro_error else 'not loaded'
+        return f'<MacroProxy {self.name} ({state})>'
+
+
+def _find_providers(name: str) -> List[object]:
+    """
+    Find all macros named like a dependency or providing it.
+
+    :param name: name of the dependency
+    :return: list of macros or macro proxies
+    """
+    return [macro for key, macro in list(macros.items())
+            if key == name or (isinstance(macro, MacroProxy) and name in macro.provides)
+            or (not isinstance(macro, MacroProxy) and name in getattr(macro, 'provides', list()))]
+
+
+def get_macro(name: str) -> object:
+    """
+    Returns a single macro, creating it if it is provided as class and was not used before.
+
+    :param name: macro name
+    :raises KeyError: if no macro of that name exists
+    :raises RuntimeError: if creating the macro fails
+    :return: the macro
+    """
+    macro = macros[name]
+    return macro.resolve() if isinstance(macro, MacroProxy) else macro
 
 
 # noinspection PyUnresolvedReferences
@@ -31,7 +164,8 @@ def get_macros_jinja() -> List[Tuple[str, str]]:
 
 def get_macros() -> Macros:
     """
-    Returns all macros. The key is the macro name and the value is the object.
+    Returns all macros. The key is the macro name and the value is the object, a MacroProxy for macros provided as
+    class.
 
     :return: macro dictionary
     """
@@ -54,10 +188,20 @@ def load_macros(config: Config, logger: Logger):
     module.class is tried to initialize. If it is a class, it will be initialized directly both times without arguments.
     Otherwise, the object will be assumed to be the macro and will be set.
 
+    If config.get('webapi', 'lazy_macros') is true, classes are not initialized while loading. A MacroProxy is set
+    instead, which initializes the class on first use. The name is taken from the class attribute name in that case,
+    classes without it are initialized right away (with a warning), so their name stays the same in both modes.
+
     Within the process, multiple attributes will be set: name (always for modules, only if missing otherwise), config,
-    logger.
+    logger. Methods (or module functions) declared by libs.cache.cached get their caches installed before post load.
 
-    After execution, post_load() will be executed if it is a function.
+    Modules are imported concurrently by config.get('webapi', 'loader_threads') threads, while the macros are created
+    one after another in order of the file names. The timings are recorded in libs.startup.
+
+    After all macros are created, post_actions() (modules) or post_load() (objects) are executed if available. A macro
+    may declare the attributes depends_on and provides, both lists of names; its post load function runs after those of
+    all macros named in depends_on (by macro name or by a name in their provides). Independent macros run concurrently,
+    macros within a dependency cycle or depending on a failed macro are skipped.
 
     :param config: the global config object
     :param logger: the global logging object
@@ -69,12 +213,20 @@ def load_macros(config: Config, logger: Logger):
     from os.path import isdir, join, isfile, dirname, basename
     from importlib import import_module
     from sys import path
+    from time import perf_counter
+    from concurrent.futures import ThreadPoolExecutor
+    from libs.startup import timed, record, record_phase, get_loader_threads
+    from libs.basics.graph import build_dependency_graph, run_in_dependency_order
 
+    start = perf_counter()
     macro_path = config.get('webapi', 'macro_path')
+    lazy = config.get('webapi', 'lazy_macros').lower() == 'true'
     path.append(dirname(macro_path.rstrip('/')))
     modules = import_module(basename(macro_path.rstrip('/')))
     logger.info(f'Searching macros in {macro_path}')
-    for d in listdir(macro_path):
+
+    files = list()
+    for d in sorted(listdir(macro_path)):
         if d == '__pycache__' or d == '__init__.py':
             continue
         fp = join(macro_path, d)
@@ -85,48 +237,118 @@ def load_macros(config: Config, logger: Logger):
         name = d.lower()
         if name.startswith('streamhelper-'):
             name = name[13:]
-        logger.debug(f'Loading macros from {name}')
-        try:
-            macro = import_module(f'.{d.rstrip(".py")}', package=modules.__package__)
-
-            _check_attributes(macro, [('use_module', bool)], name)
-            if macro.use_module:
-                macro.name = name
-                macro.config = config
-                macro.logger = logger
-                macros[name] = macro
-                if hasattr(macro, 'post_actions'):
-                    macro.post_actions()
+        files.append((d, name))
+
+    post_loads: PostLoads = dict()
+
+    with ThreadPoolExecutor(max_workers=get_loader_threads(config), thread_name_prefix='macro-loader') as pool:
+        imports = {
+            d: pool.submit(timed, import_module, f'.{d.rstrip(".py")}', package=modules.__package__) for d, _ in files
+        }
+        for d, name in files:
+            logger.debug(f'Loading macros from {name}')
+            try:
+                macro, import_time = imports[d].result()
+                _, setup_time = timed(_setup_macro, macro, name, config, logger, post_loads, lazy)
+                record('macro', name, import_time=import_time, setup_time=setup_time,
+                       wall_time=import_time + setup_time)
+                logger.debug(' -> Finished')
+            except Exception as e:
+                logger.warning(f' -> Loading macro {name} has failed: {e}')
+
+    dependencies, unknown = build_dependency_graph({
+        name: (depends_on, provides) for name, (_, depends_on, provides) in post_loads.items()
+    })
+    for name, names in unknown.items():
+        logger.debug(f'Macro {name} depends on unknown macros, ignoring them: {", ".join(names)}')
+    results = run_in_dependency_order(
+        {name: function for name, (function, _, _) in post_loads.items()}, dependencies, get_loader_threads(config)
+    )
+    for name, result in results.items():
+        record('macro', name, post_load_time=result['time'])
+        if result['status'] != 'ok':
+            logger.warning(f' -> Post actions for macro {name} {result["status"]}: {result["error"]}')
+    record_phase('macro', perf_counter() - start)
+
+
+# noinspection PyUnresolvedReferences
+def _setup_macro(macro: ModuleType, name: str, config: Config, logger: Logger, post_loads: PostLoads,
+                 lazy: bool = False):
+    """
+    Create the macros of an imported module, see load_macros.
+
+    :param macro: the imported module
+    :param name: name of the module
+    :param config: the global config object
+    :param logger: the global logging object
+    :param post_loads: dictionary the post load functions of the created macros are added to
+    :param lazy: whether to set proxies for macros provided as class instead of initializing them
+    :raises Exception: if the module is invalid or creating a macro fails
+    """
+    from libs.cache import install_caches
+    _check_attributes(macro, [('use_module', bool)], name)
+    if macro.use_module:
+        macro.name = name
+        macro.config = config
+        macro.logger = logger
+        install_caches(macro, name)
+        macros[name] = macro
+        if hasattr(macro, 'post_actions'):
+            post_loads[name] = (macro.post_actions, getattr(macro, 'depends_on', list()),
+                                getattr(macro, 'provides', list()))
+    else:
+        from inspect import isclass
+        _check_attributes(macro, [('provides_macros', list)], name)
+        for cl in macro.provides_macros:
+            if type(cl) == str:
+                logger.debug(' -> Loading macro by initializing a object from given class name')
+                if not isclass(getattr(macro, cl)):
+                    raise AttributeError(f' -> Passed class name {cl} for macro {name} but class was not '
+                                         f'found.')
+                if lazy and _is_deferrable(getattr(macro, cl), name, logger):
+                    proxy_name = getattr(macro, cl).name
+                    macros[proxy_name] = MacroProxy(getattr(macro, cl), proxy_name, config, logger)
+                    continue
+                macro_object = getattr(macro, cl)()
+            elif isclass(cl) and lazy and _is_deferrable(cl, name, logger):
+                logger.debug(' -> Deferring macro until first use')
+                proxy_name = cl.name
+                macros[proxy_name] = MacroProxy(cl, proxy_name, config, logger)
+                continue
+            elif isclass(cl):
+                logger.debug(' -> Loading macro by initializing a object from given class')
+                macro_object = cl()
             else:
-                from inspect import isclass
-                _check_attributes(macro, [('provides_macros', list)], name)
-                for cl in macro.provides_macros:
-                    if type(cl) == str:
-                        logger.debug(' -> Loading macro by initializing a object from given class name')
-                        if not isclass(getattr(macro, cl)):
-                            raise AttributeError(f' -> Passed class name {cl} for macro {name} but class was not '
-                                                 f'found.')
-                        macro_object = getattr(macro, cl)()
-                    elif isclass(cl):
-                        logger.debug(' -> Loading macro by initializing a object from given class')
-                        macro_object = cl()
-                    else:
-                        logger.debug(' -> Loading macro by setting object directly')
-                        macro_object = cl
-
-                    macro_object.logger = logger
-                    macro_object.config = config
-                    if not hasattr(macro_object, 'name'):
-                        macro_object.name = cl.__name__ if type(cl) != str else cl.lower()
-                        logger.debug(f' -> Name assumed to be \'{macro_object.name}\'')
-                    macros[macro_object.name] = macro_object
-                    if hasattr(macro_object, 'post_load'):
-                        logger.debug(' -> Post actions')
-                        macro_object.post_load()
-
-            logger.debug(' -> Finished')
-        except Exception as e:
-            logger.warning(f' -> Loading macro {name} has failed: {e}')
+                logger.debug(' -> Loading macro by setting object directly')
+                macro_object = cl
+
+            macro_object.logger = logger
+            macro_object.config = config
+            if not hasattr(macro_object, 'name'):
+                macro_object.name = cl.__name__ if type(cl) != str else cl.lower()
+                logger.debug(f' -> Name assumed to be \'{macro_object.name}\'')
+            install_caches(macro_object, macro_object.name)
+            macros[macro_object.name] = macro_object
+            if hasattr(macro_object, 'post_load'):
+                post_loads[macro_object.name] = (macro_object.post_load, getattr(macro_object, 'depends_on', list()),
+                                                 getattr(macro_object, 'provides', list()))
+
+
+def _is_deferrable(cl: type, name: str, logger: Logger) -> bool:
+    """
+    Check if a macro class can be deferred, which requires its name as class attribute. The name is registered before
+    the object exists, a name set in __init__ would be unknown until then.
+
+    :param cl: the macro class
+    :param name: name of the module providing the class
+    :param logger: the global logging object
+    :return: whether the class has a class attribute name
+    """
+    if isinstance(getattr(cl, 'name', None), str):
+        return True
+    logger.warning(f' -> Macro class {cl.__name__} of {name} has no class attribute name, it cannot be deferred and '
+                   f'is created on startup')
+    return False
 
 
 def _check_attributes(obj: ModuleType, attrs: List[Tuple[str, Type]], name: str):
@@ -0,0 +1,407 @@
+"""
+Index of the media folder.
+
+The files in the media folder (config media_path) are cataloged in a SQLite database (config media_index_path) with
+size, modification time, mime type and, if available, dimensions and duration. Plugins list media by query_media,
+count_media and get_media instead of walking the folder.
+
+The index is updated by rescans. A rescan stats every known directory, but only lists and stats the files of
+directories whose modification time has changed, i.e. which had files added, removed or renamed. Files modified in
+place (same name) are only noticed by a full rescan. Queries start a rescan in the background if the media folder was
+never scanned or the last rescan is older than media_rescan_interval seconds, and answer from the current index
+meanwhile. While the initial scan runs, the index is incomplete, see ensure_fresh. Hidden files and directories
+(starting with a dot) are not indexed.
+
+Dimensions of images are read if the Pillow package is installed, dimensions and duration of videos and audio files if
+ffprobe (part of ffmpeg) is on the PATH.
+"""
+from os.path import join
+from sqlite3 import Connection
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from libs.config import Config
+
+#: Columns queries can be sorted by, mapped to their sql expression
+SORT_COLUMNS = {'path': 'path', 'name': 'name', 'size': 'size', 'mtime': 'mtime_ns', 'duration': 'duration'}
+#: Seconds to wait for ffprobe per file
+PROBE_TIMEOUT = 10
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, directory TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL, mimetype TEXT, width INTEGER, height INTEGER, duration REAL
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE INDEX IF NOT EXISTS files_mimetype ON files (mimetype);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+'''
+
+_scan_lock = Lock()
+_thread_lock = Lock()
+_scan_thread = None
+
+
+def _connect(config: Config) -> Connection:
+    """
+    Open the index database, creating the tables if needed.
+
+    :param config: configuration object
+    :return: the connection, close it after use
+    """
+    from sqlite3 import connect
+    connection = connect(config.get('webapi', 'media_index_path'), timeout=30)
+    # Lets queries read while a rescan writes, also from other worker processes
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def rescan(config: Config, full: bool = False) -> Dict[str, int]:
+    """
+    Update the index from the media folder, see module description. Rescans of the same process run one after another.
+
+    :param config: configuration object
+    :param full: whether to list all directories, also noticing files modified in place
+    :return: number of listed directories and of added, updated and removed files
+    """
+    from collections import defaultdict
+    from os import stat
+    from time import time
+    media_path = config.get('webapi', 'media_path')
+    stats = {'directories': 0, 'added': 0, 'updated': 0, 'removed': 0}
+    with _scan_lock:
+        connection = _connect(config)
+        try:
+            _set_meta(connection, 'scanned', str(time()))
+            known = dict(connection.execute('SELECT path, mtime_ns FROM directories'))
+            children = defaultdict(list)
+            for path in known:
+                if path:
+                    children[path.rpartition('/')[0]].append(path)
+
+            seen = set()
+            pending = ['']
+            while pending:
+                directory = pending.pop()
+                try:
+                    mtime_ns = stat(join(media_path, *directory.split('/'))).st_mtime_ns
+                except OSError:
+                    continue
+                seen.add(directory)
+                if not full and known.get(directory) == mtime_ns:
+                    pending.extend(children[directory])
+                    continue
+                pending.extend(_scan_directory(connection, media_path, directory, mtime_ns, stats))
+                stats['directories'] += 1
+                # Committing every directory keeps the write lock short for other processes
+                connection.commit()
+
+            for directory in set(known) - seen:
+                stats['removed'] += connection.execute('DELETE FROM files WHERE directory = ?', (directory,)).rowcount
+                connection.execute('DELETE FROM directories WHERE path = ?', (directory,))
+            connection.commit()
+            _set_meta(connection, 'completed', str(time()))
+        finally:
+            connection.close()
+    return stats
+
+
+def _scan_directory(connection: Connection, media_path: str, directory: str, mtime_ns: int,
+                    stats: Dict[str, int]) -> List[str]:
+    """
+    List a directory and update the index entries of its files.
+
+    :param connection: connection to the index
+    :param media_path: the media folder
+    :param directory: path of the directory within the media folder, empty for the media folder itself
+    :param mtime_ns: modification time of the directory, stored to skip it while unchanged
+    :param stats: counters of added, updated and removed files to increase
+    :return: paths of the subdirectories
+    """
+    from os import scandir
+    from mimetypes import guess_type
+    indexed = {name: (size, mtime) for name, size, mtime in
+               connection.execute('SELECT name, size, mtime_ns FROM files WHERE directory = ?', (directory,))}
+    subdirectories = list()
+    found = set()
+    try:
+        entries = list(scandir(join(media_path, *directory.split('/'))))
+    except OSError:
+        entries = list()
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        path = f'{directory}/{entry.name}' if directory else entry.name
+        try:
+            if entry.is_dir():
+                subdirectories.append(path)
+                continue
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+        except OSError:
+            continue
+        found.add(entry.name)
+        if indexed.get(entry.name) == (st.st_size, st.st_mtime_ns):
+            continue
+        mimetype = guess_type(entry.name)[0]
+        width, height, duration = _probe(entry.path, mimetype)
+        connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (path, directory, entry.name, st.st_size, st.st_mtime_ns, mimetype, width, height, duration))
+        stats['updated' if entry.name in indexed else 'added'] += 1
+
+    for name in set(indexed) - found:
+        connection.execute('DELETE FROM files WHERE path = ?', (f'{directory}/{name}' if directory else name,))
+        stats['removed'] += 1
+    # Subdirectories which vanished are removed by rescan, as they are not seen anymore
+    connection.execute('INSERT OR REPLACE INTO directories VALUES (?, ?)', (directory, mtime_ns))
+    return subdirectories
+
+
+def _probe(path: str, mimetype: Optional[str]) -> Tuple[Optional[int], Optional[int], Optional[float]]:
+    """
+    Read dimensions and duration of a media file, see module description.
+
+    :param path: path to the file
+    :param mimetype: mime type of the file
+    :return: width, height and duration in seconds, each None if unknown
+    """
+    kind = (mimetype or '').partition('/')[0]
+    if kind == 'image':
+        try:
+            from PIL import Image
+            # Only reads the header, the image data is not decoded
+            with Image.open(path) as image:
+                return image.width, image.height, None
+        except Exception:
+            return None, None, None
+    if kind not in ('video', 'audio'):
+        return None, None, None
+
+    from json import loads
+    from shutil import which
+    from subprocess import run, PIPE, DEVNULL, SubprocessError
+    ffprobe = which('ffprobe')
+    if ffprobe is None:
+        return None, None, None
+    try:
+        result = run([ffprobe, '-v', 'error', '-print_format', 'json', '-show_entries',
+                      'format=duration:stream=width,height', path],
+                     stdout=PIPE, stderr=DEVNULL, timeout=PROBE_TIMEOUT, check=True)
+        info = loads(result.stdout)
+    except (OSError, SubprocessError, ValueError):
+        return None, None, None
+    stream = next((s for s in info.get('streams', list()) if 'width' in s), dict())
+    duration = info.get('format', dict()).get('duration')
+    return stream.get('width'), stream.get('height'), float(duration) if duration else None
+
+
+def start_rescan(config: Config, full: bool = False) -> bool:
+    """
+    Rescan the index in a background thread, unless a rescan is running already.
+
+    :param config: configuration object
+    :param full: see rescan
+    :return: whether a rescan was started
+    """
+    global _scan_thread
+    from threading import Thread
+    with _thread_lock:
+        if _scan_thread is not None and _scan_thread.is_alive():
+            return False
+        _scan_thread = Thread(target=_rescan_logged, args=(config, full), name='media-rescan', daemon=True)
+        _scan_thread.start()
+    return True
+
+
+def _rescan_logged(config: Config, full: bool):
+    """
+    Run a rescan, logging its outcome.
+
+    :param config: configuration object
+    :param full: see rescan
+    """
+    from logging import getLogger
+    from time import perf_counter
+    logger = getLogger('webapi')
+    start = perf_counter()
+    try:
+        stats = rescan(config, full)
+    except Exception as e:
+        logger.error(f'Rescanning the media index has failed: {e}')
+        return
+    logger.debug(f'Rescanned the media index in {perf_counter() - start:.2f}s, listed {stats["directories"]} '
+                 f'directories, {stats["added"]} files added, {stats["updated"]} updated, {stats["removed"]} removed')
+
+
+def ensure_fresh(config: Config) -> bool:
+    """
+    Start a background rescan if the media folder was never scanned or the last rescan is older than
+    media_rescan_interval seconds. Queries call it unless refresh is false, so a request running multiple queries
+    checks once and passes refresh=False.
+
+    :param config: configuration object
+    :return: whether the index is incomplete, i.e. the initial scan is running (also in another worker process)
+    """
+    from time import time
+    connection = _connect(config)
+    try:
+        scanned, completed = _get_meta(connection, 'scanned'), _get_meta(connection, 'completed')
+    finally:
+        connection.close()
+    interval = float(config.get('webapi', 'media_rescan_interval') or 0)
+    if scanned is None or (interval > 0 and time() - float(scanned) > interval):
+        start_rescan(config)
+    return completed is None
+
+
+def _get_meta(connection: Connection, key: str) -> Optional[str]:
+    """
+    Get a value of the meta table.
+
+    :param connection: connection to the index
+    :param key: key of the value
+    :return: the value or None
+    """
+    row = connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(connection: Connection, key: str, value: str):
+    """
+    Set and commit a value of the meta table.
+
+    :param connection: connection to the index
+    :param key: key of the value
+    :param value: the value
+    """
+    connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+    connection.commit()
+
+
+def _where(directory: str = None, recursive: bool = True, mimetype: str = None,
+           search: str = None) -> Tuple[str, list]:
+    """
+    Build the filter of a query, see query_media.
+
+    :return: where clause (empty if not filtered) and its parameters
+    """
+    conditions, parameters = list(), list()
+    directory = directory.strip('/') if directory is not None else None
+    if directory:
+        if recursive:
+            conditions.append("(directory = ? OR directory LIKE ? ESCAPE '\\')")
+            parameters += [directory, f'{_escape_like(directory)}/%']
+        else:
+            conditions.append('directory = ?')
+            parameters.append(directory)
+    elif directory is not None and not recursive:
+        conditions.append("directory = ''")
+    if mimetype:
+        if '/' in mimetype.strip('/'):
+            conditions.append('mimetype = ?')
+            parameters.append(mimetype)
+        else:
+            conditions.append("mimetype LIKE ? ESCAPE '\\'")
+            parameters.append(f'{_escape_like(mimetype.strip("/"))}/%')
+    if search:
+        conditions.append("name LIKE ? ESCAPE '\\'")
+        parameters.append(f'%{_escape_like(search)}%')
+    return (f' WHERE {" AND ".join(conditions)}' if conditions else ''), parameters
+
+
+def _escape_like(value: str) -> str:
+    """
+    Escape the wildcards of a LIKE pattern.
+
+    :param value: text to match literally
+    :return: the escaped text
+    """
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _to_dict(row: tuple) -> dict:
+    """
+    Convert a row of the files table to the dictionary returned by queries.
+
+    :param row: the row
+    :return: dictionary of path, directory, name, size, mtime (seconds), mimetype, width, height and duration
+    """
+    path, directory, name, size, mtime_ns, mimetype, width, height, duration = row
+    return {'path': path, 'directory': directory, 'name': name, 'size': size, 'mtime': mtime_ns / 1e9,
+            'mimetype': mimetype, 'width': width, 'height': height, 'duration': duration}
+
+
+def query_media(config: Config, directory: str = None, recursive: bool = True, mimetype: str = None,
+                search: str = None, sort: str = 'path', descending: bool = False, limit: int = None,
+                offset: int = 0, refresh: bool = True) -> Iterator[dict]:
+    """
+    List indexed media files. Results are read lazily, so large listings do not have to fit in memory.
+
+    :param config: configuration object
+    :param directory: only files within this directory (path within the media folder, empty for the media folder)
+    :param recursive: whether to include files of subdirectories of directory
+    :param mimetype: only files of this mime type (e.g. image/png) or main type (e.g. video)
+    :param search: only files whose name contains this text (case insensitive for ascii letters)
+    :param sort: column to sort by, one of SORT_COLUMNS
+    :param descending: whether to sort in descending order
+    :param limit: maximum number of files, all if None
+    :param offset: number of files to skip
+    :param refresh: whether to start a rescan if the index is outdated, see ensure_fresh
+    :raises ValueError: if sort is unknown
+    :return: generator of dictionaries, see _to_dict
+    """
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f'Unknown sort column {sort}, use one of {", ".join(SORT_COLUMNS)}')
+    where, parameters = _where(directory, recursive, mimetype, search)
+    order = f'{SORT_COLUMNS[sort]} {"DESC" if descending else "ASC"}, path'
+    if refresh:
+        ensure_fresh(config)
+    connection = _connect(config)
+    try:
+        cursor = connection.execute(f'SELECT * FROM files{where} ORDER BY {order} LIMIT ? OFFSET ?',
+                                    parameters + [-1 if limit is None else limit, offset])
+        for row in cursor:
+            yield _to_dict(row)
+    finally:
+        connection.close()
+
+
+def count_media(config: Config, directory: str = None, recursive: bool = True, mimetype: str = None,
+                search: str = None, refresh: bool = True) -> int:
+    """
+    Count indexed media files, see query_media for the filters.
+
+    :param config: configuration object
+    :param refresh: whether to start a rescan if the index is outdated, see ensure_fresh
+    :return: number of matching files
+    """
+    where, parameters = _where(directory, recursive, mimetype, search)
+    if refresh:
+        ensure_fresh(config)
+    connection = _connect(config)
+    try:
+        return connection.execute(f'SELECT COUNT(*) FROM files{where}', parameters).fetchone()[0]
+    finally:
+        connection.close()
+
+
+def get_media(config: Config, path: str, refresh: bool = True) -> Optional[dict]:
+    """
+    Get the index entry of a media file.
+
+    :param config: configuration object
+    :param path: path of the file within the media folder
+    :param refresh: whether to start a rescan if the index is outdated, see ensure_fresh
+    :return: dictionary, see _to_dict, or None if the file is not indexed (yet)
+    """
+    if refresh:
+        ensure_fresh(config)
+    connection = _connect(config)
+    try:
+        row = connection.execute('SELECT * FROM files WHERE path = ?', (path.strip('/'),)).fetchone()
+        return _to_dict(row) if row else None
+    finally:
+        connection.close()
@@ -0,0 +1,213 @@
+"""
+Support for packaged plugins, which are run directly from a zip archive (.zip or .pyz) in the plugin path instead of an
+extracted folder.
+
+An archive called <folder>.zip contains the plugin package as folder <folder>, the same layout as an uploaded plugin.
+The package is imported by zipimport, templates and static files are served from the archive through an in-memory index
+of its central directory.
+"""
+from threading import RLock
+from typing import Dict, Optional, Tuple
+
+from flask import Blueprint
+from jinja2 import BaseLoader, TemplateNotFound
+
+from libs.basics.archive import ArchiveIndex
+
+_indexes: Dict[str, ArchiveIndex] = dict()  # {archive path: index}
+_import_lock = RLock()
+
+
+def get_index(archive_path: str) -> ArchiveIndex:
+    """
+    Get the index of an archive, indexing it again if the archive was modified since.
+
+    :param archive_path: path to the archive
+    :raises zipfile.BadZipFile: if the file is no zip archive
+    :return: the index
+    """
+    index = _indexes.get(archive_path)
+    if index is None or index.is_outdated():
+        if index is not None:
+            index.close()
+        index = _indexes[archive_path] = ArchiveIndex(archive_path)
+    return index
+
+
+def forget_index(archive_path: str):
+    """
+    Close and drop the index of an archive as well as all import caches of it, e.g. before the archive is replaced or
+    removed.
+
+    :param archive_path: path to the archive
+    """
+    from sys import path_importer_cache
+    index = _indexes.pop(archive_path, None)
+    if index is not None:
+        index.close()
+    path_importer_cache.pop(archive_path, None)
+    try:
+        # noinspection PyUnresolvedReferences,PyProtectedMember
+        from zipimport import _zip_directory_cache
+        _zip_directory_cache.pop(archive_path, None)
+    except ImportError:
+        pass
+
+
+def is_plugin_archive(archive_path: str, folder: str) -> bool:
+    """
+    Check if an archive contains the package of a plugin, see module description.
+
+    :param archive_path: path to the archive
+    :param folder: expected folder name of the package
+    :return: whether the package exists within the archive
+    """
+    from zipfile import BadZipFile
+    try:
+        return get_index(archive_path).exists(f'{folder}/__init__.py')
+    except (BadZipFile, OSError):
+        return False
+
+
+def find_package(archive_path: str) -> Optional[str]:
+    """
+    Find the plugin package within an archive, which is the only top level folder containing an __init__.py.
+
+    :param archive_path: path to the archive
+    :raises zipfile.BadZipFile: if the file is no zip archive
+    :return: folder name of the package or None if there is none or multiple
+    """
+    from zipfile import ZipFile
+    with ZipFile(archive_path, 'r') as zip_file:
+        packages = {
+            name.split('/')[0] for name in zip_file.namelist() if name.count('/') == 1 and name.endswith('/__init__.py')
+        }
+    return packages.pop() if len(packages) == 1 else None
+
+
+def import_package(package_name: str, archive_path: str, folder: str):
+    """
+    Import the plugin package within an archive as subpackage of the plugin path package by zipimport. Its submodules
+    are imported from the archive as well. Returns the module if it is imported already.
+
+    The archive is on the path of the plugin path package only while importing, the plugin package keeps its own path
+    within the archive for its submodules. Works on Python 3.9, where zipimporter has no find_spec yet.
+
+    :param package_name: name of the plugin path package (e.g. blueprints)
+    :param archive_path: path to the archive
+    :param folder: folder of the plugin package within the archive
+    :raises ImportError: if the package is missing within the archive
+    :return: the plugin module
+    """
+    from sys import modules
+    from importlib import import_module
+
+    name = f'{package_name}.{folder}'
+    with _import_lock:
+        if name in modules:
+            return modules[name]
+        package = import_module(package_name)
+        package_path = package.__path__
+        package.__path__ = [*package_path, archive_path]
+        try:
+            return import_module(name)
+        finally:
+            package.__path__ = package_path
+
+
+class ArchiveLoader(BaseLoader):
+    """
+    Jinja loader for templates within a folder of an archive.
+    """
+
+    def __init__(self, archive_path: str, prefix: str):
+        """
+        Create the loader.
+
+        :param archive_path: path to the archive
+        :param prefix: template folder within the archive, using / as separator and ending with /
+        """
+        self.archive_path = archive_path
+        self.prefix = prefix
+
+    def get_source(self, environment, template: str) -> Tuple[str, str, callable]:
+        """
+        Load a template from the archive. Templates are reloaded once the archive changes.
+
+        :param environment: jinja environment
+        :param template: template name
+        :raises TemplateNotFound: if the template does not exist
+        :return: source, file name for tracebacks and function returning whether the template is up to date
+        """
+        name = f'{self.prefix}{template}'
+        index = get_index(self.archive_path)
+        if not index.exists(name):
+            raise TemplateNotFound(template)
+        return index.read(name).decode('utf-8'), f'{self.archive_path}/{name}', lambda: not index.is_outdated()
+
+    def list_templates(self) -> list:
+        """
+        List all templates within the archive folder.
+
+        :return: sorted template names
+        """
+        return get_index(self.archive_path).list(self.prefix)
+
+
+class ArchiveBlueprint(Blueprint):
+    """
+    Blueprint serving its templates and static files from a folder within an archive.
+    """
+
+    def __init__(self, name: str, import_name: str, archive_path: str, folder: str, **kwargs):
+        """
+        Create the blueprint. The folders templates and static within the package folder are used.
+
+        :param name: blueprint name
+        :param import_name: import name, see flask.Blueprint
+        :param archive_path: path to the archive
+        :param folder: folder of the plugin package within the archive
+        :param kwargs: further arguments for flask.Blueprint, except of template_folder and static_folder
+        """
+        self.archive_path = archive_path
+        self.prefix = f'{folder}/'
+        has_static = any(name.startswith(f'{self.prefix}static/') for name in get_index(archive_path).entries)
+        super().__init__(name, import_name, template_folder='templates', static_folder='static' if has_static else None,
+                         **kwargs)
+
+    @property
+    def jinja_loader(self) -> ArchiveLoader:
+        """
+        Jinja loader for the templates folder within the archive.
+
+        :return: the loader
+        """
+        return ArchiveLoader(self.archive_path, f'{self.prefix}templates/')
+
+    def send_static_file(self, filename: str):
+        """
+        Send a static file from the archive. Answers conditional requests by the CRC and date of the archive entry.
+
+        :param filename: path within the static folder
+        :return: flask response or 404
+        """
+        from mimetypes import guess_type
+        from datetime import datetime
+        from flask import request, current_app
+        from werkzeug.exceptions import NotFound
+
+        index = get_index(self.archive_path)
+        info = index.entries.get(f'{self.prefix}static/{filename}')
+        if info is None or '..' in filename.split('/'):
+            raise NotFound()
+        response = current_app.response_class(
+            index.read(info.filename),
+            mimetype=guess_type(filename)[0] or 'application/octet-stream'
+        )
+        response.last_modified = datetime(*info.date_time)
+        response.set_etag(f'{info.CRC:08x}-{info.file_size}')
+        cache_timeout = self.get_send_file_max_age(filename)
+        if cache_timeout is not None:
+            response.cache_control.public = True
+            response.cache_control.max_age = cache_timeout
+        return response.make_conditional(request)
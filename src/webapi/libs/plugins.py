@@ -1,11 +1,12 @@
 """
 Plugin loader and management.
 """
-from typing import Tuple, List, Dict
-from types import ModuleType
+from typing import Tuple, List, Dict, FrozenSet, Mapping, NamedTuple, Iterable, Optional
+from types import ModuleType, MappingProxyType
 
 from shutil import rmtree
-from os.path import isdir, join
+from os.path import isdir, isfile, join
+from threading import RLock
 
 from flask import Blueprint, request, flash
 
@@ -18,31 +19,105 @@ Plugins = Dict[str, ModuleType]  # {plugin_name: module}
 PluginPage = Tuple[str, str, int, str]  # [Page Display Name, Internal Page Route, Sort Nonce, Plugin Name]
 PluginPages = List[PluginPage]
 
-plugins: Plugins = dict()
-active_plugins: List[str] = list()
-plugin_pages: PluginPages = list()
+#: Plugins the framework depends on, always loaded eagerly
+CORE_PLUGINS = ('base', 'errors')
+#: Valid folder names of installed plugins, the name is used as module name and url prefix
+PLUGIN_FOLDER_PATTERN = r'[A-Za-z0-9_][A-Za-z0-9_-]*'
+
+
+class PluginRegistry(NamedTuple):
+    """
+    Immutable snapshot of the loaded plugins, the active ones and their pages.
+
+    Snapshots are never modified, every change publishes a new one with an increased version. Readers therefore need
+    no locking, even while another thread (de)activates plugins.
+    """
+    version: int
+    plugins: Mapping[str, ModuleType]
+    active: Tuple[str, ...]
+    active_set: FrozenSet[str]
+    pages: Tuple[PluginPage, ...]
+    active_pages: Tuple[PluginPage, ...]
+    plugins_jinja: Tuple[Tuple[str, str], ...]
+
+
+_registry: PluginRegistry = PluginRegistry(0, MappingProxyType(dict()), tuple(), frozenset(), tuple(), tuple(), tuple())
+_registry_lock = RLock()
+_lifecycle_lock = RLock()
+_webapi = None
+_blueprints_package: str = None
 c: Config = None
 log: Logger = None
 
 
-def get_plugin_pages() -> PluginPages:
+def get_registry() -> PluginRegistry:
     """
-    Returns all pages from plugins that are currently active as sorted list.
+    Returns the current plugin registry snapshot.
 
-    :return: list of pages
+    :return: registry snapshot
+    """
+    return _registry
+
+
+def _publish(plugins: Mapping[str, ModuleType] = None, active: Iterable[str] = None,
+             pages: Iterable[PluginPage] = None) -> PluginRegistry:
+    """
+    Publish a new registry snapshot. Values not passed are taken from the current snapshot. Writers need to hold
+    _registry_lock while reading the current snapshot and publishing the new one.
+
+    :param plugins: all loaded plugins
+    :param active: names of active plugins in activation order
+    :param pages: all pages of the loaded plugins
+    :return: the new snapshot
+    """
+    global _registry
+    with _registry_lock:
+        current = _registry
+        plugins = MappingProxyType(dict(plugins)) if plugins is not None else current.plugins
+        active = tuple(dict.fromkeys(active)) if active is not None else current.active
+        pages = tuple(sorted(pages, key=sort_pages)) if pages is not None else current.pages
+        active_set = frozenset(active)
+        _registry = PluginRegistry(
+            version=current.version + 1,
+            plugins=plugins,
+            active=active,
+            active_set=active_set,
+            pages=pages,
+            active_pages=tuple(page for page in pages if page[3] in active_set),
+            plugins_jinja=tuple(sorted(
+                (key, plugin.description if hasattr(plugin, 'description') else "")
+                for key, plugin in plugins.items()
+            ))
+        )
+        return _registry
+
+
+def get_plugin_pages() -> Tuple[PluginPage, ...]:
+    """
+    Returns all pages from plugins that are currently active as sorted tuple.
+
+    :return: tuple of pages
+    """
+    return _registry.active_pages
+
+
+def get_active_plugins() -> Tuple[str, ...]:
+    """
+    Returns the names of active plugins in activation order.
+
+    :return: tuple of names
     """
-    plugin_pages.sort(key=sort_pages)
-    active_plugin_pages = [e for e in plugin_pages if e[3] in get_active_plugins()]
-    return active_plugin_pages
+    return _registry.active
 
 
-def get_active_plugins() -> List[str]:
+def is_plugin_active(name: str) -> bool:
     """
-    Returns a list of names of active plugins.
+    Checks if a plugin is active.
 
-    :return: list of names
+    :param name: plugin name
+    :return: whether the plugin is active
     """
-    return active_plugins
+    return name in _registry.active_set
 
 
 def sort_pages(page: PluginPage) -> Tuple[int, str]:
@@ -55,44 +130,63 @@ def sort_pages(page: PluginPage) -> Tuple[int, str]:
     return page[2], page[0]
 
 
-def get_plugins_jinja() -> List[Tuple[str, str]]:
+def get_plugins_jinja() -> Tuple[Tuple[str, str], ...]:
     """
-    Returns a list containing of tuples, every tuple contains the lowercase name and the description
+    Returns a tuple containing of tuples sorted by name, every tuple contains the lowercase name and the description
 
-    :return: the list of plugins
+    :return: the plugins
     """
-    return [
-        (
-            key,
-            plugins[key].description if hasattr(plugins[key], 'description') else ""
-        )
-        for key in list(plugins.keys())
-    ]
+    return _registry.plugins_jinja
 
 
-def get_plugins() -> Plugins:
+def get_plugins() -> Mapping[str, ModuleType]:
     """
-    Returns all plugins. The key is the plugin name and the value is the module.
+    Returns all plugins as read-only mapping. The key is the plugin name and the value is the module.
 
-    :return: plugin dictionary
+    :return: plugin mapping
     """
-    return plugins
+    return _registry.plugins
 
 
-def _load_activated_plugins():
+def _load_activated_plugins() -> List[str]:
     """
     Loads all activated plugins from the config.
+
+    :return: list of plugin names
     """
-    for plugin in c.get('webapi', 'active_plugins').split(', '):
-        if plugin != '':
-            active_plugins.append(plugin)
+    return [plugin for plugin in c.get('webapi', 'active_plugins').split(', ') if plugin != '']
 
 
 def _save_activated_plugins():
     """
-    Saves all activated plugins to the config.
+    Saves all activated plugins to the config. The write is deferred, so bursts of (de)activations cause a single write.
     """
-    c.set('webapi', 'active_plugins', ', '.join(active_plugins))
+    c.set('webapi', 'active_plugins', ', '.join(_registry.active), deferred=True)
+
+
+def _sync_activated_plugins(*_):
+    """
+    Config subscriber applying changes of the activated plugins made by another process, e.g. another prefork worker
+    (see libs.server). Unknown plugins are ignored.
+    """
+    with _registry_lock:
+        active = [name for name in _load_activated_plugins() if name in _registry.plugins]
+        if set(active) != set(_registry.active):
+            _publish(active=active)
+
+
+def refuse_runtime_change():
+    """
+    Check if the loaded plugins may be changed at runtime (installing, loading, unloading, removing). That is not the
+    case while serving by multiple worker processes, as the change would only apply to the worker handling the request.
+
+    :return: 409 response if changes are refused, None otherwise
+    """
+    from libs.server import get_worker_count
+    if get_worker_count() > 1:
+        return redirect_or_response(409, 'Plugins cannot be changed while serving by multiple worker processes, change '
+                                         'them while the server is stopped and restart it')
+    return None
 
 
 def _activate_plugin(*names: str):
@@ -101,10 +195,9 @@ def _activate_plugin(*names: str):
 
     :param names: plugin names
     """
-    for name in names:
-        if name not in active_plugins:
-            active_plugins.append(name)
-    _save_activated_plugins()
+    with _registry_lock:
+        _publish(active=_registry.active + names)
+        _save_activated_plugins()
 
 
 def _deactivate_plugin(*names: str):
@@ -113,38 +206,515 @@ def _deactivate_plugin(*names: str):
 
     :param names: plugin names
     """
-    for name in names:
-        while name in active_plugins:
-            active_plugins.remove(name)
-    _save_activated_plugins()
+    with _registry_lock:
+        _publish(active=[name for name in _registry.active if name not in names])
+        _save_activated_plugins()
 
 
 def _remove_plugin(*names: str):
     """
-    Removes plugins by deactivating them if they are activated, removing their objects and removing the corresponding
-    folders.
+    Removes plugins by deactivating them if they are activated, unloading them, removing their objects and removing the
+    corresponding folders.
 
     :param names: plugin names
     """
     for name in names:
-        if name in active_plugins:
-            active_plugins.remove(name)
-        if name in plugins:
-            del plugins[name]
+        if is_plugin_loaded(name):
+            unload_plugin(name)
+    with _registry_lock:
+        registry = _registry
+        _publish(
+            plugins={key: plugin for key, plugin in registry.plugins.items() if key not in names},
+            active=[name for name in registry.active if name not in names],
+            pages=[page for page in registry.pages if page[3] not in names]
+        )
+        _save_activated_plugins()
+    for name in names:
         blueprint_path = c.get('webapi', 'plugin_path')
-        if isdir(join(blueprint_path, name)):
-            log.warning(f"Removing plugin {name}")
-            rmtree(join(blueprint_path, name))
-    # TODO Does not work if streamhelper- is cut
+        folder = _find_plugin_folder(name)
+        if folder is None:
+            continue
+        log.warning(f"Removing plugin {name}")
+        archive_path = _plugin_archive(folder)
+        if archive_path is not None:
+            from os import remove
+            from libs.packaged import forget_index
+            forget_index(archive_path)
+            remove(archive_path)
+        else:
+            rmtree(join(blueprint_path, folder))
     # TODO needs to be added for macros as well
 
 
+class _LazyPlugin:
+    """Placeholder for a plugin whose code is not imported, either deferred by its manifest or unloaded."""
+
+    def __init__(self, name: str, folder: str, manifest: dict, autoload: bool = True):
+        """
+        Initialize the placeholder from the manifest of the plugin.
+
+        :param name: plugin name
+        :param folder: folder name of the plugin within the plugin path
+        :param manifest: parsed manifest
+        :param autoload: whether to load the plugin when it is used, see load_deferred_plugin
+        """
+        self.name = name
+        self.folder = folder
+        self.description = manifest.get('description', '')
+        self.provides_pages = [tuple(page) for page in manifest.get('provides_pages', list())]
+        # Path of every page below the url prefix, so links to pages can be built without loading the plugin
+        self.page_paths = {f'{name}.{page[1]}': page[3] if len(page) > 3 else '/' for page in self.provides_pages}
+        self.autoload = autoload
+        self.error: Optional[str] = None
+
+
+class LazyPluginMiddleware:
+    """WSGI middleware loading deferred plugins on the first request below their url prefix."""
+
+    def __init__(self, wsgi_app):
+        """
+        Wrap a wsgi application.
+
+        :param wsgi_app: the wrapped wsgi application, usually Flask.wsgi_app
+        """
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        """
+        Load the deferred plugin the request is addressed to (if any) and pass the request on.
+        """
+        name = environ.get('PATH_INFO', '').lstrip('/').split('/', 1)[0]
+        if _is_deferred(name):
+            try:
+                load_deferred_plugin(name)
+            except Exception as e:
+                log.warning(f' -> Loading deferred plugin {name} has failed: {e}')
+        return self.wsgi_app(environ, start_response)
+
+
+def _is_deferred(name: str) -> bool:
+    """
+    Checks if a plugin is known by its manifest only and has not failed loading before.
+
+    :param name: plugin name
+    :return: whether the plugin waits for being loaded
+    """
+    plugin = _registry.plugins.get(name)
+    return isinstance(plugin, _LazyPlugin) and plugin.autoload and plugin.error is None
+
+
+def is_plugin_loaded(name: str) -> bool:
+    """
+    Checks if a plugin is loaded, meaning its code is imported and its routes are registered.
+
+    :param name: plugin name
+    :return: whether the plugin is loaded
+    """
+    return name in _registry.plugins and not isinstance(_registry.plugins[name], _LazyPlugin)
+
+
+def load_deferred_plugin(name: str) -> Optional[ModuleType]:
+    """
+    Import and register a plugin deferred by the lazy mode, see load_plugins. Thread safe, the plugin is loaded exactly
+    once. Does nothing for plugins that are already loaded.
+
+    :param name: plugin name
+    :raises Exception: if the plugin fails to load, further calls will not retry
+    :return: the plugin module or None if the plugin is unknown
+    """
+    with _lifecycle_lock:
+        plugin = _registry.plugins.get(name)
+        if not isinstance(plugin, _LazyPlugin) or not plugin.autoload:
+            return plugin
+        if plugin.error is not None:
+            raise ImportError(plugin.error)
+
+        log.info(f'Loading deferred plugin {name}')
+        try:
+            return _load_plugin(name, plugin.folder)
+        except Exception as e:
+            plugin.error = str(e)
+            raise
+
+
+def load_plugin(name: str) -> ModuleType:
+    """
+    Import and register a plugin while the application is running, e.g. after installing it. If the plugin is already
+    loaded, it is reloaded from disk: its modules are imported again and the old blueprint is replaced by the new one
+    in a single step, so requests never run into a missing plugin. Requests already running finish with the old code.
+
+    :param name: plugin name
+    :raises FileNotFoundError: if no folder for the plugin exists
+    :raises Exception: if the plugin fails to load, a loaded plugin keeps running in that case
+    :return: the plugin module
+    """
+    with _lifecycle_lock:
+        folder = _find_plugin_folder(name)
+        if folder is None:
+            raise FileNotFoundError(f'Plugin {name} not found in {c.get("webapi", "plugin_path")}')
+        log.info(f'{"Reloading" if is_plugin_loaded(name) else "Loading"} plugin {name}')
+        return _load_plugin(name, folder)
+
+
+def unload_plugin(name: str) -> bool:
+    """
+    Unregister a plugin while the application is running and remove its modules, so the memory can be freed. The plugin
+    stays listed (and activated, if it is) and can be loaded again by load_plugin.
+
+    Before unloading, unloading_actions() is called on the plugin if it implements the function.
+
+    :param name: plugin name
+    :raises ValueError: if the plugin is a core plugin
+    :return: whether the plugin was loaded before
+    """
+    from inspect import isfunction
+    from libs.basics.routing import unregister_blueprint_live
+    if name in CORE_PLUGINS:
+        raise ValueError(f'Core plugin {name} cannot be unloaded')
+    with _lifecycle_lock:
+        if not is_plugin_loaded(name):
+            return False
+        plugin = _registry.plugins[name]
+        log.info(f'Unloading plugin {name}')
+        if hasattr(plugin, 'unloading_actions') and isfunction(plugin.unloading_actions):
+            try:
+                plugin.unloading_actions()
+            except Exception as e:
+                log.warning(f' -> Unloading actions of plugin {name} have failed: {e}')
+        unregister_blueprint_live(_webapi, name)
+        _purge_modules(plugin.__name__)
+        placeholder = _LazyPlugin(name, plugin.__name__.rsplit('.', 1)[-1], {
+            'description': getattr(plugin, 'description', ''),
+            'provides_pages': getattr(plugin, 'provides_pages', list())
+        }, autoload=False)
+        with _registry_lock:
+            registry = _registry
+            _publish(
+                plugins={**registry.plugins, name: placeholder},
+                pages=[page for page in registry.pages if page[3] != name]
+            )
+        log.debug(' -> Finished')
+        return True
+
+
+def _load_plugin(name: str, folder: str) -> ModuleType:
+    """
+    Import, register and publish a plugin while the application is running. Replaces the plugin if it is loaded.
+    Callers need to hold _lifecycle_lock.
+
+    :param name: plugin name
+    :param folder: folder name of the plugin within the plugin path
+    :raises Exception: if the plugin fails to load
+    :return: the plugin module
+    """
+    from importlib import invalidate_caches
+    from libs.startup import timed, record
+    replace = is_plugin_loaded(name)
+    if replace:
+        _purge_modules(_registry.plugins[name].__name__)
+    archive_path = _plugin_archive(folder)
+    if archive_path is not None:
+        from libs.packaged import forget_index
+        forget_index(archive_path)
+    invalidate_caches()
+    module, import_time = timed(_import_plugin, folder)
+    _, setup_time = timed(_setup_plugin, _webapi, module, folder, name, live=True, replace=replace)
+    record('plugin', name, import_time=import_time, setup_time=setup_time, wall_time=import_time + setup_time)
+    provide_macros(module)
+    from libs.assets import build_plugin_bundles
+    build_plugin_bundles(module, c, log)
+    with _registry_lock:
+        registry = _registry
+        _publish(
+            plugins={**registry.plugins, name: module},
+            pages=[page for page in registry.pages if page[3] != name] + _plugin_pages(module)
+        )
+    _exec_post_action(module)
+    log.debug(' -> Finished')
+    return module
+
+
+def _purge_modules(module_name: str):
+    """
+    Remove a module and all of its submodules from the import system, so they are imported from disk the next time and
+    can be garbage collected once no longer referenced.
+
+    :param module_name: full name of the module
+    """
+    from sys import modules
+    for key in list(modules.keys()):
+        if key == module_name or key.startswith(f'{module_name}.'):
+            del modules[key]
+    if '.' in module_name:
+        package_name, child = module_name.rsplit('.', 1)
+        package = modules.get(package_name)
+        if package is not None and hasattr(package, child):
+            delattr(package, child)
+
+
+def _plugin_name(folder: str) -> str:
+    """
+    Get the name of a plugin by its folder name, see load_plugins.
+
+    :param folder: folder name of the plugin within the plugin path
+    :return: plugin name
+    """
+    name = folder.lower()
+    if name.startswith('streamhelper-'):
+        name = name[13:]
+    return name
+
+
+def check_plugin_folder(folder: str):
+    """
+    Check if an uploaded plugin may be installed into a folder of the plugin path. The name has to match
+    PLUGIN_FOLDER_PATTERN (so it stays within the plugin path) and must not belong to a core plugin.
+
+    :param folder: folder name of the plugin
+    :raises ValueError: if the folder name is invalid or belongs to a core plugin
+    """
+    from re import fullmatch
+    if not fullmatch(PLUGIN_FOLDER_PATTERN, folder or ''):
+        raise ValueError(f'Invalid plugin folder name "{folder}"')
+    if _plugin_name(folder) in CORE_PLUGINS:
+        raise ValueError(f'Core plugin {_plugin_name(folder)} cannot be replaced')
+
+
+def _find_plugin_folder(name: str) -> Optional[str]:
+    """
+    Find the folder of a plugin within the plugin path. Folders take precedence over packaged plugins.
+
+    :param name: plugin name
+    :return: folder name (the package folder within the archive for packaged plugins) or None if not found
+    """
+    for folder, _ in _list_plugin_folders(c.get('webapi', 'plugin_path')):
+        if _plugin_name(folder) == name:
+            return folder
+    return None
+
+
+def _list_plugin_folders(blueprint_path: str) -> List[Tuple[str, Optional[str]]]:
+    """
+    List all plugins within the plugin path, folders as well as packaged plugins (see libs.packaged) without a folder
+    of the same name. Hidden files and folders (e.g. staging folders of updates) are skipped.
+
+    :param blueprint_path: the plugin path
+    :return: sorted list of the folder names and the archive paths of packaged plugins (None for folders)
+    """
+    from os import listdir
+    from libs.basics.archive import split_archive_name
+    from libs.packaged import is_plugin_archive
+    entries = [d for d in sorted(listdir(blueprint_path)) if d != '__pycache__' and not d.startswith('.')]
+    folders = [d for d in entries if isdir(join(blueprint_path, d))]
+    archives = list()
+    for d in entries:
+        folder = split_archive_name(d)
+        if folder is None or folder in folders or not isfile(join(blueprint_path, d)):
+            continue
+        if is_plugin_archive(join(blueprint_path, d), folder):
+            archives.append((folder, join(blueprint_path, d)))
+        else:
+            log.debug(f'Ignoring {d}, it contains no plugin package {folder}')
+    return sorted([(folder, None) for folder in folders] + archives)
+
+
+def _plugin_archive(folder: str) -> Optional[str]:
+    """
+    Get the archive of a packaged plugin.
+
+    :param folder: folder name of the plugin within the plugin path
+    :return: path to the archive or None if the plugin is a folder
+    """
+    from libs.basics.archive import ARCHIVE_EXTENSIONS
+    blueprint_path = c.get('webapi', 'plugin_path')
+    if isdir(join(blueprint_path, folder)):
+        return None
+    for extension in ARCHIVE_EXTENSIONS:
+        if isfile(join(blueprint_path, folder + extension)):
+            return join(blueprint_path, folder + extension)
+    return None
+
+
+def _build_url_after_change(error, endpoint: str, values: dict) -> Optional[str]:
+    """
+    Url build error handler. Urls to the pages a deferred plugin declares in its manifest are built from the path
+    declared there (without arguments only), so rendering the navigation bar does not load the plugin. For other
+    endpoints of deferred plugins, the plugin is loaded. The url is built again with an up to date url adapter if the
+    routes changed after the current request started.
+
+    :param error: the build error
+    :param endpoint: endpoint to build the url for
+    :param values: arguments of url_for
+    :return: the url or None to let flask raise the error
+    """
+    from flask import url_for
+    from libs.basics.routing import rebind_url_adapter
+    name = endpoint.split('.', 1)[0]
+    if name not in _registry.plugins:
+        return None
+    plugin = _registry.plugins[name]
+    # Flask passes its own options (_external, _anchor, ...) along with the arguments
+    arguments = [key for key, value in values.items() if not key.startswith('_')]
+    if _is_deferred(name) and endpoint in plugin.page_paths and not arguments and not values.get('_external'):
+        # The plugin is loaded by LazyPluginMiddleware once the page is requested
+        from flask import has_request_context
+        script_root = request.script_root if has_request_context() else ''
+        anchor = f'#{values["_anchor"]}' if values.get('_anchor') else ''
+        return f'{script_root}/{name}/{plugin.page_paths[endpoint].lstrip("/")}{anchor}'
+    try:
+        load_deferred_plugin(name)
+    except Exception:
+        return None
+    if not rebind_url_adapter(_webapi):
+        return None
+    return url_for(endpoint, **values)
+
+
+def _read_manifest(folder: str) -> Optional[dict]:
+    """
+    Read the manifest (plugin.json) of a plugin.
+
+    :param folder: folder name of the plugin within the plugin path
+    :raises ValueError: if the manifest is no valid json
+    :return: parsed manifest or None if missing
+    """
+    from json import load, loads
+    archive_path = _plugin_archive(folder)
+    if archive_path is not None:
+        from libs.packaged import get_index
+        index = get_index(archive_path)
+        manifest_name = f'{folder}/plugin.json'
+        return loads(index.read(manifest_name).decode('utf-8')) if index.exists(manifest_name) else None
+    manifest_path = join(c.get('webapi', 'plugin_path'), folder, 'plugin.json')
+    if not isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return load(f)
+
+
+def _plugin_pages(plugin) -> PluginPages:
+    """
+    Get the pages a plugin provides by its provides_pages attribute.
+
+    :param plugin: plugin module or placeholder
+    :return: list of pages
+    """
+    return [
+        (
+            page[0],
+            f'{plugin.name}.{page[1]}',
+            page[2] if len(page) > 2 else 1000,
+            plugin.name
+        )
+        for page in getattr(plugin, 'provides_pages', list())
+    ]
+
+
+def _import_plugin(folder: str) -> ModuleType:
+    """
+    Import the module of a plugin. Safe to call from multiple threads.
+
+    :param folder: folder name of the plugin within the plugin path
+    :raises Exception: if the plugin fails to import
+    :return: the plugin module
+    """
+    from importlib import import_module
+    archive_path = _plugin_archive(folder)
+    if archive_path is not None:
+        from libs.packaged import import_package
+        return import_package(_blueprints_package, archive_path, folder)
+    return import_module(f'.{folder}', package=_blueprints_package)
+
+
+def _discover_plugin(folder: str, name: str, lazy: bool):
+    """
+    Read the manifest of a plugin if lazy loading is enabled, import the plugin otherwise. Safe to call from multiple
+    threads.
+
+    :param folder: folder name of the plugin within the plugin path
+    :param name: plugin name
+    :param lazy: whether lazy loading is enabled
+    :raises Exception: if the manifest is invalid or the plugin fails to import
+    :return: a placeholder for deferred plugins, the module otherwise
+    """
+    if lazy and name not in CORE_PLUGINS:
+        manifest = _read_manifest(folder)
+        if manifest is not None and manifest.get('lazy', True):
+            return _LazyPlugin(name, folder, manifest)
+    return _import_plugin(folder)
+
+
+def _setup_plugin(webapi, plugin: ModuleType, folder: str, name: str, live: bool = False, replace: bool = False):
+    """
+    Set up an imported plugin, create its blueprint and register it, see load_plugins.
+
+    :param webapi: the applications flask object
+    :param plugin: the plugin module
+    :param folder: folder name of the plugin within the plugin path
+    :param name: plugin name
+    :param live: whether the application may already be serving requests
+    :param replace: whether to replace a registered blueprint of the same name, requires live
+    :raises Exception: if the plugin is invalid
+    """
+    from inspect import isfunction
+    from libs.basics.routing import swap_blueprint_live
+
+    blueprint_path = c.get('webapi', 'plugin_path')
+
+    attr = 'set_blueprint'
+    if not hasattr(plugin, attr):
+        raise AttributeError(f'Plugin {name} misses the attribute {attr}.')
+    if not isfunction(getattr(plugin, attr)):
+        raise AttributeError(f'Plugin {name} has the attribute {attr}, but it\'s not a function.')
+
+    plugin.name = name
+    plugin.config = c
+    plugin.logger = log
+    archive_path = _plugin_archive(folder)
+    if archive_path is not None:
+        from libs.packaged import ArchiveBlueprint
+        blueprint = ArchiveBlueprint(name, name, archive_path, folder, url_prefix=f'/{name}')
+    else:
+        blueprint = Blueprint(
+            name,
+            name,
+            template_folder=join(blueprint_path, folder, 'templates'),
+            static_folder=join(blueprint_path, folder, 'static'),
+            url_prefix=f'/{name}'
+        )
+    plugin.set_blueprint(blueprint)
+
+    if live:
+        swap_blueprint_live(webapi, name if replace else None, blueprint)
+    else:
+        webapi.register_blueprint(blueprint)
+
+
+# noinspection PyUnresolvedReferences
+def provide_macros(plugin: ModuleType):
+    """
+    Provide a plugin with the macros listed in its request_macros attribute as plugin.macros. Config and Logger are
+    always provided.
+
+    :param plugin: plugin module
+    """
+    from libs.macros import get_macros
+    add_macros = {'config': Config, 'logger': Logger}
+    if hasattr(plugin, 'request_macros'):
+        for macro in plugin.request_macros:
+            if macro in get_macros():
+                add_macros[macro] = get_macros()[macro]
+    plugin.macros = add_macros
+
+
 # noinspection PyUnresolvedReferences
 def load_plugins(webapi, config: Config, logger: Logger):
     """
     Loads all plugins.
 
-    Any folder located in config.get('webapi', 'plugin_path') is tried to import as module except of __pycache__.
+    Any folder located in config.get('webapi', 'plugin_path') is tried to import as module except of __pycache__ and
+    hidden folders. Zip archives (.zip or .pyz) in the plugin path containing the plugin package as folder of the same
+    name are imported from the archive (packaged plugins, see libs.packaged), unless a folder of that name exists.
 
     If a plugin's folder starts with 'streamhelper-' (case insensitive), this part will be removed in the plugin name.
 
@@ -157,84 +727,88 @@ def load_plugins(webapi, config: Config, logger: Logger):
     name in lowercase (the prefix 'streamhelper-' will be stripped, see above) and the url_prefix will be the name, so
     a plugin called 'test' will have it routes below '/test'.
 
+    If lazy loading is enabled (config.get('webapi', 'lazy_plugins')), plugins shipping a manifest are not imported.
+    The manifest is a file called plugin.json in the plugins folder, containing the keys description and
+    provides_pages (same format as the module attributes, with the path of the page below the url prefix as optional
+    fourth element, defaulting to /). Setting the key lazy to false opts out. Such a plugin is imported and registered
+    on the first request below its url prefix or when a url to one of its endpoints is built, except for the pages of
+    the manifest (e.g. in the navigation bar), see load_deferred_plugin. The core plugins are always loaded.
+
+    Plugins are discovered and imported concurrently by config.get('webapi', 'loader_threads') threads, while
+    blueprints are created and registered one after another in order of the folder names. The timings are recorded in
+    libs.startup.
+
     After execution, plugin.exec_post_actions() may be called, which invokes the function post_loading_actions() on all
-    plugins if available. No order implied.
+    plugins if available, see there for the order.
 
     :param webapi: the applications flask object
     :param config: the global config object
     :param logger:the global logging object
     """
-    global c, log
+    global c, log, _webapi, _blueprints_package
     c = config
     log = logger
+    _webapi = webapi
 
-    from os import listdir
-    from os.path import isdir, join, basename, dirname
+    from os.path import basename, dirname
     from importlib import import_module
     from sys import path
+    from time import perf_counter
+    from concurrent.futures import ThreadPoolExecutor
+    from libs.startup import timed, record, record_phase, get_loader_threads
 
+    start = perf_counter()
     blueprint_path = config.get('webapi', 'plugin_path')
     path.append(dirname(blueprint_path.rstrip('/')))
     blueprints = import_module(basename(blueprint_path.rstrip('/')))
+    _blueprints_package = blueprints.__package__
+    lazy = config.get('webapi', 'lazy_plugins').lower() == 'true'
     logger.info(f'Searching plugins in {blueprint_path}')
-    for d in listdir(blueprint_path):
-        if not isdir(join(blueprint_path, d)) or d == '__pycache__':
-            continue
-
-        name = d.lower()
-        if name.startswith('streamhelper-'):
-            name = name[13:]
-        logger.debug(f'Loading plugin {name}')
-        try:
-            plugin = import_module(f'.{d}', package=blueprints.__package__)
-
-            attr = 'set_blueprint'
-            if not hasattr(plugin, attr):
-                raise AttributeError(f'Plugin {name} misses the attribute {attr}.')
-            from inspect import isfunction
-            if not isfunction(getattr(plugin, attr)):
-                raise AttributeError(f'Plugin {name} has the attribute {attr}, but it\'s not a function.')
-
-            plugin.name = name
-            plugin.config = config
-            plugin.logger = logger
-            blueprint = Blueprint(
-                name,
-                name,
-                template_folder=join(blueprint_path, d, 'templates'),
-                static_folder=join(blueprint_path, d, 'static'),
-                url_prefix=f'/{name}'
-            )
-            plugin.set_blueprint(blueprint)
-            plugins[name] = plugin
-
-            webapi.register_blueprint(blueprint)
-            if hasattr(plugin, 'provides_pages'):
-                for page in plugin.provides_pages:
-                    plugin_pages.append(
-                        (
-                            page[0],
-                            f'{plugin.name}.{page[1]}',
-                            page[2] if len(page) > 2 else 1000,
-                            name
-                        )
-                    )
-
-            logger.debug(' -> Finished')
-        except Exception as e:
-            logger.warning(f' -> Loading plugin {name} has failed: {e}')
+    plugins: Plugins = dict()
+    plugin_pages: PluginPages = list()
+
+    folders = [(d, _plugin_name(d)) for d, _ in _list_plugin_folders(blueprint_path)]
+
+    with ThreadPoolExecutor(max_workers=get_loader_threads(config), thread_name_prefix='plugin-loader') as pool:
+        discoveries = {d: pool.submit(timed, _discover_plugin, d, name, lazy) for d, name in folders}
+        for d, name in folders:
+            logger.debug(f'Loading plugin {name}')
+            try:
+                plugin, import_time = discoveries[d].result()
+                if isinstance(plugin, _LazyPlugin):
+                    logger.debug(' -> Deferred until first use')
+                else:
+                    _, setup_time = timed(_setup_plugin, webapi, plugin, d, name)
+                    record('plugin', name, import_time=import_time, setup_time=setup_time,
+                           wall_time=import_time + setup_time)
+                    logger.debug(' -> Finished')
+                plugins[name] = plugin
+                plugin_pages += _plugin_pages(plugin)
+            except Exception as e:
+                logger.warning(f' -> Loading plugin {name} has failed: {e}')
+    record_phase('plugin', perf_counter() - start)
+
+    # Publish loaded plugins and the active plugin list, removing unavailable plugins
+    with _registry_lock:
+        _publish(
+            plugins={**_registry.plugins, **plugins},
+            active=[plugin for plugin in _load_activated_plugins() if plugin in plugins or plugin in _registry.plugins],
+            pages=list(_registry.pages) + plugin_pages
+        )
+        _save_activated_plugins()
 
-    # Load active plugin list and remove unavailable plugins
-    _load_activated_plugins()
-    for plugin in active_plugins.copy():
-        if plugin not in list(plugins.keys()):
-            _deactivate_plugin(plugin)
+    # Load deferred plugins on demand
+    webapi.url_build_error_handlers.append(_build_url_after_change)
+    config.unsubscribe('webapi', 'active_plugins', _sync_activated_plugins)
+    config.subscribe('webapi', 'active_plugins', _sync_activated_plugins)
+    if any(isinstance(plugin, _LazyPlugin) for plugin in plugins.values()):
+        webapi.wsgi_app = LazyPluginMiddleware(webapi.wsgi_app)
 
     @webapi.route('/activate_plugin')
     def activate_plugin():
         """
-        Activates a plugin. At the time, activation and deactivation of plugins only affects the active_plugin() method
-        used by the frontend, and does not unload the plugin. TODO Real load/unload
+        Activates a plugin. Activation and deactivation of plugins affect the pages shown by the frontend. Unloaded
+        plugins are loaded on activation, use /unload_plugin to unload one.
 
         Arguments:
             - name
@@ -245,14 +819,23 @@ def load_plugins(webapi, config: Config, logger: Logger):
         if not is_set(plugin_name):
             return redirect_or_response(400, 'Missing parameter name')
 
+        if plugin_name in get_plugins() and not is_plugin_loaded(plugin_name) and not _is_deferred(plugin_name):
+            refused = refuse_runtime_change()
+            if refused is not None:
+                return refused
+            try:
+                load_plugin(plugin_name)
+            except Exception as e:
+                log.warning(f' -> Loading plugin {plugin_name} has failed: {e}')
+                return redirect_or_response(500, f'Loading plugin {plugin_name} has failed')
         _activate_plugin(plugin_name)
         return redirect_or_response(200, 'Success')
 
     @webapi.route('/deactivate_plugin', methods=['GET', 'POST'])
     def deactivate_plugin():
         """
-        Deactivates a plugin. At the time, activation and deactivation of plugins only affects the active_plugin()
-        method used by the frontend, and does not unload the plugin. TODO Real load/unload
+        Deactivates a plugin. Activation and deactivation of plugins affect the pages shown by the frontend, the plugin
+        keeps running. Use /unload_plugin to unload it.
 
         Takes name as an argument. 400 response if missing.
 
@@ -268,8 +851,7 @@ def load_plugins(webapi, config: Config, logger: Logger):
     @webapi.route('/remove_plugin')
     def remove_plugin():
         """
-        Removes a plugin completely. If flask does not auto reload, the application may need to be restarted for the
-        changes to take effect.
+        Removes a plugin completely, unloading it first.
 
         Arguments:
             - name
@@ -279,18 +861,127 @@ def load_plugins(webapi, config: Config, logger: Logger):
         plugin_name = param('name')
         if not is_set(plugin_name):
             return redirect_or_response(400, 'Missing parameter name')
+        if plugin_name in CORE_PLUGINS:
+            return redirect_or_response(400, f'Core plugin {plugin_name} cannot be removed')
+        refused = refuse_runtime_change()
+        if refused is not None:
+            return refused
 
         _remove_plugin(plugin_name)
         return redirect_or_response(200, 'Success')
 
+    @webapi.route('/load_plugin')
+    def load_plugin_route():
+        """
+        Loads a plugin from the plugin path without restarting, e.g. after it was copied there. A loaded plugin is
+        reloaded, see load_plugin.
+
+        Arguments:
+            - name
+
+        :return: redirect if redirect_url was passed, otherwise response
+        """
+        plugin_name = param('name')
+        if not is_set(plugin_name):
+            return redirect_or_response(400, 'Missing parameter name')
+        refused = refuse_runtime_change()
+        if refused is not None:
+            return refused
+
+        try:
+            load_plugin(plugin_name)
+        except FileNotFoundError as e:
+            return redirect_or_response(404, str(e))
+        except Exception as e:
+            log.warning(f' -> Loading plugin {plugin_name} has failed: {e}')
+            return redirect_or_response(500, f'Loading plugin {plugin_name} has failed')
+        return redirect_or_response(200, 'Success')
+
+    @webapi.route('/reload_plugin')
+    def reload_plugin_route():
+        """
+        Reloads a plugin from disk without restarting, see load_plugin.
+
+        Arguments:
+            - name
+
+        :return: redirect if redirect_url was passed, otherwise response
+        """
+        return load_plugin_route()
+
+    @webapi.route('/unload_plugin')
+    def unload_plugin_route():
+        """
+        Unloads a plugin without restarting, see unload_plugin.
+
+        Arguments:
+            - name
+
+        :return: redirect if redirect_url was passed, otherwise response
+        """
+        plugin_name = param('name')
+        if not is_set(plugin_name):
+            return redirect_or_response(400, 'Missing parameter name')
+        refused = refuse_runtime_change()
+        if refused is not None:
+            return refused
+
+        try:
+            unload_plugin(plugin_name)
+        except ValueError as e:
+            return redirect_or_response(400, str(e))
+        return redirect_or_response(200, 'Success')
+
 
 # noinspection PyUnresolvedReferences
 def exec_post_actions():
     """
-    Execute post_loading_actions() on all plugins that implement the function. No order implied.
+    Execute post_loading_actions() on all plugins that implement the function. Deferred plugins run them once they are
+    loaded.
+
+    Plugins may declare the attributes depends_on and provides, both lists of names. The post loading actions of a
+    plugin run after those of all plugins named in its depends_on (by plugin name or by a name in their provides),
+    independent plugins run concurrently. Plugins within a dependency cycle or depending on a failed plugin are skipped.
+    The timings are recorded in libs.startup.
     """
     from inspect import isfunction
-    for plugin in plugins.values():
-        if hasattr(plugin, 'post_loading_actions') and isfunction(plugin.post_loading_actions):
-            log.debug(f'Running post loading actions for {plugin.name}')
+    from libs.basics.graph import build_dependency_graph, run_in_dependency_order
+    from libs.startup import record, get_loader_threads
+
+    plugins = get_plugins()
+    dependencies, unknown = build_dependency_graph({
+        name: (getattr(plugin, 'depends_on', list()), getattr(plugin, 'provides', list()))
+        for name, plugin in plugins.items()
+    })
+    for name, names in unknown.items():
+        log.debug(f'Plugin {name} depends on unknown plugins, ignoring them: {", ".join(names)}')
+
+    tasks = {
+        name: (lambda plugin=plugin: _exec_post_action(plugin, raise_errors=True))
+        for name, plugin in plugins.items()
+        if hasattr(plugin, 'post_loading_actions') and isfunction(plugin.post_loading_actions)
+    }
+    results = run_in_dependency_order(tasks, dependencies, get_loader_threads(c))
+    for name, result in results.items():
+        record('plugin', name, post_load_time=result['time'])
+        if result['status'] != 'ok':
+            log.warning(f' -> Post loading actions for {name} {result["status"]}: {result["error"]}')
+
+
+# noinspection PyUnresolvedReferences
+def _exec_post_action(plugin: ModuleType, raise_errors: bool = False):
+    """
+    Execute post_loading_actions() on a plugin if it implements the function.
+
+    :param plugin: plugin module
+    :param raise_errors: whether to raise exceptions of the function instead of logging them
+    """
+    from inspect import isfunction
+    if hasattr(plugin, 'post_loading_actions') and isfunction(plugin.post_loading_actions):
+        log.debug(f'Running post loading actions for {plugin.name}')
+        try:
             plugin.post_loading_actions()
+        except Exception as e:
+            if raise_errors:
+                raise
+            log.warning(f' -> Post loading actions for {plugin.name} have failed: {e}')
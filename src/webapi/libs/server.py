@@ -0,0 +1,198 @@
+"""
+Production WSGI server.
+
+In threaded mode, waitress serves the application within the current process. In prefork mode, the application is
+created once in the supervisor process, which then binds the listening socket and forks the configured number of worker
+processes, each running waitress on the shared socket. Crashed workers are restarted. Before forking, the garbage
+collector freezes all objects created so far, so the memory of the loaded application stays shared copy-on-write
+instead of being copied when the collector touches it.
+
+State kept in memory (e.g. installation jobs, the live log, macro caches) is per worker in prefork mode. Changes of the
+loaded plugins at runtime (installing, loading, unloading, removing) are refused with more than one worker, as they
+would only apply to the worker handling the request, see get_worker_count. Activation and deactivation of plugins
+spread to all workers through the config file (see config_reload_interval). The log files are only written by the
+supervisor, workers send their records to it, see libs.log.start_forwarding.
+"""
+from logging import Logger
+
+from libs.config import Config
+
+_workers = 1  # number of processes serving requests
+
+
+def get_worker_count() -> int:
+    """
+    Get the number of processes serving requests, more than one in prefork mode.
+
+    :return: number of worker processes
+    """
+    return _workers
+
+
+def get_waitress_options(config: Config) -> dict:
+    """
+    Get the tuning options of waitress from configuration, see server_threads, server_connection_limit, server_backlog
+    and server_channel_timeout.
+
+    :param config: configuration object
+    :return: keyword arguments for waitress.serve
+    """
+    return {
+        'threads': int(config.get('webapi', 'server_threads')),
+        'connection_limit': int(config.get('webapi', 'server_connection_limit')),
+        'backlog': int(config.get('webapi', 'server_backlog')),
+        'channel_timeout': int(config.get('webapi', 'server_channel_timeout'))
+    }
+
+
+def serve(webapi, config: Config, logger: Logger, host: str, port: int):
+    """
+    Serve the application until the process is terminated, in the mode set by server_mode. Prefork mode falls back to
+    threaded mode on platforms without os.fork.
+
+    :param webapi: main application object
+    :param config: configuration object
+    :param logger: logger of the application
+    :param host: host to listen on
+    :param port: port to listen on
+    """
+    from os import name as os_name
+    options = get_waitress_options(config)
+    mode = config.get('webapi', 'server_mode').lower()
+    if mode == 'prefork' and os_name == 'posix':
+        serve_prefork(webapi, config, logger, host, port, int(config.get('webapi', 'server_workers')), options)
+        return
+    if mode == 'prefork':
+        logger.warning('Prefork mode is not supported on this platform, serving threaded')
+    elif mode != 'threaded':
+        logger.warning(f'Unknown server mode {mode}, serving threaded')
+
+    from waitress import serve as waitress_serve
+    logger.info(f'Serving on {host}:{port} with {options["threads"]} threads')
+    waitress_serve(webapi, host=host, port=port, **options)
+
+
+def serve_prefork(webapi, config: Config, logger: Logger, host: str, port: int, workers: int, options: dict):
+    """
+    Serve the application by forked worker processes sharing one listening socket, see module description. Returns once
+    all workers have exited after SIGTERM or SIGINT.
+
+    :param webapi: main application object
+    :param config: configuration object
+    :param logger: logger of the application
+    :param host: host to listen on
+    :param port: port to listen on
+    :param workers: number of worker processes
+    :param options: tuning options of waitress, see get_waitress_options
+    """
+    import gc
+    from os import register_at_fork, wait, kill, WIFSIGNALED, WTERMSIG, WEXITSTATUS
+    from signal import signal, SIGTERM, SIGINT
+    from socket import create_server
+    from time import monotonic, sleep
+    from libs.log import stop_listener, start_listener, restart_after_fork, start_forwarding
+    global _workers
+
+    workers = _workers = max(1, workers)
+    options = dict(options)
+    sock = create_server((host, port), backlog=options.pop('backlog'))
+    logger.info(f'Serving on {host}:{port} with {workers} workers of {options["threads"]} threads each')
+
+    # Only the forking thread exists in a child, so the background threads are stopped while forking (no locks of them
+    # are held then) and started again in both processes. Pending config changes are written first, a child would keep
+    # them forever (without the timer writing them) and ignore the changes of other workers to the same keys.
+    reload_interval = float(config.get('webapi', 'config_reload_interval') or 0)
+
+    def before_fork():
+        config.flush()
+        config.stop_watching()
+        stop_listener()
+
+    def after_fork_in_parent():
+        start_listener()
+        config.watch(reload_interval)
+
+    def after_fork_in_child():
+        restart_after_fork()
+        config.watch(reload_interval)
+
+    register_at_fork(before=before_fork, after_in_parent=after_fork_in_parent, after_in_child=after_fork_in_child)
+    start_forwarding()
+
+    # Objects existing now are never collected, so the collector does not write to the memory pages shared with workers
+    gc.collect()
+    gc.freeze()
+
+    children = dict()  # {pid: start time}
+    stopping = False
+
+    def spawn():
+        from os import fork
+        pid = fork()
+        if pid == 0:
+            _run_worker(webapi, sock, options)
+        children[pid] = monotonic()
+        logger.debug(f'Started worker {pid}')
+
+    def stop(signum, _):
+        nonlocal stopping
+        stopping = True
+        for child in list(children):
+            try:
+                kill(child, SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal(SIGTERM, stop)
+    signal(SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        reason = f'signal {WTERMSIG(status)}' if WIFSIGNALED(status) else f'exit code {WEXITSTATUS(status)}'
+        logger.warning(f'Worker {pid} has exited with {reason}, restarting it')
+        # Do not restart workers failing right away in a busy loop
+        if monotonic() - started < 1:
+            sleep(1)
+        if not stopping:
+            spawn()
+
+    sock.close()
+    logger.info('All workers have exited')
+
+
+def _run_worker(webapi, sock, options: dict):
+    """
+    Run waitress on the shared socket within a worker process. Never returns.
+
+    :param webapi: main application object
+    :param sock: the listening socket
+    :param options: tuning options of waitress without backlog
+    """
+    from os import _exit
+    from sys import exit
+    from signal import signal, SIGTERM, SIGINT, SIG_IGN
+    from traceback import print_exc
+    # The supervisor stops the workers by SIGTERM, also on SIGINT (e.g. ctrl+c in a terminal)
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, lambda *_: exit(0))
+    code = 1
+    try:
+        from waitress import serve as waitress_serve
+        waitress_serve(webapi, sockets=[sock], **options)
+        code = 0
+    except SystemExit as e:
+        code = e.code or 0
+    except BaseException:
+        print_exc()
+    finally:
+        from libs.log import shutdown
+        shutdown()
+        _exit(code)
@@ -0,0 +1,100 @@
+"""
+Library to record and report how long loading plugins and macros took.
+"""
+from threading import Lock
+from typing import Any, Callable, Dict, List, Tuple
+
+from logging import Logger
+from libs.config import Config
+
+Timings = Dict[str, float]  # {timing name: seconds}
+
+_timings: Dict[str, Dict[str, Timings]] = dict()  # {kind: {name: timings}}
+_phases: Dict[str, float] = dict()  # {kind: seconds}
+_lock = Lock()
+
+
+def record(kind: str, name: str, **timings: float):
+    """
+    Record timings of a single plugin or macro. Timings recorded before under the same name are kept unless
+    overwritten.
+
+    :param kind: kind of the item, e.g. plugin or macro
+    :param name: name of the item
+    :param timings: seconds by timing name, e.g. import_time=0.1
+    """
+    with _lock:
+        _timings.setdefault(kind, dict()).setdefault(name, dict()).update(timings)
+
+
+def record_phase(kind: str, seconds: float):
+    """
+    Record the wall time of loading all items of a kind.
+
+    :param kind: kind of the items, e.g. plugin or macro
+    :param seconds: wall time in seconds
+    """
+    with _lock:
+        _phases[kind] = seconds
+
+
+def get_report() -> dict:
+    """
+    Returns all recorded timings. For every kind, the phase wall time and the items sorted by wall time (slowest first)
+    are listed.
+
+    :return: report as json serializable dictionary
+    """
+    with _lock:
+        return {
+            kind: {
+                'wall_time': _phases.get(kind, 0.0),
+                'items': sorted(
+                    ({'name': name, **timings} for name, timings in _timings.get(kind, dict()).items()),
+                    key=lambda item: item.get('wall_time', 0.0),
+                    reverse=True
+                )
+            }
+            for kind in dict.fromkeys(list(_phases.keys()) + list(_timings.keys()))
+        }
+
+
+def log_summary(logger: Logger, slowest: int = 3):
+    """
+    Log a summary line per kind containing the phase wall time and the slowest items.
+
+    :param logger: logger to use
+    :param slowest: number of items to name
+    """
+    for kind, entry in get_report().items():
+        items: List[dict] = entry['items']
+        names = ', '.join(f"{item['name']} ({item.get('wall_time', 0.0):.3f}s)" for item in items[:slowest])
+        logger.info(f'Loaded {len(items)} {kind}s in {entry["wall_time"]:.3f}s, slowest: {names or "-"}')
+
+
+def timed(func: Callable, *args, **kwargs) -> Tuple[Any, float]:
+    """
+    Call a function and measure how long it took.
+
+    :param func: function to call
+    :param args: positional arguments for the function
+    :param kwargs: keyword arguments for the function
+    :return: return value of the function and the duration in seconds
+    """
+    from time import perf_counter
+    start = perf_counter()
+    result = func(*args, **kwargs)
+    return result, perf_counter() - start
+
+
+def get_loader_threads(config: Config) -> int:
+    """
+    Get the number of threads to use for importing plugins and macros.
+
+    :param config: configuration object
+    :return: number of threads, at least one
+    """
+    try:
+        return max(1, int(config.get('webapi', 'loader_threads')))
+    except ValueError:
+        return 1
@@ -0,0 +1,310 @@
+"""
+On-demand thumbnails of the images and videos in the media folder.
+
+A thumbnail is generated on first request by a pool of worker threads, concurrent requests for the same thumbnail wait
+for a single generation. Thumbnails are stored in the folder GENERATED_FOLDER within the thumbnail folder, named by a
+hash of the media file path, the size and the format. A thumbnail is generated again once its media file is modified,
+as the modification time of the media file is copied to it. The stored thumbnails are limited to a byte budget (config
+thumbnail_cache_size), least recently used ones are removed first. The index of stored thumbnails is built from the
+folder on startup (see setup), so thumbnails of earlier runs count towards the budget.
+
+Thumbnails of videos show a frame grabbed by ffmpeg (if it is on the PATH), one second into the video. Generating
+thumbnails requires the Pillow package, it is optional otherwise.
+"""
+from collections import OrderedDict
+from concurrent.futures import Future
+from os.path import join
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from libs.config import Config
+
+#: Folder within the thumbnail folder storing generated thumbnails
+GENERATED_FOLDER = '.generated'
+#: Supported formats by name: (Pillow format, file extension)
+FORMATS = {'jpeg': ('JPEG', 'jpg'), 'png': ('PNG', 'png'), 'webp': ('WEBP', 'webp')}
+#: Position in seconds of the frame used as thumbnail of videos
+FRAME_POSITION = 1
+#: Seconds to wait for ffmpeg grabbing a frame
+FRAME_TIMEOUT = 10
+
+_flights: Dict[str, Future] = dict()  # {thumbnail name and requested format: generation}
+_lock = Lock()
+_pool = None
+_cache: Optional['ThumbnailCache'] = None
+
+
+class ThumbnailCache:
+    """
+    Index of the generated thumbnails in order of their last use, removing the least recently used ones if the total
+    size exceeds the budget.
+    """
+
+    def __init__(self, folder: str, budget: int):
+        """
+        Create the index from the thumbnails stored in a folder, ordered by their access time.
+
+        :param folder: folder of the generated thumbnails
+        :param budget: maximum total size in bytes
+        """
+        from os import scandir
+        self.folder = folder
+        self.budget = budget
+        self.size = 0
+        self._entries: OrderedDict = OrderedDict()  # {name: size}
+        self._lock = Lock()
+        try:
+            files = [(entry.stat().st_atime, entry.name, entry.stat().st_size) for entry in scandir(folder)
+                     if entry.is_file() and not entry.name.endswith('.tmp')]
+        except OSError:
+            files = list()
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self.size += size
+
+    def touch(self, name: str, size: int = None):
+        """
+        Mark a thumbnail as used, adding it if it is new. Thumbnails missing from the index (e.g. written by another
+        worker process) are added with their size on disk.
+
+        :param name: file name of the thumbnail
+        :param size: size in bytes if the thumbnail is new or was replaced
+        """
+        if size is None and name not in self._entries:
+            from os import stat
+            try:
+                size = stat(join(self.folder, name)).st_size
+            except OSError:
+                return
+        with self._lock:
+            if size is not None:
+                self.size += size - self._entries.get(name, 0)
+                self._entries[name] = size
+            if name in self._entries:
+                self._entries.move_to_end(name)
+
+    def evict(self, keep: str = None) -> int:
+        """
+        Remove the least recently used thumbnails until the total size is within the budget.
+
+        :param keep: name of a thumbnail not to remove, e.g. the one just generated
+        :return: number of removed thumbnails
+        """
+        from os import remove
+        removed = list()
+        with self._lock:
+            for name in list(self._entries):
+                if self.size <= self.budget:
+                    break
+                if name == keep:
+                    continue
+                self.size -= self._entries.pop(name)
+                removed.append(name)
+        for name in removed:
+            try:
+                remove(join(self.folder, name))
+            except OSError:
+                pass
+        return len(removed)
+
+
+def setup(config: Config, logger=None):
+    """
+    Build the index of the stored thumbnails from the folder and remove the least recently used ones exceeding the
+    budget, e.g. after it was lowered. Called on startup.
+
+    :param config: configuration object
+    :param logger: optional logger reporting removed thumbnails
+    """
+    cache = _get_cache(config, join(config.get('webapi', 'thumbnail_path'), GENERATED_FOLDER))
+    removed = cache.evict()
+    if logger is not None and removed:
+        logger.info(f'Removed {removed} thumbnails exceeding the thumbnail cache size')
+
+
+def parse_size(size: Optional[str], default: int, maximum: int) -> Tuple[int, int]:
+    """
+    Parse the requested size of a thumbnail, either a single number (a square box) or <width>x<height>. The thumbnail
+    fits into the box keeping the aspect ratio.
+
+    :param size: the requested size or None for the default
+    :param default: default size
+    :param maximum: maximum width and height, larger sizes are reduced to it
+    :raises ValueError: if the size is invalid
+    :return: width and height of the box
+    """
+    if not size:
+        return default, default
+    width, _, height = size.lower().partition('x')
+    if not width.isdigit() or not (height or width).isdigit():
+        raise ValueError(f'Invalid thumbnail size {size}')
+    width, height = int(width), int(height or width)
+    if width < 1 or height < 1:
+        raise ValueError(f'Invalid thumbnail size {size}')
+    return min(width, maximum), min(height, maximum)
+
+
+def get_thumbnail(config: Config, filename: str, size: str = None, image_format: str = None) -> str:
+    """
+    Get a thumbnail of a media file, generating it if it does not exist or is outdated.
+
+    :param config: configuration object
+    :param filename: path of the media file within the media folder
+    :param size: requested size, see parse_size
+    :param image_format: jpeg, png or webp. Defaults to jpeg, or png for images with transparency.
+    :raises ValueError: if the size or format is invalid or the path leaves the media folder
+    :raises FileNotFoundError: if the media file does not exist
+    :raises RuntimeError: if Pillow is not installed or the media file is no supported image or video (also if ffmpeg
+        is not available for videos)
+    :return: path of the thumbnail within the thumbnail folder
+    """
+    from hashlib import sha256
+    from os import stat
+    from libs.basics.archive import safe_join
+    from libs.basics.api.files import cached_stat
+
+    source = safe_join(config.get('webapi', 'media_path'), filename)
+    source_stat = cached_stat(source)
+    if source_stat is None:
+        raise FileNotFoundError(f'No media file {filename}')
+    width, height = parse_size(size, int(config.get('webapi', 'thumbnail_default_size')),
+                               int(config.get('webapi', 'thumbnail_max_size')))
+    if image_format is not None and image_format.lower() not in FORMATS:
+        raise ValueError(f'Unsupported thumbnail format {image_format}, use one of {", ".join(FORMATS)}')
+
+    folder = join(config.get('webapi', 'thumbnail_path'), GENERATED_FOLDER)
+    stem = f'{sha256(filename.encode("utf-8")).hexdigest()[:16]}-{width}x{height}'
+    cache = _get_cache(config, folder)
+    for name in [f'{stem}.{FORMATS[image_format.lower()][1]}'] if image_format else \
+            [f'{stem}.{extension}' for _, extension in FORMATS.values()]:
+        try:
+            if stat(join(folder, name)).st_mtime_ns == source_stat.st_mtime_ns:
+                cache.touch(name)
+                return f'{GENERATED_FOLDER}/{name}'
+        except OSError:
+            continue
+
+    key = f'{stem}.{image_format.lower() if image_format else ""}'
+    with _lock:
+        future = _flights.get(key)
+        leader = future is None
+        if leader:
+            global _pool
+            if _pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _pool = ThreadPoolExecutor(max_workers=max(1, int(config.get('webapi', 'thumbnail_workers'))),
+                                           thread_name_prefix='thumbnails')
+            future = _flights[key] = _pool.submit(
+                _generate, source, source_stat.st_mtime_ns, folder, stem, width, height,
+                image_format.lower() if image_format else None, int(config.get('webapi', 'thumbnail_quality'))
+            )
+    if leader:
+        # Registered outside of _lock, the callback runs right away in this thread if the generation already finished
+        future.add_done_callback(lambda _: _forget_flight(key))
+    name, thumbnail_size = future.result()
+    cache.touch(name, thumbnail_size)
+    cache.evict(keep=name)
+    return f'{GENERATED_FOLDER}/{name}'
+
+
+def _forget_flight(key: str):
+    """
+    Remove a finished generation, so the next request checks the stored thumbnail again.
+
+    :param key: name of the thumbnail without extension and the requested format
+    """
+    with _lock:
+        _flights.pop(key, None)
+
+
+def _get_cache(config: Config, folder: str) -> ThumbnailCache:
+    """
+    Get the index of the generated thumbnails, creating it on first use.
+
+    :param config: configuration object
+    :param folder: folder of the generated thumbnails
+    :return: the index
+    """
+    global _cache
+    with _lock:
+        if _cache is None or _cache.folder != folder:
+            _cache = ThumbnailCache(folder, int(config.get('webapi', 'thumbnail_cache_size')))
+        return _cache
+
+
+def _generate(source: str, mtime_ns: int, folder: str, stem: str, width: int, height: int,
+              image_format: Optional[str], quality: int) -> Tuple[str, int]:
+    """
+    Generate a thumbnail, runs within the worker pool.
+
+    :param source: path of the media file
+    :param mtime_ns: modification time of the media file, set on the thumbnail
+    :param folder: folder of the generated thumbnails
+    :param stem: name of the thumbnail without extension
+    :param width: maximum width
+    :param height: maximum height
+    :param image_format: name of the format, see FORMATS, or None to choose by transparency
+    :param quality: quality for lossy formats
+    :raises RuntimeError: if Pillow is not installed or the file is no supported image or video
+    :return: file name and size of the thumbnail
+    """
+    from io import BytesIO
+    from mimetypes import guess_type
+    from os import utime, stat
+    from libs.basics.file import create_folder, write_atomic
+    try:
+        from PIL import Image, ImageOps, UnidentifiedImageError
+    except ImportError:
+        raise RuntimeError('Generating thumbnails requires the Pillow package')
+
+    image_source = source
+    if (guess_type(source)[0] or '').startswith('video/'):
+        image_source = BytesIO(_grab_frame(source))
+    try:
+        with Image.open(image_source) as image:
+            # Lets the JPEG decoder scale down while decoding, which is much faster than loading the full image
+            image.draft('RGB', (width, height))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((width, height))
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+            image_format = image_format or ('png' if has_alpha else 'jpeg')
+            pillow_format, extension = FORMATS[image_format]
+            if pillow_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            buffer = BytesIO()
+            image.save(buffer, pillow_format, quality=quality, optimize=True)
+    except (UnidentifiedImageError, OSError) as e:
+        raise RuntimeError(f'No thumbnail available: {e}')
+
+    name = f'{stem}.{extension}'
+    fp = join(folder, name)
+    create_folder(folder)
+    write_atomic(fp, buffer.getvalue())
+    utime(fp, ns=(stat(fp).st_atime_ns, mtime_ns))
+    return name, len(buffer.getvalue())
+
+
+def _grab_frame(source: str) -> bytes:
+    """
+    Grab a frame of a video by ffmpeg, at FRAME_POSITION or the first frame for shorter videos.
+
+    :param source: path of the video
+    :raises RuntimeError: if ffmpeg is not on the PATH or fails
+    :return: the frame as png
+    """
+    from shutil import which
+    from subprocess import run, PIPE, DEVNULL, SubprocessError
+    ffmpeg = which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError('Generating thumbnails of videos requires ffmpeg')
+    for position in (FRAME_POSITION, 0):
+        try:
+            # Seeking before the input is fast, it jumps to the nearest keyframe instead of decoding up to the position
+            result = run([ffmpeg, '-v', 'error', '-ss', str(position), '-i', source, '-frames:v', '1',
+                          '-f', 'image2pipe', '-vcodec', 'png', '-'],
+                         stdout=PIPE, stderr=DEVNULL, timeout=FRAME_TIMEOUT)
+        except (OSError, SubprocessError) as e:
+            raise RuntimeError(f'No thumbnail available: {e}')
+        if result.stdout:
+            return result.stdout
+    raise RuntimeError(f'No thumbnail available: ffmpeg could not read a frame of {source}')